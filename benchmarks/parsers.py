@@ -0,0 +1,96 @@
+"""
+Compares the throughput of the metadata parsers on large synthetic outputs:
+the text parser as it was before OPF parsing was added, the current text
+parser and the OPF parser. :func:`throughput` feeds the ``parse_throughput``
+scenario of :mod:`benchmarks.run`. Run from the repository root as ::
+
+    python -m benchmarks.parsers
+"""
+import io
+import timeit
+
+from capybre.metadata import extract_raw_metadata_map, clean_metadata_map
+from capybre.opf import parse_opf
+
+DESCRIPTION_LINES = 20000
+REPEAT = 5
+
+
+def legacy_extract_raw_metadata_map(raw_metadata):
+    metadata_lines = []
+    for line in raw_metadata:
+        if len(line.strip()) > 20 and line[20] == ':':
+            key, _, value = line.partition(':')
+            metadata_lines.append((key.strip(), value))
+        elif len(metadata_lines) > 0:
+            (key, value) = metadata_lines[-1]
+            metadata_lines[-1] = (key, value + ' ' + line)
+
+    return {key.strip(): value.strip() for key, value in metadata_lines}
+
+
+def text_output(description_lines):
+    return [
+        'Title               : Pride and Prejudice',
+        'Author(s)           : Jane Austen [Austen, Jane]',
+        'Identifiers         : isbn:9780679783268, uri:http://www.gutenberg.org/1342',
+        'Comments            : It is a truth universally acknowledged,',
+    ] + ['that a single man in possession of a good fortune'] * description_lines + [
+        'Published           : 1998-06-01T00:00:00+00:00',
+    ]
+
+
+def opf_output(description_lines):
+    description = '\n'.join(['that a single man in possession of a good fortune'] * description_lines)
+    return '''<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>Pride and Prejudice</dc:title>
+    <dc:creator opf:file-as="Austen, Jane" opf:role="aut">Jane Austen</dc:creator>
+    <dc:identifier opf:scheme="ISBN">9780679783268</dc:identifier>
+    <dc:description>It is a truth universally acknowledged, {}</dc:description>
+    <dc:date>1998-06-01T00:00:00+00:00</dc:date>
+  </metadata>
+</package>
+'''.format(description).encode('utf-8')
+
+
+SIZES = (10, 1000, DESCRIPTION_LINES)
+
+
+def best_of(fn):
+    return min(timeit.repeat(fn, number=1, repeat=REPEAT))
+
+
+def throughput():
+    """Lines per second through each parser, for outputs of several sizes"""
+    results = {}
+    for size in SIZES:
+        text = text_output(size)
+        opf = opf_output(size)
+        lines = len(text)
+        timings = {
+            'extract_raw_metadata_map': best_of(lambda: extract_raw_metadata_map(text)),
+            'clean_metadata_map': best_of(lambda: clean_metadata_map(extract_raw_metadata_map(text))),
+            'parse_opf': best_of(lambda: parse_opf(io.BytesIO(opf))),
+        }
+        for name, seconds in timings.items():
+            results['{}.{}_lines_per_s'.format(name, size)] = lines / seconds
+    return results
+
+
+def main():
+    text = text_output(DESCRIPTION_LINES)
+    opf = opf_output(DESCRIPTION_LINES)
+    results = {
+        'legacy text': best_of(lambda: clean_metadata_map(legacy_extract_raw_metadata_map(text))),
+        'text': best_of(lambda: clean_metadata_map(extract_raw_metadata_map(text))),
+        'opf': best_of(lambda: parse_opf(io.BytesIO(opf))),
+    }
+    print('{} description lines, best of {}'.format(DESCRIPTION_LINES, REPEAT))
+    for name, seconds in results.items():
+        print('{:<12} {:>10.2f} ms'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""
+Benchmarks capybre's own overhead and scaling, printing the results as JSON
+so runs can be compared across releases. Run from the repository root as ::
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline previous.json
+
+By default the Calibre tools are replaced by the stand-ins in
+``benchmarks/stubs``, whose latency and output size are set with
+``--latency`` and ``--output-bytes``. With ``--real``, the same scenarios run
+against the Calibre install on the ``PATH`` (converting the sample EPUB
+from ``tests/``); lookups then hit the network, so the fetch scenarios only
+run with ``--network``.
+
+Every metric is named for its unit: ``_ms`` metrics are better lower and
+``_per_s`` metrics better higher. With ``--baseline``, metrics that got
+worse by more than ``--threshold`` are listed and the exit status is 1.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from capybre import aio
+from capybre.convert import convert, convert_many
+from capybre.fetch_metadata import fetch_metadata, fetch_metadata_many
+from capybre.helpers import default_workers
+from capybre.metadata import extract_metadata
+
+from . import parsers
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(ROOT, 'benchmarks', 'stubs')
+SAMPLE = os.path.join(ROOT, 'tests', 'PrideAndPrejudice.epub')
+TOOLS = ('ebook-convert', 'ebook-meta', 'fetch-ebook-metadata')
+
+WORKER_COUNTS = (1, 2, 4, 8)
+ISBN = '9780679783268'
+
+
+def timed(fn, repeat):
+    """Mean wall time of fn in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def call_overhead(workdir, options):
+    """Per-call cost of each wrapper over running the same tool directly"""
+    output = os.path.join(workdir, 'overhead.mobi')
+    calls = {
+        'convert': (
+            ['ebook-convert', SAMPLE, output],
+            lambda: convert(SAMPLE, output),
+        ),
+        'extract_metadata': (
+            ['ebook-meta', SAMPLE],
+            lambda: extract_metadata(SAMPLE, native=False),
+        ),
+    }
+    if options.network:
+        calls['fetch_metadata'] = (
+            ['fetch-ebook-metadata', '--isbn', ISBN],
+            lambda: fetch_metadata(isbn=ISBN),
+        )
+    results = {}
+    for name, (args, wrapped) in calls.items():
+        direct_ms = timed(
+            lambda: subprocess.run(args, stdout=subprocess.PIPE, check=True),
+            options.repeat
+        )
+        wrapped_ms = timed(wrapped, options.repeat)
+        results[name + '.direct_ms'] = direct_ms
+        results[name + '.wrapped_ms'] = wrapped_ms
+        results[name + '.overhead_ms'] = wrapped_ms - direct_ms
+    results['extract_metadata.native_ms'] = timed(lambda: extract_metadata(SAMPLE), options.repeat)
+    return results
+
+
+def parse_throughput(workdir, options):
+    """Lines per second through the text and OPF parsers"""
+    return parsers.throughput()
+
+
+def batch_scaling(workdir, options):
+    """Throughput of the thread-pool batch APIs as workers are added"""
+    results = {}
+    jobs = options.jobs
+    for workers in WORKER_COUNTS:
+        jobs_list = [
+            {'input_file': SAMPLE, 'output_file': os.path.join(workdir, 'batch{}.mobi'.format(i))}
+            for i in range(jobs)
+        ]
+        start = time.perf_counter()
+        for result in convert_many(jobs_list, max_workers=workers):
+            if not result.ok:
+                raise result.error
+        results['convert_many.{}_workers_per_s'.format(workers)] = jobs / (time.perf_counter() - start)
+
+        if options.network:
+            start = time.perf_counter()
+            queries = [(None, None, ISBN)] * jobs
+            list(fetch_metadata_many(queries, max_workers=workers))
+            results['fetch_metadata_many.{}_workers_per_s'.format(workers)] = (
+                jobs / (time.perf_counter() - start)
+            )
+    return results
+
+
+def async_scaling(workdir, options):
+    """Throughput of the asyncio APIs as the concurrency limit is raised"""
+    results = {}
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        for limit in WORKER_COUNTS:
+            aio.set_concurrency(limit)
+            conversions = [
+                aio.async_convert(SAMPLE, os.path.join(workdir, 'async{}.mobi'.format(i)))
+                for i in range(options.jobs)
+            ]
+            start = time.perf_counter()
+            loop.run_until_complete(asyncio.gather(*conversions))
+            results['async_convert.{}_concurrent_per_s'.format(limit)] = (
+                options.jobs / (time.perf_counter() - start)
+            )
+    finally:
+        aio.set_concurrency(default_workers())
+        asyncio.set_event_loop(None)
+        loop.close()
+    return results
+
+
+SCENARIOS = {
+    'call_overhead': call_overhead,
+    'parse_throughput': parse_throughput,
+    'batch_scaling': batch_scaling,
+    'async_scaling': async_scaling,
+}
+
+
+def use_stubs(options):
+    os.environ['PATH'] = STUBS + os.pathsep + os.environ.get('PATH', '')
+    os.environ['CAPYBRE_STUB_LATENCY'] = str(options.latency)
+    os.environ['CAPYBRE_STUB_OUTPUT_BYTES'] = str(options.output_bytes)
+
+
+def compare(baseline, results, threshold):
+    """Metrics that got worse than baseline by more than threshold
+
+    Returns:
+        List of ``(scenario, metric, before, after)`` tuples
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, after in metrics.items():
+            before = baseline.get(scenario, {}).get(metric)
+            if not before or before <= 0 or after <= 0:
+                continue
+            if metric.endswith('_ms'):
+                worse = after / before - 1
+            elif metric.endswith('_per_s'):
+                worse = before / after - 1
+            else:
+                continue
+            if worse > threshold:
+                regressions.append((scenario, metric, before, after))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--real', action='store_true',
+                        help='run against the Calibre tools on the PATH instead of the stubs')
+    parser.add_argument('--network', action='store_true',
+                        help='also run the fetch scenarios (which hit the network with --real)')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run; may be repeated. Defaults to all of them')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds each stub call takes (default: %(default)s)')
+    parser.add_argument('--output-bytes', type=int, default=64 * 1024,
+                        help='size of the files the conversion stub writes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='calls averaged per overhead measurement (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=32,
+                        help='items per batch or concurrency measurement (default: %(default)s)')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction a metric may worsen by before it counts as a regression '
+                             '(default: %(default)s)')
+    options = parser.parse_args(argv)
+    if not options.real:
+        # the stubs answer lookups locally
+        options.network = True
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.real:
+        missing = [tool for tool in TOOLS if shutil.which(tool) is None]
+        if missing:
+            sys.exit('--real needs Calibre on the PATH; missing {}'.format(', '.join(missing)))
+    else:
+        use_stubs(options)
+
+    report = {
+        'mode': 'real' if options.real else 'stub',
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': {
+            'latency': None if options.real else options.latency,
+            'output_bytes': None if options.real else options.output_bytes,
+            'repeat': options.repeat,
+            'jobs': options.jobs,
+        },
+        'results': {},
+    }
+    workdir = tempfile.mkdtemp(prefix='capybre-bench-')
+    try:
+        for name in options.scenario or SCENARIOS:
+            report['results'][name] = SCENARIOS[name](workdir, options)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, report['results'], options.threshold)
+        for scenario, metric, before, after in regressions:
+            sys.stderr.write('regression: {} {} {:.4g} -> {:.4g}\n'.format(scenario, metric, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Shared behaviour of the stand-ins for Calibre's command line tools, tuned
+through environment variables:
+
+``CAPYBRE_STUB_LATENCY``
+    Seconds each call sleeps before doing anything, standing in for
+    Calibre's startup and work. Defaults to 0
+``CAPYBRE_STUB_OUTPUT_BYTES``
+    Size of the files ``ebook-convert`` writes. Defaults to 64 KiB
+``CAPYBRE_STUB_DESCRIPTION_LINES``
+    Lines of description printed by ``ebook-meta`` and
+    ``fetch-ebook-metadata``. Defaults to 5
+"""
+import os
+import sys
+import time
+
+LATENCY = float(os.environ.get('CAPYBRE_STUB_LATENCY', '0'))
+OUTPUT_BYTES = int(os.environ.get('CAPYBRE_STUB_OUTPUT_BYTES', str(64 * 1024)))
+DESCRIPTION_LINES = int(os.environ.get('CAPYBRE_STUB_DESCRIPTION_LINES', '5'))
+
+DESCRIPTION_LINE = 'that a single man in possession of a good fortune, must be in want of a wife.'
+
+
+def wait():
+    if LATENCY:
+        time.sleep(LATENCY)
+
+
+def option(args, name):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+
+
+def print_text_metadata():
+    lines = [
+        'Title               : Pride and Prejudice',
+        'Author(s)           : Jane Austen [Austen, Jane]',
+        'Tags                : Love stories, Sisters -- Fiction, Domestic fiction',
+        'Languages           : eng',
+        'Published           : 1998-06-01T00:00:00+00:00',
+        'Identifiers         : isbn:9780679783268, uri:http://www.gutenberg.org/1342',
+        'Comments            : It is a truth universally acknowledged,',
+    ] + [DESCRIPTION_LINE] * DESCRIPTION_LINES
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def opf_metadata():
+    return '''<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>Pride and Prejudice</dc:title>
+    <dc:creator opf:file-as="Austen, Jane" opf:role="aut">Jane Austen</dc:creator>
+    <dc:identifier opf:scheme="ISBN">9780679783268</dc:identifier>
+    <dc:language>eng</dc:language>
+    <dc:date>1998-06-01T00:00:00+00:00</dc:date>
+    <dc:description>It is a truth universally acknowledged, {}</dc:description>
+  </metadata>
+</package>
+'''.format('\n'.join([DESCRIPTION_LINE] * DESCRIPTION_LINES))
@@ -1,30 +1,92 @@
-from .convert import convert, converted_fileobj
-from .ebook_format import EbookFormat
-from .metadata import (
-    Metadata,
-    extract_metadata,
-    extract_metadata_map,
-    extract_cover,
-    extracted_cover_fileobj
-)
-from .fetch_metadata import (
-    fetch_metadata,
-    fetch_metadata_map,
-    fetch_cover,
-    fetched_metadata_and_cover
-)
-
-__all__ = [
-    'convert',
-    'converted_fileobj',
-    'EbookFormat',
-    'extract_cover',
-    'extract_metadata',
-    'extract_metadata_map',
-    'extracted_cover_fileobj',
-    'fetch_cover',
-    'fetch_metadata',
-    'fetch_metadata_map',
-    'fetched_metadata_and_cover',
-    'Metadata',
-]
+"""
+Exports are imported from their submodules on first use, so ``import
+capybre`` stays cheap for short-lived processes that only need part of it.
+"""
+import importlib
+import sys
+import types
+
+_EXPORTS = {
+    'aio': (
+        'async_convert',
+        'async_convert_progress',
+        'async_extract_cover',
+        'async_extract_metadata',
+        'async_fetch_metadata',
+    ),
+    'conversion_cache': ('ConversionCache',),
+    'convert': (
+        'convert',
+        'convert_bytes',
+        'convert_many',
+        'convert_to_buffer',
+        'convert_to_many',
+        'converted_fileobj',
+        'ConversionResult',
+    ),
+    'ebook_format': ('EbookFormat',),
+    'fetch_cache': ('FetchCache',),
+    'fetch_metadata': (
+        'fetch_metadata',
+        'fetch_metadata_map',
+        'fetch_cover',
+        'fetch_metadata_many',
+        'fetched_metadata_and_cover',
+        'FetchResult',
+        'MetadataNotFound',
+    ),
+    'library': ('LibraryIndex',),
+    'limits': (
+        'CalibreTimeout',
+        'ResourceLimitExceeded',
+        'ResourceLimits',
+        'set_limits',
+    ),
+    'metadata': (
+        'Metadata',
+        'extract_metadata',
+        'extract_metadata_map',
+        'extract_metadata_and_cover',
+        'extract_cover',
+        'extract_cover_bytes',
+        'extracted_cover_fileobj',
+        'extracted_metadata_and_cover',
+    ),
+    'metadata_cache': ('MetadataCache',),
+    'metadata_table': ('MetadataTable',),
+    'mirror': ('plan_sync', 'sync_converted', 'SyncPlan', 'SyncReport'),
+    'profiles': ('ConversionProfile',),
+    'progress': ('ConversionStalled', 'Progress'),
+    'remote': ('RemoteConverter', 'WorkerServer', 'WorkerUnavailable'),
+    'scheduler': ('QueueFull', 'Scheduler'),
+    'toolchain': ('CalibreNotFound', 'health_check'),
+    'worker_pool': ('WorkerPool',),
+    'write_metadata': ('write_metadata', 'write_metadata_many', 'WriteResult'),
+}
+
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = sorted(_MODULES, key=str.lower)
+
+
+class _Package(types.ModuleType):
+
+    def __getattr__(self, name):
+        if name not in _MODULES:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+        value = getattr(importlib.import_module('.' + _MODULES[name], __name__), name)
+        types.ModuleType.__setattr__(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        # importing a submodule binds it on the package, which would hide
+        # an export of the same name (e.g. capybre.convert)
+        if name in _MODULES and isinstance(value, types.ModuleType):
+            return
+        types.ModuleType.__setattr__(self, name, value)
+
+    def __dir__(self):
+        return sorted(set(types.ModuleType.__dir__(self)) | set(__all__))
+
+
+sys.modules[__name__].__class__ = _Package
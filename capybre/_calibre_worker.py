@@ -0,0 +1,101 @@
+"""
+Long-lived worker run inside Calibre's own interpreter by
+:class:`capybre.worker_pool.WorkerPool`, as ``calibre-debug -e`` this file.
+
+Reads one JSON request per line from stdin, of the form ::
+
+    {"calls": [["ebook-meta", "book.epub"], ...]}
+
+and runs each call through the entry point of the named command line tool,
+answering with one JSON line per request ::
+
+    {"results": [{"code": 0, "output": "...", "stderr": "..."}, ...]}
+
+where stderr is the end of what the call wrote to stderr, which is also
+passed through. Anything Calibre itself prints is redirected to stderr so
+it can't corrupt the protocol stream. This file is never imported by
+capybre.
+"""
+import importlib
+import io
+import json
+import os
+import sys
+import traceback
+
+ENTRY_POINTS = {
+    'ebook-convert': ('calibre.ebooks.conversion.cli', 'main'),
+    'ebook-meta': ('calibre.ebooks.metadata.cli', 'main'),
+    'fetch-ebook-metadata': ('calibre.ebooks.metadata.sources.cli', 'main'),
+}
+
+
+class StderrTail(io.RawIOBase):
+    """Passes writes through to target, keeping the end of them"""
+
+    SIZE = 64 * 1024
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+        self.tail = b''
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.target.write(data)
+        self.target.flush()
+        self.tail = (self.tail + data)[-self.SIZE:]
+        return len(data)
+
+
+def run_tool(args):
+    module, name = ENTRY_POINTS[args[0]]
+    main = getattr(importlib.import_module(module), name)
+    buffer = io.BytesIO()
+    stdout = sys.stdout
+    stderr = sys.stderr
+    capture = io.TextIOWrapper(buffer, encoding='utf-8', write_through=True)
+    tail = StderrTail(stderr.buffer)
+    # Calibre's prints() writes bytes to the buffer of the stream it's given
+    sys.stderr = io.TextIOWrapper(tail, encoding='utf-8', errors='replace', write_through=True)
+    sys.stdout = capture
+    try:
+        code = main(list(args))
+    except SystemExit as e:
+        code = e.code
+    except Exception:
+        sys.stderr.write(traceback.format_exc())
+        code = 1
+    finally:
+        sys.stdout = stdout
+        capture.flush()
+        capture.detach()
+        sys.stderr.flush()
+        sys.stderr.detach()
+        sys.stderr = stderr
+    if not isinstance(code, int):
+        code = 0 if code is None else 1
+    return {
+        'code': code,
+        'output': buffer.getvalue().decode('utf-8', 'replace'),
+        'stderr': tail.tail.decode('utf-8', 'replace'),
+    }
+
+
+def serve():
+    protocol = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        results = [run_tool(call) for call in request['calls']]
+        protocol.write(json.dumps({'results': results}).encode('utf-8') + b'\n')
+        protocol.flush()
+
+
+serve()
@@ -0,0 +1,325 @@
+"""
+Coroutine versions of the conversion, extraction and fetching functions,
+built on asyncio subprocesses so they can be awaited from an event loop
+without tying up a thread per Calibre call. For use like ::
+
+    metadata = await async_extract_metadata('PrideAndPrejudice.epub')
+
+The number of Calibre processes running at once on an event loop is capped
+by a semaphore (see :func:`set_concurrency`). Cancelling one of these
+coroutines kills the Calibre process it started, along with any children
+it spawned.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import weakref
+
+from .convert import output_filename
+from .ebook_format import EbookFormat
+from .fetch_metadata import fetch_metadata_args, MetadataNotFound, NO_RESULTS
+from .helpers import decode_lines, default_workers
+from .instrumentation import observe
+from .profiles import profile_args
+from .progress import ConversionStalled, parse_progress, Progress
+from .limits import (
+    breached,
+    CalibreTimeout,
+    command,
+    effective_limits,
+    kill_group,
+    ResourceLimitExceeded,
+)
+from .metadata import extract_raw_metadata_map, clean_metadata_map, Metadata
+
+
+_concurrency = default_workers()
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def set_concurrency(limit):
+    """Sets how many Calibre processes may run at once on each event loop
+
+    Args:
+        limit (int): Maximum number of concurrent subprocesses. Defaults to
+            the number of available cores
+    """
+    global _concurrency
+    _concurrency = limit
+    _semaphores.clear()
+
+
+def _semaphore():
+    loop = asyncio.get_event_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(_concurrency)
+    return _semaphores[loop]
+
+
+def _kill(process):
+    if process.returncode is None:
+        kill_group(process.pid)
+
+
+def _stdout(suppress_output):
+    return subprocess.DEVNULL if suppress_output else None
+
+
+async def _run(args, stdout=subprocess.PIPE, limits=None, capture_stderr=False):
+    limits = effective_limits(limits)
+    capture_stderr = capture_stderr or limits.memory_bytes is not None
+    async with _semaphore():
+        with observe(args) as invocation:
+            process = await asyncio.create_subprocess_exec(
+                *command(args, limits),
+                stdout=stdout,
+                stderr=subprocess.PIPE if capture_stderr else None,
+                start_new_session=hasattr(os, 'killpg')
+            )
+            try:
+                output, stderr = await asyncio.wait_for(process.communicate(), limits.timeout)
+            except asyncio.TimeoutError:
+                _kill(process)
+                await process.wait()
+                raise CalibreTimeout(args, limits.timeout) from None
+            except asyncio.CancelledError:
+                _kill(process)
+                await process.wait()
+                raise
+            if stderr:
+                sys.stderr.write(stderr.decode('utf-8', 'replace'))
+            invocation.exit_code = process.returncode
+            if output is not None:
+                invocation.output_size = len(output)
+            exceeded = breached(limits, process.returncode, stderr=stderr)
+            if exceeded:
+                raise ResourceLimitExceeded(exceeded, process.returncode, args, output, stderr)
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, args, output, stderr)
+    return output
+
+
+async def async_convert(
+    input_file,
+    output_file=None,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None,
+    suppress_output=True,
+    limits=None,
+    profile=None
+) -> str:
+    """Coroutine version of :func:`capybre.convert.convert`
+
+    Args:
+        input_file (str): path to the input file
+        output_file (str, optional): fully-specified path to the output file
+        as_format (EbookFormat, optional): Enum representation of desired
+            output format
+        as_ext (str, optional): String representation of desired output format,
+            e.g. ``mobi``
+        suppress_output (bool, optional): Suppresses stdout from ebook-convert
+            call (typically dozens of lines). Defaults to ``True``
+        limits (ResourceLimits, optional): Timeout and resource limits for
+            the ebook-convert call, overriding the global ones, see
+            :mod:`capybre.limits`
+        profile (ConversionProfile or str, optional): Options to convert
+            with, or the name of a preset (``'fast'``, ``'balanced'`` or
+            ``'quality'``), see :mod:`capybre.profiles`
+    Returns:
+        Path to the output file
+    """
+    output_file = output_filename(input_file, output_file, as_format, as_ext)
+    await _run(
+        ['ebook-convert', input_file, output_file] + profile_args(profile, input_file, output_file),
+        stdout=_stdout(suppress_output),
+        limits=limits
+    )
+    return output_file
+
+
+async def async_convert_progress(
+    input_file,
+    output_file=None,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None,
+    limits=None,
+    profile=None,
+    stall_timeout=None
+):
+    """Converts like :func:`async_convert`, yielding the conversion's
+    progress as it advances. For use like ::
+
+        async for stage, fraction, elapsed in async_convert_progress('Manual.pdf', as_ext='epub'):
+            print('{:.0%} {}'.format(fraction, stage))
+
+    The output file has been written once iteration ends. Stopping
+    iteration early kills the conversion.
+
+    Args:
+        input_file (str): path to the input file
+        output_file (str, optional): fully-specified path to the output file
+        as_format (EbookFormat, optional): Enum representation of desired
+            output format
+        as_ext (str, optional): String representation of desired output format,
+            e.g. ``mobi``
+        limits (ResourceLimits, optional): Timeout and resource limits for
+            the ebook-convert call, overriding the global ones, see
+            :mod:`capybre.limits`
+        profile (ConversionProfile or str, optional): Options to convert
+            with, see :mod:`capybre.profiles`
+        stall_timeout (float, optional): Seconds progress may go without
+            advancing before the conversion is killed
+    Yields:
+        :class:`capybre.progress.Progress` for each progress line
+    Raises:
+        subprocess.CalledProcessError: if ebook-convert exits unsuccessfully
+        capybre.limits.CalibreTimeout: if ebook-convert runs past its timeout
+        capybre.progress.ConversionStalled: if its progress stalls for
+            stall_timeout
+    """
+    output_file = output_filename(input_file, output_file, as_format, as_ext)
+    args = ['ebook-convert', input_file, output_file] + profile_args(profile, input_file, output_file)
+    limits = effective_limits(limits)
+    capture_stderr = limits.memory_bytes is not None
+    async with _semaphore():
+        with observe(args) as invocation:
+            process = await asyncio.create_subprocess_exec(
+                *command(args, limits),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if capture_stderr else None,
+                start_new_session=hasattr(os, 'killpg')
+            )
+            loop = asyncio.get_event_loop()
+            started = advanced = loop.time()
+            deadline = None if limits.timeout is None else started + limits.timeout
+            last = None
+            reading_stderr = asyncio.ensure_future(process.stderr.read()) if capture_stderr else None
+            stderr = None
+            try:
+                while True:
+                    now = loop.time()
+                    waits = [t - now for t in (deadline, stall_timeout and advanced + stall_timeout) if t]
+                    try:
+                        line = await asyncio.wait_for(process.stdout.readline(), min(waits) if waits else None)
+                    except asyncio.TimeoutError:
+                        _kill(process)
+                        await process.wait()
+                        if deadline is not None and loop.time() >= deadline:
+                            raise CalibreTimeout(args, limits.timeout) from None
+                        raise ConversionStalled(args, stall_timeout, last) from None
+                    if not line:
+                        break
+                    parsed = parse_progress(line)
+                    if parsed is None:
+                        continue
+                    now = loop.time()
+                    progress = Progress(parsed[0], parsed[1], now - started)
+                    if last is None or (progress.fraction, progress.stage) != (last.fraction, last.stage):
+                        advanced = now
+                    last = progress
+                    yield progress
+                await process.wait()
+                if reading_stderr is not None:
+                    stderr = await reading_stderr
+            except GeneratorExit:
+                # closed early: the loop may be finalizing us, so don't wait
+                _kill(process)
+                raise
+            except BaseException:
+                _kill(process)
+                await process.wait()
+                raise
+            finally:
+                if reading_stderr is not None and not reading_stderr.done():
+                    reading_stderr.cancel()
+            if stderr:
+                sys.stderr.write(stderr.decode('utf-8', 'replace'))
+            invocation.exit_code = process.returncode
+            exceeded = breached(limits, process.returncode, stderr=stderr)
+            if exceeded:
+                raise ResourceLimitExceeded(exceeded, process.returncode, args, None, stderr)
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, args)
+
+
+async def async_extract_metadata_map(input_file: str):
+    """Coroutine version of :func:`capybre.metadata.extract_metadata_map`
+
+    Args:
+        input_file (str): path to the input file
+    Returns:
+        Dict mapping between metadata keys and values as directly output from
+            the ebook-meta call
+    """
+    output = await _run(['ebook-meta', input_file])
+    return extract_raw_metadata_map(decode_lines(output))
+
+
+async def async_extract_metadata(input_file) -> Metadata:
+    """Coroutine version of :func:`capybre.metadata.extract_metadata`
+
+    Args:
+        input_file (str): path to the input file
+    Returns:
+        :class:`Metadata` object
+    """
+    metadata = clean_metadata_map(await async_extract_metadata_map(input_file))
+    metadata.ebook_format = EbookFormat.from_filename(input_file)
+    return metadata
+
+
+async def async_extract_cover(
+    input_file: str,
+    output_file: str = 'cover.jpg',
+    suppress_output=True
+):
+    """Coroutine version of :func:`capybre.metadata.extract_cover`
+
+    Args:
+        input_file (str): path to the input file
+        output_file (str, optional): path to the output cover image file,
+            defaults to 'cover.jpg'
+        suppress_output (bool, optional): Suppresses stdout from ebook-meta
+            call. Defaults to ``True``
+    """
+    await _run(
+        ['ebook-meta', input_file, '--get-cover', output_file],
+        stdout=_stdout(suppress_output)
+    )
+
+
+async def async_fetch_metadata_map(title=None, author=None, isbn=None):
+    """Coroutine version of :func:`capybre.fetch_metadata.fetch_metadata_map`
+
+    Args:
+        title (str, optional): Title of the book
+        author (str, optional): Author of the book
+        isbn (str, optional): Book's ISBN code
+    Returns:
+        Dict mapping between metadata keys and values as directly output from
+            the fetch-ebook-metadata call
+    """
+    args = fetch_metadata_args(title, author, isbn)
+    try:
+        output = await _run(args, capture_stderr=True)
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 1 and NO_RESULTS in (e.stderr or b'') + (e.output or b''):
+            raise MetadataNotFound(e.returncode, e.cmd, e.output, e.stderr) from None
+        raise
+    return extract_raw_metadata_map(decode_lines(output))
+
+
+async def async_fetch_metadata(title=None, author=None, isbn=None) -> Metadata:
+    """Coroutine version of :func:`capybre.fetch_metadata.fetch_metadata`
+
+    Args:
+        title (str, optional): Title of the book
+        author (str, optional): Author of the book
+        isbn (str, optional): Book's ISBN code
+    Returns:
+        :class:`Metadata` object
+    """
+    return clean_metadata_map(
+        await async_fetch_metadata_map(title, author, isbn)
+    )
@@ -0,0 +1,349 @@
+"""
+The ``capybre`` command. For use like ::
+
+    capybre convert books.jsonl --as-ext mobi --jobs 8
+    capybre meta books.jsonl --output metadata.jsonl
+    capybre cover books.jsonl --resume
+    capybre fetch lookups.jsonl --jobs 4
+    capybre sync /mnt/library /mnt/kindle --as-ext mobi --dry-run
+    capybre worker --port 8765 --slots 4 --timeout 600
+
+The batch subcommands read a JSON Lines manifest, one item per line: the
+path of an ebook, or an object of keyword arguments to the function the
+subcommand runs (:func:`capybre.convert.convert`,
+:func:`capybre.metadata.extract_metadata`,
+:func:`capybre.metadata.extract_cover` or
+:func:`capybre.fetch_metadata.fetch_metadata`). For example ::
+
+    "PrideAndPrejudice.epub"
+    {"input_file": "Emma.epub", "output_file": "out/Emma.azw3", "profile": "fast"}
+
+Items run in parallel, and each finished item is appended to a results
+file (by default the manifest's path with ``.results.jsonl``) as an object
+of the ``item``, whether it was ``ok``, the ``seconds`` it took, and its
+``result`` or ``error``. With ``--resume``, items the results file already
+records as ok are skipped, so an interrupted run can be picked up again.
+While running, throughput and an estimated time left are shown on stderr.
+The command exits 1 if any item failed.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+TOKEN_ENV = 'CAPYBRE_WORKER_TOKEN'
+
+# seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+
+def _limits(args):
+    from .limits import ResourceLimits
+
+    if args.timeout or args.cpu_seconds or args.memory_bytes:
+        return ResourceLimits(
+            timeout=args.timeout, cpu_seconds=args.cpu_seconds, memory_bytes=args.memory_bytes
+        )
+    return None
+
+
+def _item_kwargs(item, key):
+    if isinstance(item, str):
+        return {key: item}
+    if not isinstance(item, dict):
+        raise Exception('Manifest items must be paths or objects, not {!r}'.format(item))
+    return dict(item)
+
+
+def _convert(args):
+    from .convert import convert, job_kwargs
+    from .ebook_format import EbookFormat
+
+    limits = _limits(args)
+    defaults = {'as_ext': args.as_ext, 'profile': args.profile}
+
+    def run(item):
+        kwargs = job_kwargs(defaults, _item_kwargs(item, 'input_file'))
+        if 'as_format' in kwargs:
+            kwargs['as_format'] = EbookFormat[kwargs['as_format'].upper()]
+        return {'output_file': convert(limits=limits, **kwargs)}
+
+    return run
+
+
+def _meta(args):
+    from .metadata import extract_metadata
+
+    limits = _limits(args)
+
+    def run(item):
+        metadata = extract_metadata(limits=limits, **_item_kwargs(item, 'input_file'))
+        return {'metadata': metadata.to_dict()}
+
+    return run
+
+
+def _cover(args):
+    from .metadata import extract_metadata_and_cover
+
+    limits = _limits(args)
+
+    def run(item):
+        kwargs = _item_kwargs(item, 'input_file')
+        input_file = kwargs['input_file']
+        output_file = kwargs.pop('output_file', None) or os.path.splitext(input_file)[0] + '.jpg'
+        _, cover = extract_metadata_and_cover(limits=limits, **kwargs)
+        if cover is None:
+            raise Exception('{} has no cover'.format(input_file))
+        with open(output_file, 'wb') as f:
+            f.write(cover)
+        return {'output_file': output_file}
+
+    return run
+
+
+def _fetch(args):
+    from .fetch_metadata import fetch_metadata
+
+    def run(item):
+        metadata = fetch_metadata(sources=args.sources, **_item_kwargs(item, 'isbn'))
+        return {'metadata': metadata.to_dict()}
+
+    return run
+
+
+def _key(item):
+    return json.dumps(item, sort_keys=True)
+
+
+def read_manifest(path):
+    """The items of a JSON Lines manifest, skipping blank lines
+
+    Raises:
+        Exception: naming the line, if one isn't valid JSON
+    """
+    items = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                raise Exception('{} line {}: {}'.format(path, number, e))
+    return items
+
+
+def _succeeded(path):
+    """Keys of the items the results file at path records as ok"""
+    done = set()
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record['ok']:
+                        done.add(_key(record['item']))
+                except (ValueError, KeyError):
+                    # a run killed mid-write can leave a partial last line
+                    pass
+    return done
+
+
+class _Progress:
+    """Throughput and ETA of a batch, redrawn in place on a terminal"""
+
+    def __init__(self, total, stream):
+        self.total = total
+        self.stream = stream
+        self.done = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.drawn = None
+        self.tty = stream.isatty()
+
+    def update(self, ok):
+        self.done += 1
+        if not ok:
+            self.failed += 1
+        now = time.monotonic()
+        if self.tty and (self.drawn is None or now - self.drawn >= PROGRESS_INTERVAL):
+            self.drawn = now
+            self.stream.write('\r\033[K' + self.line(now))
+            self.stream.flush()
+
+    def line(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = '{}/{} done, {} failed, {:.2f} items/s'.format(self.done, self.total, self.failed, rate)
+        if self.done < self.total and rate > 0:
+            line += ', ETA {}'.format(_duration((self.total - self.done) / rate))
+        return line
+
+    def finish(self):
+        now = time.monotonic()
+        self.stream.write(('\r\033[K' if self.tty else '') + self.line(now))
+        self.stream.write(' in {}\n'.format(_duration(now - self.start)))
+        self.stream.flush()
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+    return '{}:{:02}'.format(minutes, seconds)
+
+
+def _batch(args):
+    from .helpers import bounded_map
+
+    items = read_manifest(args.manifest)
+    output = args.output or os.path.splitext(args.manifest)[0] + '.results.jsonl'
+    if args.resume:
+        done = _succeeded(output)
+        skipped = len(items)
+        items = [item for item in items if _key(item) not in done]
+        skipped -= len(items)
+        if skipped:
+            print('Skipping {} items already done'.format(skipped), file=sys.stderr)
+    run = args.runner(args)
+
+    def timed(item):
+        start = time.perf_counter()
+        record = {'item': item}
+        try:
+            record['result'] = run(item)
+            record['ok'] = True
+        except Exception as e:
+            record['ok'] = False
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        return record
+
+    progress = _Progress(len(items), sys.stderr)
+    with open(output, 'a' if args.resume else 'w') as log:
+        for _, record, _ in bounded_map(timed, items, args.jobs):
+            log.write(json.dumps(record) + '\n')
+            log.flush()
+            progress.update(record['ok'])
+    progress.finish()
+    return 1 if progress.failed else 0
+
+
+def _sync(args):
+    from .mirror import sync_converted
+
+    report = sync_converted(
+        args.src_dir,
+        args.dst_dir,
+        as_ext=args.as_ext,
+        profile=args.profile,
+        source_formats=args.source_formats,
+        max_workers=args.jobs,
+        dry_run=args.dry_run,
+        delete=not args.keep_orphans,
+        limits=_limits(args)
+    )
+    plan = report.plan
+    if args.dry_run:
+        for source, output, reason in plan.convert:
+            print('convert {} -> {} ({})'.format(source, output, reason))
+        for output in plan.delete:
+            print('delete {}{}'.format(output, ' (kept)' if args.keep_orphans else ''))
+    for source in plan.conflicts:
+        print('skipped {}: another source mirrors to the same output'.format(source), file=sys.stderr)
+    for output, error in sorted(report.failed.items()):
+        print('failed {}: {}: {}'.format(output, type(error).__name__, error), file=sys.stderr)
+    print('{} to convert, {} to delete, {} up to date'.format(
+        len(plan.convert), len(plan.delete), plan.unchanged
+    ), file=sys.stderr)
+    return 0 if report.ok else 1
+
+
+def _worker(args):
+    from .remote import WorkerServer
+
+    server = WorkerServer(
+        args.host, args.port, args.slots, args.token or os.environ.get(TOKEN_ENV), _limits(args)
+    )
+    print('capybre worker listening on {}'.format(server.url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _add_limit_args(parser):
+    parser.add_argument('--timeout', type=float, help='Seconds each Calibre call may run for')
+    parser.add_argument('--cpu-seconds', type=int, help='CPU seconds each Calibre call may use')
+    parser.add_argument('--memory-bytes', type=int, help='Bytes of memory each Calibre call may map')
+
+
+def _add_batch(commands, name, help, runner, jobs=None):
+    batch = commands.add_parser(name, help=help)
+    batch.add_argument('manifest', help='JSON Lines file of items to run')
+    batch.add_argument('-o', '--output', help='JSON Lines file to record results in '
+                       '(default: the manifest with .results.jsonl)')
+    batch.add_argument('-j', '--jobs', type=int, default=jobs,
+                       help='Items to run at once (default: {})'.format(jobs or 'one per core'))
+    batch.add_argument('--resume', action='store_true',
+                       help='Skip items the results file records as ok, and append to it')
+    batch.set_defaults(run=_batch, runner=runner)
+    return batch
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='capybre', description="Runs Calibre's command line tools at scale")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    convert = _add_batch(commands, 'convert', 'Convert the ebooks of a manifest', _convert)
+    convert.add_argument('--as-ext', help='Format to convert to, for items without an output_file')
+    convert.add_argument('--profile', help='Preset to convert with: fast, balanced or quality')
+    _add_limit_args(convert)
+
+    meta = _add_batch(commands, 'meta', 'Extract the metadata of the ebooks of a manifest', _meta)
+    _add_limit_args(meta)
+
+    cover = _add_batch(commands, 'cover', 'Extract the covers of the ebooks of a manifest', _cover)
+    _add_limit_args(cover)
+
+    fetch = _add_batch(commands, 'fetch', 'Look up the books of a manifest online', _fetch, jobs=4)
+    fetch.add_argument('--sources', nargs='+', help='Metadata sources to query, e.g. Google')
+
+    sync = commands.add_parser('sync', help='Bring a converted mirror of a library up to date')
+    sync.add_argument('src_dir', help='Directory of the library')
+    sync.add_argument('dst_dir', help='Directory of the mirror')
+    sync.add_argument('--as-ext', required=True, help="The mirror's format, e.g. mobi")
+    sync.add_argument('--profile', help='Preset to convert with: fast, balanced or quality')
+    sync.add_argument('--source-formats', nargs='+', help='Formats to mirror, in order of preference')
+    sync.add_argument('-j', '--jobs', type=int, help='Conversions to run at once (default: one per core)')
+    sync.add_argument('-n', '--dry-run', action='store_true', help='Print the plan without changing anything')
+    sync.add_argument('--keep-orphans', action='store_true', help='Keep outputs whose source is gone')
+    _add_limit_args(sync)
+    sync.set_defaults(run=_sync)
+
+    worker = commands.add_parser('worker', help='Run conversions for remote clients')
+    worker.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: %(default)s)')
+    worker.add_argument('--port', type=int, default=8765, help='Port to listen on, 0 for any (default: %(default)s)')
+    worker.add_argument('--slots', type=int, help='Conversions to run at once (default: one per core)')
+    worker.add_argument('--token', help='Token clients must present (default: ${})'.format(TOKEN_ENV))
+    _add_limit_args(worker)
+    worker.set_defaults(run=_worker)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = parser().parse_args(argv)
+    try:
+        return args.run(args)
+    except Exception as e:
+        print('capybre: {}'.format(e), file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""
+An opt-in, content-addressed on-disk cache of converted ebooks, so that
+converting the same input to the same format twice only runs
+``ebook-convert`` once. For use like ::
+
+    cache = ConversionCache('/var/cache/capybre', max_bytes=10 * 2**30)
+    convert('PrideAndPrejudice.epub', as_ext='mobi', cache=cache)
+
+Entries are keyed by a hash of the input file's contents, the output format
+and any conversion options. The cache is kept under a byte budget by
+evicting the least recently used entries, writes are atomic, and concurrent
+requests for the same entry (from threads or, where ``fcntl`` is available,
+other processes) wait for a single conversion instead of repeating it.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+from .helpers import call, file_digest, SingleFlight
+
+
+class ConversionCache:
+    """Size-bounded LRU cache of converted files
+
+    Args:
+        directory (str): Directory holding the cache, created if needed. It
+            may be shared between processes
+        max_bytes (int, optional): Total size the cached files are kept
+            under. Defaults to 1 GiB
+        link (bool, optional): Serve hits by hardlinking the cached file to
+            the output path rather than copying it. Much cheaper, but the
+            output must then not be modified in place. Falls back to a copy
+            across filesystems. Defaults to ``False``
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30, link=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._single_flight = SingleFlight()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'locks'), exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def key(self, input_file, ext, options=()) -> str:
+        """Cache key for converting input_file to ext with options"""
+        digest = hashlib.sha256()
+        digest.update(file_digest(input_file).encode('ascii'))
+        digest.update(json.dumps([ext.lower(), list(options)]).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key, ext) -> str:
+        return os.path.join(self.directory, key[:2], '{}.{}'.format(key, ext.lower()))
+
+    def convert(self, input_file, output_file, options=(), suppress_output=True, limits=None, progress=None):
+        """Converts input_file to output_file, going through the cache
+
+        The output format is taken from output_file's extension, as with
+        ``ebook-convert`` itself.
+
+        Args:
+            input_file (str): path to the input file
+            output_file (str): path to the output file
+            options (List[str], optional): Extra ``ebook-convert`` arguments,
+                which are part of the cache key
+            suppress_output (bool, optional): Suppresses stdout from
+                ebook-convert. Defaults to ``True``
+            limits (ResourceLimits, optional): Limits for the ebook-convert
+                call on a miss, see :mod:`capybre.limits`
+            progress (ProgressWatcher, optional): Watches the ebook-convert
+                call on a miss, see :mod:`capybre.progress`
+        Returns:
+            Path to the output file
+        """
+        ext = os.path.splitext(output_file)[1][1:]
+        key = self.key(input_file, ext, options)
+        cached = self.path(key, ext)
+        filled = False
+        while True:
+            # a shared lock keeps the entry from being evicted while it's copied
+            with self._file_lock(key, shared=True):
+                if self._touch(cached):
+                    if not filled:
+                        with self._lock:
+                            self.hits += 1
+                    self._materialize(cached, output_file)
+                    return output_file
+            # a miss, or evicted again between the fill and taking the lock
+            filled = self._single_flight.do(
+                key,
+                lambda: self._fill(key, cached, input_file, options, suppress_output, limits, progress)
+            )
+
+    def _fill(self, key, cached, input_file, options, suppress_output, limits=None, progress=None):
+        """Converts into the entry unless it's there already, returning
+        whether it converted"""
+        with self._file_lock(key) as lock:
+            # another process may have filled the entry while we waited
+            if self._touch(cached):
+                return False
+            with self._lock:
+                self.misses += 1
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            ext = os.path.splitext(cached)[1]
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix=ext, dir=os.path.dirname(cached))
+            os.close(fd)
+            try:
+                call(
+                    ['ebook-convert', input_file, tmp] + list(options),
+                    suppress_output,
+                    check=True,
+                    limits=limits,
+                    progress=progress
+                )
+                os.replace(tmp, cached)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                lock.remove()
+                raise
+        with self._lock:
+            self._size += os.path.getsize(cached)
+            over_budget = self._size > self.max_bytes
+        if over_budget:
+            self.evict(keep=cached)
+        return True
+
+    def _materialize(self, cached, output_file):
+        if os.path.abspath(cached) == os.path.abspath(output_file):
+            return
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        if self.link:
+            try:
+                os.link(cached, output_file)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(cached, output_file)
+
+    def _touch(self, cached):
+        try:
+            os.utime(cached)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _file_lock(self, key, shared=False, blocking=True):
+        return _FileLock(self._lock_path(key), shared, blocking)
+
+    def _lock_path(self, key):
+        return os.path.join(self.directory, 'locks', key + '.lock')
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if d != 'locks']
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until under the byte budget
+
+        Args:
+            keep (str, optional): path of an entry never to evict
+        """
+        entries = []
+        for path, stat in self._entries():
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            # entries being filled or served are skipped rather than waited for
+            if path == keep or not self._remove(path, blocking=False):
+                continue
+            size -= entry_size
+        with self._lock:
+            self._size = size
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        for path, _ in list(self._entries()):
+            self._remove(path)
+        with self._lock:
+            self._size = 0
+
+    def _remove(self, path, blocking=True):
+        """Removes an entry and its lock file, under the lock, returning
+        whether it did"""
+        key = os.path.splitext(os.path.basename(path))[0]
+        with self._file_lock(key, blocking=blocking) as lock:
+            if not lock.acquired:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            lock.remove()
+        return True
+
+
+class _FileLock:
+    """Advisory lock on a file, a no-op without ``fcntl``
+
+    Args:
+        path (str): The lock file, created if needed
+        shared (bool, optional): Take a shared lock rather than an exclusive
+            one. Defaults to ``False``
+        blocking (bool, optional): Wait for the lock. If ``False``,
+            ``acquired`` says whether it was taken. Defaults to ``True``
+    """
+
+    def __init__(self, path, shared=False, blocking=True):
+        self.path = path
+        self.shared = shared
+        self.blocking = blocking
+        self.acquired = fcntl is None
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            operation |= fcntl.LOCK_NB
+        while True:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, operation)
+            except BlockingIOError:
+                os.close(fd)
+                return self
+            # the holder we waited for may have removed the file, leaving us
+            # locking an orphan while others lock its replacement
+            try:
+                current = os.path.samestat(os.fstat(fd), os.stat(self.path))
+            except FileNotFoundError:
+                current = False
+            if current:
+                self.fd = fd
+                self.acquired = True
+                return self
+            os.close(fd)
+
+    def remove(self):
+        """Deletes the lock file, which must be held exclusively"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __exit__(self, type, value, traceback):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -6,10 +6,16 @@ or the desired extenion.
 
 ..ebook-convert: https://manual.calibre-ebook.com/generated/en/ebook-convert.html
 """
+import io
 import os
+import shutil
+import sys
+from typing import Dict
 
 from .ebook_format import EbookFormat
-from .helpers import call
+from .helpers import call, bounded_map, scratch_directory, write_source
+from .profiles import profile_args
+from .progress import ProgressWatcher
 
 
 def convert(
@@ -17,7 +23,12 @@ def convert(
     output_file=None,
     as_format=EbookFormat.UNKNOWN,
     as_ext=None,
-    suppress_output=True
+    suppress_output=True,
+    cache=None,
+    limits=None,
+    profile=None,
+    on_progress=None,
+    stall_timeout=None
 ) -> str:
     """Converts ebook at input_file to new format, returning the converted filepath
 
@@ -35,24 +46,342 @@ def convert(
             e.g. ``mobi``
         suppress_output (bool, optional): Suppresses stdout from ebook-convert
             call (typically dozens of lines). Defaults to ``True``
+        cache (ConversionCache, optional): Cache to serve the conversion
+            from, see :class:`capybre.conversion_cache.ConversionCache`
+        limits (ResourceLimits, optional): Timeout and resource limits for
+            the ebook-convert call, overriding the global ones, see
+            :mod:`capybre.limits`
+        profile (ConversionProfile or str, optional): Options to convert
+            with, or the name of a preset (``'fast'``, ``'balanced'`` or
+            ``'quality'``), see :mod:`capybre.profiles`
+        on_progress (Callable[[Progress], None], optional): Called with each
+            progress line ebook-convert prints, see :mod:`capybre.progress`.
+            Not called when the conversion is served from the cache
+        stall_timeout (float, optional): Seconds the conversion's progress
+            may go without advancing before it's killed
     Returns:
         Path to the output file
+    Raises:
+        subprocess.CalledProcessError: if ebook-convert exits unsuccessfully
+        capybre.limits.CalibreTimeout: if ebook-convert runs past its timeout
+        capybre.limits.ResourceLimitExceeded: if ebook-convert is stopped by
+            a resource limit
+        capybre.progress.ConversionStalled: if ebook-convert's progress
+            stalls for stall_timeout
     """
 
-    if output_file is None:
-        if as_ext:
-            as_format = EbookFormat.from_ext(as_ext)
-        if as_format == EbookFormat.UNKNOWN:
-            raise Exception('Please specifiy a real extension')
-        output_file = (input_file[:input_file.rfind('.')] +
-                       '.' +
-                       as_format.to_ext())
+    output_file = output_filename(input_file, output_file, as_format, as_ext)
+    options = profile_args(profile, input_file, output_file)
+    progress = None
+    if on_progress is not None or stall_timeout is not None:
+        progress = ProgressWatcher(on_progress, stall_timeout)
+    return _convert(input_file, output_file, options, suppress_output, cache, limits, progress)
 
-    call(['ebook-convert', input_file, output_file], suppress_output)
+
+def _convert(input_file, output_file, options, suppress_output, cache, limits, progress=None):
+    if cache is not None:
+        return cache.convert(input_file, output_file, options, suppress_output, limits, progress)
+    call(
+        ['ebook-convert', input_file, output_file] + options,
+        suppress_output,
+        check=True,
+        limits=limits,
+        progress=progress
+    )
 
     return output_file
 
 
+def convert_bytes(
+    source,
+    input_ext,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None,
+    suppress_output=True,
+    cache=None,
+    limits=None,
+    profile=None,
+    on_progress=None,
+    stall_timeout=None
+) -> bytes:
+    """Converts an in-memory ebook, returning the converted ebook's bytes
+
+    ``ebook-convert`` only works on files, so the input and output pass
+    through a private scratch directory on a RAM-backed filesystem
+    (``/dev/shm``) where one is available, removed before returning.
+
+    Args:
+        source (bytes or file): the input ebook, as bytes or a binary file
+            object
+        input_ext (str): extension of the input format, e.g. ``epub``
+        as_format (EbookFormat, optional): Enum representation of desired
+            output format
+        as_ext (str, optional): String representation of desired output format,
+            e.g. ``mobi``
+        suppress_output (bool, optional): Suppresses stdout from ebook-convert
+            call (typically dozens of lines). Defaults to ``True``
+        cache (ConversionCache, optional): Cache to serve the conversion
+            from, see :class:`capybre.conversion_cache.ConversionCache`
+        limits (ResourceLimits, optional): Timeout and resource limits for
+            the ebook-convert call, overriding the global ones, see
+            :mod:`capybre.limits`
+        profile (ConversionProfile or str, optional): Options to convert
+            with, or the name of a preset (``'fast'``, ``'balanced'`` or
+            ``'quality'``), see :mod:`capybre.profiles`
+        on_progress (Callable[[Progress], None], optional): Called with each
+            progress line ebook-convert prints, see :mod:`capybre.progress`
+        stall_timeout (float, optional): Seconds the conversion's progress
+            may go without advancing before it's killed
+    Returns:
+        The converted ebook's bytes
+    """
+    with scratch_directory() as directory:
+        input_file = os.path.join(directory, 'input.' + input_ext)
+        write_source(source, input_file)
+        output_file = output_filename(
+            os.path.join(directory, 'output.' + input_ext),
+            None,
+            as_format,
+            as_ext
+        )
+        convert(
+            input_file,
+            output_file,
+            suppress_output=suppress_output,
+            cache=cache,
+            limits=limits,
+            profile=profile,
+            on_progress=on_progress,
+            stall_timeout=stall_timeout
+        )
+        with open(output_file, 'rb') as f:
+            return f.read()
+
+
+def convert_to_buffer(source, input_ext, **kwargs) -> io.BytesIO:
+    """Like :func:`convert_bytes`, but returns a seekable in-memory buffer
+
+    Accepts the same arguments as :func:`convert_bytes`.
+    """
+    return io.BytesIO(convert_bytes(source, input_ext, **kwargs))
+
+
+def output_filename(
+    input_file,
+    output_file=None,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None
+) -> str:
+    """Resolves the output path :func:`convert` would write to
+
+    If output_file is given it is returned unchanged; otherwise the path is
+    that of input_file with the extension of the requested format.
+    """
+    if output_file is not None:
+        return output_file
+    if as_ext:
+        as_format = EbookFormat.from_ext(as_ext)
+    if as_format == EbookFormat.UNKNOWN:
+        raise Exception('Please specifiy a real extension')
+    return (input_file[:input_file.rfind('.')] +
+            '.' +
+            as_format.to_ext())
+
+
+class ConversionResult:
+    """Outcome of a single job run by :func:`convert_many`
+
+    Args:
+        job (str or dict): The job as it was passed to :func:`convert_many`
+        output_file (str): Path to the converted file, if successful
+        error (Exception): The exception raised by the conversion, if any
+    """
+
+    def __init__(self, job, output_file=None, error=None):
+        self.job = job
+        self.output_file = output_file
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def convert_many(
+    jobs,
+    max_workers=None,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None,
+    suppress_output=True,
+    cache=None,
+    limits=None,
+    profile=None
+):
+    """Converts many ebooks in parallel, yielding results as each finishes
+
+    Each job is either the path of an input file, converted according to
+    the as_format/as_ext defaults given here, or a dict of keyword arguments
+    to :func:`convert` (which must include ``input_file``, and overrides the
+    defaults). A failing job does not stop the others; its exception is
+    reported on the yielded result instead. For use like ::
+
+        for result in convert_many(paths, as_ext='mobi'):
+            if not result.ok:
+                log(result.job, result.error)
+
+    Args:
+        jobs (Iterable[str or dict]): Conversions to run. Consumed lazily,
+            so it may be a generator over a very large backlog
+        max_workers (int, optional): Number of conversions to run at once.
+            Defaults to the number of available cores
+        as_format (EbookFormat, optional): Default output format
+        as_ext (str, optional): Default output extension
+        suppress_output (bool, optional): Suppresses stdout from ebook-convert
+            calls. Defaults to ``True``
+        cache (ConversionCache, optional): Default cache to serve
+            conversions from
+        limits (ResourceLimits, optional): Default limits for each
+            conversion. A conversion stopped by one fails with
+            :class:`capybre.limits.CalibreTimeout` or
+            :class:`capybre.limits.ResourceLimitExceeded` on its result
+        profile (ConversionProfile or str, optional): Default profile or
+            preset name to convert with, see :mod:`capybre.profiles`
+    Yields:
+        :class:`ConversionResult` for each job, in order of completion
+    """
+    defaults = {
+        'as_format': as_format,
+        'as_ext': as_ext,
+        'suppress_output': suppress_output,
+        'cache': cache,
+        'limits': limits,
+        'profile': profile,
+    }
+
+    def run(job):
+        if isinstance(job, dict):
+            return convert(**job_kwargs(defaults, job))
+        return convert(job, **defaults)
+
+    for job, output_file, error in bounded_map(run, jobs, max_workers):
+        yield ConversionResult(job, output_file, error)
+
+
+def job_kwargs(defaults, job):
+    """The keyword arguments of a :func:`convert_many` job: the defaults,
+    overridden by the job's own. A job naming its own output format, by
+    either ``as_format`` or ``as_ext``, takes neither default format, as
+    ``as_ext`` would win over the job's ``as_format``"""
+    if 'as_format' in job or 'as_ext' in job:
+        defaults = {key: value for key, value in defaults.items() if key not in ('as_format', 'as_ext')}
+    return dict(defaults, **job)
+
+
+# Calibre reads HTMLZ back quickly: a single normalized HTML file with its
+# stylesheet, images and OPF metadata
+INTERMEDIATE_FORMAT = EbookFormat.HTMLZ
+
+
+def convert_to_many(
+    input_file,
+    formats,
+    output_dir=None,
+    max_workers=None,
+    suppress_output=True,
+    cache=None,
+    limits=None,
+    profile=None,
+    intermediate=INTERMEDIATE_FORMAT
+) -> Dict[EbookFormat, str]:
+    """Converts one ebook to several formats, parsing the input only once
+
+    The input is first converted to an intermediate format in a scratch
+    directory, which does the expensive parsing, heuristics and
+    normalization of the input a single time. Each requested format is then
+    converted from the intermediate, in parallel. For use like ::
+
+        outputs = convert_to_many(
+            'PrideAndPrejudice.epub',
+            [EbookFormat.MOBI, EbookFormat.AZW3, EbookFormat.PDF, EbookFormat.TXT]
+        )
+        upload(outputs[EbookFormat.PDF])
+
+    The common and input options of the profile apply to the conversion to
+    the intermediate, and the output options to each conversion from it.
+    HTMLZ flattens the book into a single HTML file; pass
+    ``intermediate=EbookFormat.EPUB`` where its structure must survive
+    exactly. With a single format, or an input already in the intermediate
+    format, the input is converted directly.
+
+    Args:
+        input_file (str): path to the input file
+        formats (Iterable[EbookFormat]): Formats to convert to
+        output_dir (str, optional): Directory to write the outputs to, each
+            named as input_file with the extension of its format. Defaults
+            to the directory of input_file
+        max_workers (int, optional): Number of conversions from the
+            intermediate to run at once. Defaults to one per format
+        suppress_output (bool, optional): Suppresses stdout from ebook-convert
+            calls. Defaults to ``True``
+        cache (ConversionCache, optional): Cache to serve each conversion
+            from, see :class:`capybre.conversion_cache.ConversionCache`
+        limits (ResourceLimits, optional): Timeout and resource limits for
+            each ebook-convert call, see :mod:`capybre.limits`
+        profile (ConversionProfile or str, optional): Options to convert
+            with, or the name of a preset, see :mod:`capybre.profiles`
+        intermediate (EbookFormat, optional): Format the input is parsed
+            into. Defaults to ``EbookFormat.HTMLZ``
+    Returns:
+        Dict of each requested format to the path of its output file
+    Raises:
+        subprocess.CalledProcessError: if an ebook-convert call exits
+            unsuccessfully. The conversions to the other formats still run
+            to completion, and their outputs are left in place
+    """
+    formats = list(dict.fromkeys(EbookFormat(f) for f in formats))
+    if EbookFormat.UNKNOWN in formats:
+        raise Exception('Please specifiy a real extension')
+    if output_dir is None:
+        output_dir = os.path.dirname(input_file)
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    outputs = {
+        fmt: os.path.join(output_dir, name + '.' + fmt.to_ext())
+        for fmt in formats
+    }
+
+    def fan_out(source, common):
+        def run(fmt):
+            if source != input_file and fmt == intermediate:
+                shutil.copyfile(source, outputs[fmt])
+                return outputs[fmt]
+            options = profile_args(profile, source, outputs[fmt], common)
+            return _convert(source, outputs[fmt], options, suppress_output, cache, limits)
+
+        errors = {
+            fmt: error
+            for fmt, _, error in bounded_map(run, formats, max_workers or len(formats))
+            if error is not None
+        }
+        for fmt in formats:
+            if fmt in errors:
+                raise errors[fmt]
+        return outputs
+
+    if len(formats) < 2 or EbookFormat.from_filename(input_file) == intermediate:
+        return fan_out(input_file, True)
+    with scratch_directory() as directory:
+        intermediate_file = os.path.join(directory, name + '.' + intermediate.to_ext())
+        _convert(
+            input_file,
+            intermediate_file,
+            profile_args(profile, input_file, intermediate_file),
+            suppress_output,
+            cache,
+            limits
+        )
+        return fan_out(intermediate_file, False)
+
+
 class converted_fileobj:
     """Context-object wrapper around convert
 
@@ -73,6 +402,14 @@ class converted_fileobj:
             e.g. ``mobi``
         suppress_output (bool, optional): Suppresses stdout from ebook-convert
             call (typically dozens of lines). Defaults to ``True``
+        cache (ConversionCache, optional): Cache to serve the conversion
+            from, see :class:`capybre.conversion_cache.ConversionCache`
+        limits (ResourceLimits, optional): Timeout and resource limits for
+            the ebook-convert call, overriding the global ones, see
+            :mod:`capybre.limits`
+        profile (ConversionProfile or str, optional): Options to convert
+            with, or the name of a preset (``'fast'``, ``'balanced'`` or
+            ``'quality'``), see :mod:`capybre.profiles`
 
     """
 
@@ -81,7 +418,10 @@ class converted_fileobj:
         input_file,
         as_format=None,
         as_ext=None,
-        suppress_output=True
+        suppress_output=True,
+        cache=None,
+        limits=None,
+        profile=None
     ):
         self.input_file: str = input_file
         if as_format:
@@ -89,20 +429,33 @@ class converted_fileobj:
         else:
             self.as_format = EbookFormat.from_ext(as_ext)
         self.suppress_output = suppress_output
+        self.cache = cache
+        self.limits = limits
+        self.profile = profile
         self.fp = None
-        self.output_file = None
+        self.scratch = scratch_directory()
 
     def __enter__(self):
-        self.output_file = convert(
-            self.input_file,
-            as_format=self.as_format,
-            suppress_output=self.suppress_output
-        )
-        self.fp = open(self.output_file, 'rb')
+        directory = self.scratch.__enter__()
+        try:
+            output_file = convert(
+                self.input_file,
+                output_filename(
+                    os.path.join(directory, os.path.basename(self.input_file)),
+                    as_format=self.as_format
+                ),
+                suppress_output=self.suppress_output,
+                cache=self.cache,
+                limits=self.limits,
+                profile=self.profile
+            )
+            self.fp = open(output_file, 'rb')
+        except BaseException:
+            self.scratch.__exit__(*sys.exc_info())
+            raise
         return self.fp
 
     def __exit__(self, type, value, traceback):
         if self.fp:
             self.fp.close()
-        if self.output_file:
-            os.remove(self.output_file)
+        self.scratch.__exit__(type, value, traceback)
@@ -5,7 +5,7 @@ import os
 class EbookFormat(IntEnum):
     """
     EbookFormat is an enum representation of the supported output ebook
-    formats: EPUB, LIT, LRF, FB2, MOBI, PDB, PDF, PMLZ, RB, TCR, TXT
+    formats: EPUB, LIT, LRF, FB2, MOBI, PDB, PDF, PMLZ, RB, TCR, TXT, AZW3, HTMLZ
     """
     UNKNOWN = 0
     EPUB = 1
@@ -19,6 +19,8 @@ class EbookFormat(IntEnum):
     RB = 9
     TCR = 10
     TXT = 11
+    AZW3 = 12
+    HTMLZ = 13
 
     def to_ext(self) -> str:
         """Gets the extension for the given EbookFormat Enum value"""
@@ -51,7 +53,9 @@ EBOOK_FORMAT_MAP = {
     EbookFormat.PMLZ: 'pmlz',
     EbookFormat.RB:   'rb',
     EbookFormat.TCR:  'tcr',
-    EbookFormat.TXT:  'txt'
+    EbookFormat.TXT:  'txt',
+    EbookFormat.AZW3: 'azw3',
+    EbookFormat.HTMLZ: 'htmlz'
 }
 
 EBOOK_FORMAT_INVERSE_MAP = {
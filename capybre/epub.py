@@ -0,0 +1,504 @@
+"""
+Reads metadata and covers straight out of EPUB files, without spawning
+``ebook-meta``. An EPUB is a zip archive whose metadata lives in an OPF
+package document, located through ``META-INF/container.xml``; this module
+parses that document into the same raw metadata map ``ebook-meta`` prints,
+so :func:`capybre.metadata.clean_metadata_map` treats both identically.
+
+Anything this reader isn't sure it can reproduce faithfully (unreadable
+archives, unfamiliar language codes, covers only referenced from an HTML
+page, ...) is reported by returning ``None``, and callers fall back to
+``ebook-meta``.
+
+:func:`replace_member` writes a copy of an EPUB with one member replaced,
+for :mod:`capybre.write_metadata` to swap in a new OPF.
+"""
+import posixpath
+import re
+import struct
+import time
+import zipfile
+import zlib
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+from .metadata import (
+    TITLE, AUTHOR, PUBLISHER, TAGS, LANGUAGE, IDENTIFIERS,
+    DESCRIPTION, SERIES, RATING, PUBLISHED, LAST_EDITED
+)
+
+CONTAINER = 'META-INF/container.xml'
+RIGHTS = 'Rights'
+
+DATE_ONLY_RE = re.compile('^\\d{4}(-\\d{2}(-\\d{2})?)?$')
+
+# Calibre reports languages as ISO 639-3 codes
+LANGUAGE_CODES = {
+    'ar': 'ara', 'bg': 'bul', 'ca': 'cat', 'cs': 'ces', 'cy': 'cym',
+    'da': 'dan', 'de': 'deu', 'el': 'ell', 'en': 'eng', 'eo': 'epo',
+    'es': 'spa', 'et': 'est', 'eu': 'eus', 'fa': 'fas', 'fi': 'fin',
+    'fr': 'fra', 'ga': 'gle', 'gl': 'glg', 'he': 'heb', 'hi': 'hin',
+    'hr': 'hrv', 'hu': 'hun', 'id': 'ind', 'is': 'isl', 'it': 'ita',
+    'ja': 'jpn', 'ko': 'kor', 'la': 'lat', 'lt': 'lit', 'lv': 'lav',
+    'nb': 'nob', 'nl': 'nld', 'nn': 'nno', 'no': 'nor', 'pl': 'pol',
+    'pt': 'por', 'ro': 'ron', 'ru': 'rus', 'sk': 'slk', 'sl': 'slv',
+    'sr': 'srp', 'sv': 'swe', 'th': 'tha', 'tr': 'tur', 'uk': 'ukr',
+    'vi': 'vie', 'zh': 'zho',
+}
+
+AUTHOR_SUFFIXES = ('jr', 'jr.', 'sr', 'sr.', 'ii', 'iii', 'iv', 'phd', 'md')
+
+
+class UnsupportedEpub(Exception):
+    """Raised internally when an EPUB needs ``ebook-meta`` to be read faithfully"""
+
+
+def _local(tag):
+    return tag.rpartition('}')[2] if isinstance(tag, str) else ''
+
+
+def _attr(element, name):
+    """Attribute by local name, whatever namespace (if any) it is in"""
+    for key, value in element.attrib.items():
+        if _local(key) == name:
+            return value
+    return None
+
+
+def _text(element):
+    return ' '.join(''.join(element.itertext()).split())
+
+
+class _Package:
+    """The parts of an OPF package document needed for metadata and covers"""
+
+    def __init__(self, archive):
+        container = ElementTree.fromstring(archive.read(CONTAINER))
+        rootfiles = [
+            e for e in container.iter()
+            if _local(e.tag) == 'rootfile'
+            and _attr(e, 'media-type') in (None, 'application/oebps-package+xml')
+        ]
+        if not rootfiles:
+            raise UnsupportedEpub('No OPF rootfile')
+        self.path = _attr(rootfiles[0], 'full-path')
+        self.root = ElementTree.fromstring(archive.read(self.path))
+        self.metadata = self._section('metadata')
+        self.manifest = self._section('manifest')
+        self.refines = {}
+        for meta in self._children(self.metadata, 'meta'):
+            refines = _attr(meta, 'refines')
+            if refines:
+                self.refines.setdefault(refines.lstrip('#'), {})[
+                    _attr(meta, 'property')
+                ] = _text(meta)
+
+    def _section(self, name):
+        for element in self.root.iter():
+            if _local(element.tag) == name:
+                return element
+        if name == 'metadata':
+            raise UnsupportedEpub('No metadata section')
+        return ElementTree.Element(name)
+
+    def _children(self, parent, name):
+        # some EPUB2 files nest Dublin Core elements in a dc-metadata element
+        return [e for e in parent.iter() if _local(e.tag) == name]
+
+    def dc(self, name) -> List:
+        return self._children(self.metadata, name)
+
+    def meta(self, name) -> Optional[str]:
+        for meta in self._children(self.metadata, 'meta'):
+            if _attr(meta, 'name') == name:
+                return _attr(meta, 'content')
+            if _attr(meta, 'property') == name:
+                return _text(meta)
+        return None
+
+    def refinement(self, element, prop) -> Optional[str]:
+        element_id = _attr(element, 'id')
+        if element_id:
+            return self.refines.get(element_id, {}).get(prop)
+        return None
+
+    def href(self, item) -> str:
+        return posixpath.normpath(
+            posixpath.join(posixpath.dirname(self.path), unquote(_attr(item, 'href')))
+        )
+
+    def items(self):
+        return self._children(self.manifest, 'item')
+
+
+def _authors(package):
+    authors = []
+    sorts = []
+    for creator in package.dc('creator'):
+        role = _attr(creator, 'role') or package.refinement(creator, 'role')
+        if role and role != 'aut':
+            continue
+        name = _text(creator)
+        if not name:
+            continue
+        authors.append(name)
+        sorts.append(
+            _attr(creator, 'file-as') or
+            package.refinement(creator, 'file-as') or
+            author_to_author_sort(name)
+        )
+    return authors, sorts
+
+
+def author_to_author_sort(author):
+    """Approximates Calibre's default sort string, e.g. ``Austen, Jane``"""
+    tokens = author.split()
+    suffix = []
+    while len(tokens) > 1 and tokens[-1].lower() in AUTHOR_SUFFIXES:
+        suffix.insert(0, tokens.pop())
+    if len(tokens) < 2:
+        return ' '.join(tokens + suffix)
+    return ' '.join([tokens[-1] + ','] + tokens[:-1] + suffix)
+
+
+def _language(code):
+    code = code.strip().lower().replace('_', '-').partition('-')[0]
+    if len(code) == 3:
+        return code
+    if code in LANGUAGE_CODES:
+        return LANGUAGE_CODES[code]
+    raise UnsupportedEpub('Unknown language code {}'.format(code))
+
+
+def _date(value):
+    value = value.strip()
+    if DATE_ONLY_RE.match(value):
+        parts = (value.split('-') + ['01', '01'])[:3]
+        return '{}T00:00:00+00:00'.format('-'.join(parts))
+    return value
+
+
+def _identifiers(package):
+    identifiers = []
+    for identifier in package.dc('identifier'):
+        value = _text(identifier)
+        scheme = _attr(identifier, 'scheme') or package.refinement(identifier, 'identifier-type')
+        if not scheme:
+            prefix, _, rest = value.partition(':')
+            if prefix.lower() == 'urn':
+                scheme, _, value = rest.partition(':')
+            elif prefix.lower() == 'isbn' and rest:
+                scheme, value = prefix, rest
+        if not scheme or not value:
+            continue
+        scheme = scheme.lower()
+        if scheme in ('calibre', 'uuid'):
+            continue
+        if scheme == 'isbn':
+            value = value.replace('-', '').replace(' ', '')
+        identifiers.append((scheme, value))
+    return identifiers
+
+
+def _format_rating(value):
+    # calibre:rating is stored out of 10 but printed out of 5
+    rating = float(value) / 2
+    return '%.2g' % rating
+
+
+def metadata_map(package) -> Dict[str, str]:
+    """Builds the ``ebook-meta`` style raw metadata map for an OPF package"""
+    mmap = {}
+
+    titles = [_text(t) for t in package.dc('title') if _text(t)]
+    if titles:
+        mmap[TITLE] = titles[0]
+
+    authors, sorts = _authors(package)
+    if authors:
+        mmap[AUTHOR] = '{} [{}]'.format(' & '.join(authors), ' & '.join(sorts))
+
+    publishers = [_text(p) for p in package.dc('publisher') if _text(p)]
+    if publishers:
+        mmap[PUBLISHER] = publishers[0]
+
+    tags = [_text(s) for s in package.dc('subject') if _text(s)]
+    if tags:
+        mmap[TAGS] = ', '.join(tags)
+
+    series = package.meta('calibre:series')
+    index = package.meta('calibre:series_index')
+    if not series:
+        for meta in package.dc('meta'):
+            if _attr(meta, 'property') == 'belongs-to-collection':
+                series = _text(meta)
+                index = package.refinement(meta, 'group-position')
+                break
+    if series:
+        index = float(index or 1)
+        mmap[SERIES] = '{} #{}'.format(series, int(index) if index.is_integer() else index)
+
+    languages = [_language(_text(lang)) for lang in package.dc('language') if _text(lang)]
+    if languages:
+        mmap[LANGUAGE] = ', '.join(languages)
+
+    timestamp = package.meta('calibre:timestamp')
+    if timestamp:
+        mmap[LAST_EDITED] = _date(timestamp)
+
+    for date in package.dc('date'):
+        event = _attr(date, 'event')
+        if event in (None, 'publication') and _text(date):
+            mmap[PUBLISHED] = _date(_text(date))
+            break
+
+    rights = [_text(r) for r in package.dc('rights') if _text(r)]
+    if rights:
+        mmap[RIGHTS] = rights[0]
+
+    identifiers = _identifiers(package)
+    if identifiers:
+        mmap[IDENTIFIERS] = ', '.join('{}:{}'.format(k, v) for k, v in identifiers)
+
+    descriptions = [_text(d) for d in package.dc('description') if _text(d)]
+    if descriptions:
+        mmap[DESCRIPTION] = descriptions[0]
+
+    rating = package.meta('calibre:rating')
+    if rating:
+        mmap[RATING] = _format_rating(rating)
+
+    return mmap
+
+
+def cover_path(package) -> Optional[str]:
+    """Path inside the archive of the cover image, if the OPF names one"""
+    items = package.items()
+    for item in items:
+        if 'cover-image' in (_attr(item, 'properties') or '').split():
+            return package.href(item)
+    cover = package.meta('cover')
+    if cover:
+        for item in items:
+            if cover in (_attr(item, 'id'), _attr(item, 'href')):
+                if (_attr(item, 'media-type') or '').startswith('image/'):
+                    return package.href(item)
+    return None
+
+
+def read_metadata_map(input_file) -> Optional[Dict[str, str]]:
+    """Reads the raw metadata map of an EPUB, as ``ebook-meta`` would print it
+
+    Args:
+        input_file (str or file): path to, or binary file object of, the EPUB
+    Returns:
+        Dict mapping between metadata keys and values, or ``None`` if the
+            file needs to be read by ``ebook-meta`` instead
+    """
+    try:
+        with zipfile.ZipFile(input_file) as archive:
+            return metadata_map(_Package(archive))
+    except (zipfile.BadZipFile, KeyError, ValueError, ElementTree.ParseError, UnsupportedEpub):
+        return None
+
+
+def read_cover(input_file) -> Optional[bytes]:
+    """Reads the cover image of an EPUB straight from the archive
+
+    Args:
+        input_file (str or file): path to, or binary file object of, the EPUB
+    Returns:
+        The image's bytes, or ``None`` if the OPF doesn't point at a cover
+            image (``ebook-meta`` may still be able to find or render one)
+    """
+    try:
+        with zipfile.ZipFile(input_file) as archive:
+            path = cover_path(_Package(archive))
+            if path is None:
+                return None
+            return archive.read(path)
+    except (zipfile.BadZipFile, KeyError, ValueError, ElementTree.ParseError, UnsupportedEpub):
+        return None
+
+
+def read_metadata_map_and_cover(input_file) -> Optional[Tuple[Dict[str, str], Optional[bytes]]]:
+    """Reads the raw metadata map and cover image of an EPUB in one pass
+
+    Args:
+        input_file (str or file): path to, or binary file object of, the EPUB
+    Returns:
+        ``(metadata_map, cover)`` as :func:`read_metadata_map` and
+            :func:`read_cover` would return them, or ``None`` if the file
+            needs to be read by ``ebook-meta`` instead
+    """
+    try:
+        with zipfile.ZipFile(input_file) as archive:
+            package = _Package(archive)
+            path = cover_path(package)
+            return metadata_map(package), archive.read(path) if path else None
+    except (zipfile.BadZipFile, KeyError, ValueError, ElementTree.ParseError, UnsupportedEpub):
+        return None
+
+
+def read_opf(input_file) -> Tuple[str, bytes]:
+    """The path inside the archive and the contents of an EPUB's OPF"""
+    with zipfile.ZipFile(input_file) as archive:
+        path = _Package(archive).path
+        return path, archive.read(path)
+
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+LOCAL_SIGNATURE = b'PK\x03\x04'
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+END_SIGNATURE = b'PK\x05\x06'
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP64_LIMIT = 0xFFFFFFFF
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+
+def _central_directory(source):
+    """The raw central directory records and end-of-archive comment of a zip"""
+    source.seek(0, 2)
+    size = source.tell()
+    tail_size = min(size, END_RECORD.size + 0xFFFF)
+    source.seek(size - tail_size)
+    tail = source.read(tail_size)
+    at = tail.rfind(END_SIGNATURE)
+    if at < 0:
+        raise zipfile.BadZipFile('No end of central directory record')
+    (_, disk, directory_disk, _, entries,
+     directory_size, directory_offset, comment_size) = END_RECORD.unpack_from(tail, at)
+    if disk or directory_disk or entries == 0xFFFF or ZIP64_LIMIT in (directory_size, directory_offset):
+        raise UnsupportedEpub('Multi-disk or Zip64 archive')
+    comment = tail[at + END_RECORD.size:at + END_RECORD.size + comment_size]
+
+    source.seek(directory_offset)
+    directory = source.read(directory_size)
+    records = []
+    offset = 0
+    for _ in range(entries):
+        fields = CENTRAL_HEADER.unpack_from(directory, offset)
+        if fields[0] != CENTRAL_SIGNATURE:
+            raise zipfile.BadZipFile('Bad central directory record')
+        end = offset + CENTRAL_HEADER.size + fields[10] + fields[11] + fields[12]
+        records.append(directory[offset:end])
+        offset = end
+    return records, comment
+
+
+def _member_name(record):
+    fields = CENTRAL_HEADER.unpack_from(record)
+    name = record[CENTRAL_HEADER.size:CENTRAL_HEADER.size + fields[10]]
+    return name.decode('utf-8' if fields[3] & FLAG_UTF8 else 'cp437')
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def _copy_member(source, output, record):
+    """Copies a member's local header, data and descriptor unchanged,
+    returning the offset it was written at"""
+    fields = CENTRAL_HEADER.unpack_from(record)
+    flags, compressed_size, offset = fields[3], fields[8], fields[16]
+    if ZIP64_LIMIT in (compressed_size, fields[9], offset):
+        raise UnsupportedEpub('Zip64 member')
+    source.seek(offset)
+    header = source.read(LOCAL_HEADER.size)
+    local = LOCAL_HEADER.unpack(header)
+    if local[0] != LOCAL_SIGNATURE:
+        raise zipfile.BadZipFile('Bad local file header')
+    length = LOCAL_HEADER.size + local[9] + local[10] + compressed_size
+    if flags & FLAG_DESCRIPTOR:
+        source.seek(offset + length)
+        length += 16 if source.read(4) == DESCRIPTOR_SIGNATURE else 12
+    source.seek(offset)
+    written_at = output.tell()
+    remaining = length
+    while remaining:
+        chunk = source.read(min(remaining, 1 << 20))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated member')
+        output.write(chunk)
+        remaining -= len(chunk)
+    return written_at
+
+
+def _write_member(output, record, data):
+    """Writes data deflated as a new member in place of the one record
+    describes, returning its new central directory record"""
+    fields = list(CENTRAL_HEADER.unpack_from(record))
+    name = record[CENTRAL_HEADER.size:CENTRAL_HEADER.size + fields[10]]
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    crc = zlib.crc32(data) & 0xFFFFFFFF
+    flags = fields[3] & FLAG_UTF8
+    mod_time, mod_date = _dos_time(time.time())
+    offset = output.tell()
+    output.write(LOCAL_HEADER.pack(
+        LOCAL_SIGNATURE, 20, flags, zipfile.ZIP_DEFLATED, mod_time, mod_date,
+        crc, len(compressed), len(data), len(name), 0
+    ))
+    output.write(name)
+    output.write(compressed)
+    # version made by and external attributes are kept
+    return CENTRAL_HEADER.pack(
+        CENTRAL_SIGNATURE, fields[1], 20, flags, zipfile.ZIP_DEFLATED, mod_time, mod_date,
+        crc, len(compressed), len(data), len(name), 0, 0, 0, fields[14], fields[15], offset
+    ) + name
+
+
+def replace_member(input_file, output_file, name, data):
+    """Writes a copy of a zip archive with one member's contents replaced
+
+    Every other member is copied byte for byte, without being decompressed
+    or recompressed, so the copy costs little more than the I/O.
+
+    Args:
+        input_file (str): path to the archive
+        output_file (str): path to write the copy to
+        name (str): path inside the archive of the member to replace
+        data (bytes): the member's new contents
+    Raises:
+        KeyError: if the archive has no member called name
+        UnsupportedEpub: for Zip64 or multi-disk archives, or if the member
+            is encrypted
+    """
+    with open(input_file, 'rb') as source:
+        records, comment = _central_directory(source)
+        names = [_member_name(record) for record in records]
+        if name not in names:
+            raise KeyError(name)
+        order = sorted(range(len(records)), key=lambda i: CENTRAL_HEADER.unpack_from(records[i])[16])
+        new_records = list(records)
+        with open(output_file, 'wb') as output:
+            for i in order:
+                record = records[i]
+                if names[i] == name:
+                    if CENTRAL_HEADER.unpack_from(record)[3] & FLAG_ENCRYPTED:
+                        raise UnsupportedEpub('Encrypted member {}'.format(name))
+                    new_records[i] = _write_member(output, record, data)
+                else:
+                    offset = _copy_member(source, output, record)
+                    new_records[i] = record[:42] + struct.pack('<L', offset) + record[46:]
+            directory_offset = output.tell()
+            for record in new_records:
+                output.write(record)
+            directory_size = output.tell() - directory_offset
+            if directory_offset > ZIP64_LIMIT:
+                raise UnsupportedEpub('Archive needs Zip64')
+            output.write(END_RECORD.pack(
+                END_SIGNATURE, 0, 0, len(records), len(records),
+                directory_size, directory_offset, len(comment)
+            ))
+            output.write(comment)
@@ -0,0 +1,194 @@
+"""
+A persistent cache of ``fetch-ebook-metadata`` lookups, so that looking up
+the same book twice only queries the remote metadata sources once. For use
+like ::
+
+    cache = FetchCache('/var/cache/capybre/fetch.db')
+    metadata = fetch_metadata(isbn='9780679783268', cache=cache)
+
+Lookups are keyed on the normalized title, author and ISBN. Found books are
+kept for a configurable time-to-live, and lookups that found nothing for a
+shorter one, so that missing books are retried eventually without hammering
+the sources in the meantime. Covers are stored alongside their metadata,
+and concurrent identical lookups share a single ``fetch-ebook-metadata``
+call.
+"""
+import json
+import os
+import threading
+import time
+
+from .fetch_metadata import (
+    fetch_metadata_args,
+    fetch_metadata_map,
+    fetch_cover_map,
+    MetadataNotFound,
+)
+from .helpers import scratch_directory, SingleFlight, SQLiteConnections
+
+DAY = 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS lookups (
+    key          TEXT PRIMARY KEY,
+    found        INTEGER NOT NULL,
+    metadata_map TEXT,
+    has_cover    INTEGER NOT NULL,
+    cover        BLOB,
+    fetched_at   REAL NOT NULL
+);
+'''
+
+
+def normalize_query(title=None, author=None, isbn=None):
+    """Normalized form of a lookup, so trivially different queries share a key
+
+    Titles and authors are case-folded with whitespace collapsed, and ISBNs
+    are reduced to their digits (and check character).
+    """
+    def text(value):
+        return ' '.join(value.split()).casefold() if value else None
+
+    if isbn:
+        isbn = ''.join(c for c in isbn if c.isdigit() or c in 'xX').upper() or None
+    return text(title), text(author), isbn
+
+
+class FetchCache:
+    """SQLite-backed cache of metadata lookups, with positive and negative TTLs
+
+    Args:
+        path (str): Path to the SQLite database, created if needed
+        ttl (float, optional): Seconds a found book is kept. Defaults to 30
+            days
+        negative_ttl (float, optional): Seconds a lookup that found nothing
+            is kept. Defaults to 1 day
+    """
+
+    def __init__(self, path, ttl=30 * DAY, negative_ttl=DAY):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self._connections = SQLiteConnections(path, SCHEMA)
+
+    def key(self, title=None, author=None, isbn=None, sources=None):
+        # also validates that the query is usable at all
+        fetch_metadata_args(title, author, isbn)
+        key = normalize_query(title, author, isbn)
+        if sources:
+            key += tuple(sorted(sources))
+        return json.dumps(key)
+
+    def _get(self, key, with_cover):
+        row = self._connections.get().execute(
+            'SELECT found, metadata_map, has_cover, cover, fetched_at FROM lookups WHERE key = ?',
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        found, metadata_map, has_cover, cover, fetched_at = row
+        ttl = self.ttl if found else self.negative_ttl
+        if time.time() - fetched_at > ttl:
+            return None
+        if found and with_cover and not has_cover:
+            return None
+        return row
+
+    def _put(self, key, metadata_map, with_cover=False, cover=None):
+        row = (
+            int(metadata_map is not None),
+            json.dumps(metadata_map) if metadata_map is not None else None,
+            int(with_cover),
+            cover,
+            time.time(),
+        )
+        self._connections.get().execute(
+            'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?, ?)',
+            (key,) + row
+        )
+        return row
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _lookup(self, key, with_cover, fetch):
+        row = self._get(key, with_cover)
+        self._count(row is not None)
+        if row is None:
+            row = self._single_flight.do((key, with_cover), lambda: self._fill(key, with_cover, fetch))
+        if not row[0]:
+            raise MetadataNotFound(1, ['fetch-ebook-metadata'], '')
+        return row
+
+    def _fill(self, key, with_cover, fetch):
+        # a concurrent lookup may have filled the entry while we queued
+        row = self._get(key, with_cover)
+        if row is not None:
+            return row
+        try:
+            metadata_map, cover = fetch()
+        except MetadataNotFound:
+            return self._put(key, None)
+        return self._put(key, metadata_map, with_cover, cover)
+
+    def fetch_metadata_map(self, title=None, author=None, isbn=None, sources=None):
+        """Cached version of :func:`capybre.fetch_metadata.fetch_metadata_map`"""
+        def fetch():
+            return fetch_metadata_map(title, author, isbn, sources=sources), None
+
+        row = self._lookup(self.key(title, author, isbn, sources), False, fetch)
+        return json.loads(row[1])
+
+    def fetch_cover(self, title=None, author=None, isbn=None, output_file='cover.jpg'):
+        """Cached version of :func:`capybre.fetch_metadata.fetch_cover`
+
+        Returns:
+            The raw metadata map of the book whose cover was written to
+            output_file. If the sources had no cover, no file is written.
+        """
+        def fetch():
+            with scratch_directory() as directory:
+                cover_file = os.path.join(directory, 'cover.jpg')
+                metadata_map = fetch_cover_map(title, author, isbn, cover_file)
+                cover = None
+                if os.path.isfile(cover_file):
+                    with open(cover_file, 'rb') as f:
+                        cover = f.read()
+            return metadata_map, cover
+
+        row = self._lookup(self.key(title, author, isbn), True, fetch)
+        if row[3] is not None:
+            with open(output_file, 'wb') as f:
+                f.write(row[3])
+        return json.loads(row[1])
+
+    def cached(self, title=None, author=None, isbn=None, sources=None) -> bool:
+        """Whether a lookup would be served from the cache, found or not"""
+        return self._get(self.key(title, author, isbn, sources), False) is not None
+
+    def invalidate(self, title=None, author=None, isbn=None):
+        """Drops the entry for a lookup, or every entry if none is given"""
+        connection = self._connections.get()
+        if title is None and author is None and isbn is None:
+            connection.execute('DELETE FROM lookups')
+        else:
+            connection.execute(
+                'DELETE FROM lookups WHERE key = ?',
+                (self.key(title, author, isbn),)
+            )
+
+    def purge(self):
+        """Deletes expired entries from the database"""
+        now = time.time()
+        self._connections.get().execute(
+            'DELETE FROM lookups WHERE (found AND fetched_at < ?) OR (NOT found AND fetched_at < ?)',
+            (now - self.ttl, now - self.negative_ttl)
+        )
@@ -5,13 +5,41 @@ looks up metadata based on title, author, and/or ISBN
 ..fetch-ebook-meta: https://manual.calibre-ebook.com/generated/en/fetch-ebook-metadata.html
 
 """
+import json
 import os
+import subprocess
+import sys
 
-from .helpers import random_filename, check_output
+from .helpers import bounded_map, check_output, scratch_directory, TokenBucket
 from .metadata import extract_raw_metadata_map, clean_metadata_map, Metadata
+from .opf import parse_opf_lines
 
 
-def fetch_metadata_map(title=None, author=None, isbn=None):
+# what fetch-ebook-metadata prints when no source knows the book
+NO_RESULTS = b'No results found'
+
+
+class MetadataNotFound(subprocess.CalledProcessError):
+    """Raised when ``fetch-ebook-metadata`` finds no matching book
+
+    A subclass of ``CalledProcessError``, which is what failed lookups
+    raised before this existed.
+    """
+
+
+def lookup(args):
+    """Runs a ``fetch-ebook-metadata`` call, returning its output lines"""
+    try:
+        return check_output(args)
+    except subprocess.CalledProcessError as e:
+        # exit code 1 also covers crashes and network errors, which mustn't
+        # be mistaken for (and cached as) a book that doesn't exist
+        if e.returncode == 1 and NO_RESULTS in (e.stderr or b'') + (e.output or b''):
+            raise MetadataNotFound(e.returncode, e.cmd, e.output, e.stderr) from None
+        raise
+
+
+def fetch_metadata_map(title=None, author=None, isbn=None, cache=None, sources=None):
     """Extracts metadata about an ebook, returning a dict.
     At least one of title, author, or ISBN is required; it is suggested to
     either provide ISBN or both title and author. In the case of multiple books
@@ -21,16 +49,25 @@ def fetch_metadata_map(title=None, author=None, isbn=None):
         title (str, optional): Title of the book
         author (str, optional): Author of the book
         isbn (str, optional): Book's ISBN code
+        cache (FetchCache, optional): Cache to serve the lookup from, see
+            :class:`capybre.fetch_cache.FetchCache`
+        sources (List[str], optional): Names of the metadata source plugins
+            to query, e.g. ``['Google']``. Defaults to Calibre's defaults
     Returns:
         Dict mapping between metadata keys and values as directly output from
             the ebook-meta call
+    Raises:
+        MetadataNotFound: if no matching book was found
     """
-    fetch_args = fetch_metadata_args(title, author, isbn)
-    raw_metadata = check_output(fetch_args)
+    if cache is not None:
+        return cache.fetch_metadata_map(title, author, isbn, sources)
+    fetch_args = fetch_metadata_args(title, author, isbn, sources)
+    raw_metadata = lookup(fetch_args)
     return extract_raw_metadata_map(raw_metadata)
 
 
-def fetch_metadata(title=None, author=None, isbn=None) -> Metadata:
+def fetch_metadata(title=None, author=None, isbn=None, cache=None, sources=None,
+                   opf=False) -> Metadata:
     """Extracts metadata about an ebook, returning a :class:`Metadata` object.
     At least one of title, author, or ISBN is required; it is suggested to
     either provide ISBN or both title and author. In the case of multiple books
@@ -40,13 +77,24 @@ def fetch_metadata(title=None, author=None, isbn=None) -> Metadata:
         title (str, optional): Title of the book
         author (str, optional): Author of the book
         isbn (str, optional): Book's ISBN code
+        cache (FetchCache, optional): Cache to serve the lookup from, see
+            :class:`capybre.fetch_cache.FetchCache`
+        sources (List[str], optional): Names of the metadata source plugins
+            to query, e.g. ``['Google']``. Defaults to Calibre's defaults
+        opf (bool, optional): Ask for, and parse, an OPF document rather
+            than the text output, see :mod:`capybre.opf`. Bypasses the
+            cache. Defaults to ``False``
     Returns:
         :class:`Metadata` object
+    Raises:
+        MetadataNotFound: if no matching book was found
     """
-    return clean_metadata_map(fetch_metadata_map(title, author, isbn))
+    if opf:
+        return parse_opf_lines(lookup(fetch_metadata_args(title, author, isbn, sources) + ['--opf']))
+    return clean_metadata_map(fetch_metadata_map(title, author, isbn, cache, sources))
 
 
-def fetch_cover(title=None, author=None, isbn=None, output_file='cover.jpg'):
+def fetch_cover(title=None, author=None, isbn=None, output_file='cover.jpg', cache=None):
     """Downloads cover to specified file
 
     As it is impossible to download without also fetching metadata, also
@@ -60,12 +108,143 @@ def fetch_cover(title=None, author=None, isbn=None, output_file='cover.jpg'):
         title (str, optional): Title of the book
         author (str, optional): Author of the book
         isbn (str, optional): Book's ISBN code
+        cache (FetchCache, optional): Cache to serve the lookup from, see
+            :class:`capybre.fetch_cache.FetchCache`
     Returns:
         :class:`Metadata` object
+    Raises:
+        MetadataNotFound: if no matching book was found
+    """
+    if cache is not None:
+        return clean_metadata_map(
+            cache.fetch_cover(title, author, isbn, output_file)
+        )
+    return clean_metadata_map(fetch_cover_map(title, author, isbn, output_file))
+
+
+def fetch_cover_map(title=None, author=None, isbn=None, output_file='cover.jpg'):
+    """Downloads cover to specified file, returning the raw metadata dict
+
+    Like :func:`fetch_cover`, but returns the metadata as
+    :func:`fetch_metadata_map` does.
     """
     fetch_args = fetch_metadata_args(title, author, isbn) + ['-c', output_file]
-    raw_metadata = check_output(fetch_args)
-    return clean_metadata_map(extract_raw_metadata_map(raw_metadata))
+    raw_metadata = lookup(fetch_args)
+    return extract_raw_metadata_map(raw_metadata)
+
+
+class FetchResult:
+    """Outcome of a single query run by :func:`fetch_metadata_many`
+
+    Args:
+        query (Tuple[str, str, str]): The (title, author, isbn) looked up
+        metadata (Metadata): The book found, if any
+        error (Exception): The exception raised by the lookup, if any;
+            :class:`MetadataNotFound` if no book matched
+    """
+
+    def __init__(self, query, metadata=None, error=None):
+        self.query = query
+        self.metadata = metadata
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def fetch_metadata_many(
+    queries,
+    max_workers=4,
+    rate_limits=None,
+    sources=None,
+    checkpoint=None,
+    cache=None
+):
+    """Looks up many books concurrently, yielding results as each finishes
+
+    Each query is a (title, author, isbn) tuple, any of which may be
+    ``None``, or a dict with those keys. Lookups go through
+    :func:`fetch_metadata`, so results match the single-call API exactly.
+    For use like ::
+
+        queries = ((None, None, isbn) for isbn in isbns)
+        for result in fetch_metadata_many(queries, rate_limits={'Google': 1}):
+            if result.ok:
+                save(result.metadata)
+
+    Args:
+        queries (Iterable[tuple or dict]): Lookups to run. Consumed lazily
+        max_workers (int, optional): Number of lookups to run at once.
+            Defaults to 4
+        rate_limits (Dict[str, float], optional): Lookups per second allowed
+            against each named source. A lookup counts against every source
+            it queries, i.e. those in sources, or all rate-limited sources if
+            sources isn't given. The key ``'*'`` limits lookups overall
+        sources (List[str], optional): Metadata source plugins to query.
+            Defaults to Calibre's defaults
+        checkpoint (str, optional): Path to a JSON Lines file recording each
+            finished query. Queries already recorded there (found or not
+            found) are skipped, so an interrupted run can be resumed by
+            calling again with the same checkpoint
+        cache (FetchCache, optional): Cache to serve lookups from. Lookups
+            it answers don't count against rate_limits
+    Yields:
+        :class:`FetchResult` for each query not already checkpointed, in
+        order of completion
+    """
+    buckets = {
+        source: TokenBucket(rate)
+        for source, rate in (rate_limits or {}).items()
+    }
+    limited = [
+        bucket for source, bucket in buckets.items()
+        if source == '*' or sources is None or source in sources
+    ]
+    done = _read_checkpoint(checkpoint) if checkpoint else set()
+
+    def pending():
+        for query in queries:
+            if isinstance(query, dict):
+                query = (query.get('title'), query.get('author'), query.get('isbn'))
+            query = tuple(query)
+            if _query_key(query) not in done:
+                yield query
+
+    def run(query):
+        # a lookup the cache answers never reaches the sources
+        if cache is None or not cache.cached(*query, sources=sources):
+            for bucket in limited:
+                bucket.acquire()
+        return fetch_metadata(*query, cache=cache, sources=sources)
+
+    log = open(checkpoint, 'a') if checkpoint else None
+    try:
+        for query, metadata, error in bounded_map(run, pending(), max_workers):
+            if log and (error is None or isinstance(error, MetadataNotFound)):
+                log.write(json.dumps({'query': list(query), 'found': error is None}) + '\n')
+                log.flush()
+            yield FetchResult(query, metadata, error)
+    finally:
+        if log:
+            log.close()
+
+
+def _query_key(query):
+    return json.dumps(list(query))
+
+
+def _read_checkpoint(checkpoint):
+    done = set()
+    if os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            for line in f:
+                try:
+                    done.add(_query_key(json.loads(line)['query']))
+                except (ValueError, KeyError):
+                    # a run killed mid-write can leave a partial last line
+                    pass
+    return done
 
 
 class fetched_metadata_and_cover:
@@ -76,32 +255,39 @@ class fetched_metadata_and_cover:
             upload(cover, metadata)
     """
 
-    def __init__(self, title=None, author=None, isbn=None):
-        self.cover_filename = random_filename('jpg')
+    def __init__(self, title=None, author=None, isbn=None, cache=None):
+        self.scratch = scratch_directory()
+        self.cover_filename = None
         self.title = title
         self.author = author
         self.isbn = isbn
+        self.cache = cache
         self.fp = None
 
     def __enter__(self):
-        metadata = fetch_cover(
-            self.title,
-            self.author,
-            self.isbn,
-            self.cover_filename
-        )
-        self.fp = open(self.cover_filename, 'rb')
+        self.cover_filename = os.path.join(self.scratch.__enter__(), 'cover.jpg')
+        try:
+            metadata = fetch_cover(
+                self.title,
+                self.author,
+                self.isbn,
+                self.cover_filename,
+                self.cache
+            )
+            self.fp = open(self.cover_filename, 'rb')
+        except BaseException:
+            self.scratch.__exit__(*sys.exc_info())
+            raise
 
         return metadata, self.fp
 
     def __exit__(self, type, value, traceback):
         if self.fp:
             self.fp.close()
-        if os.path.isfile(self.cover_filename):
-            os.remove(self.cover_filename)
+        self.scratch.__exit__(type, value, traceback)
 
 
-def fetch_metadata_args(title=None, author=None, isbn=None):
+def fetch_metadata_args(title=None, author=None, isbn=None, sources=None):
     args = ['fetch-ebook-metadata']
     if title:
         args += ['--title', title]
@@ -111,4 +297,6 @@ def fetch_metadata_args(title=None, author=None, isbn=None):
         args += ['--isbn', isbn]
     if len(args) == 1:
         raise Exception('At least one of title, author and isbn must be specified')
+    for source in sources or ():
+        args += ['--allowed-plugin', source]
     return args
@@ -1,7 +1,45 @@
+import hashlib
 import os
 import random
+import shutil
+import sqlite3
 import string
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .instrumentation import observe
+from .limits import (
+    breached,
+    CalibreTimeout,
+    command,
+    effective_limits,
+    kill_group,
+    ResourceLimitExceeded,
+)
+
+
+# Optional object that runs Calibre tools in place of a fresh subprocess,
+# e.g. a :class:`capybre.worker_pool.WorkerPool`; see :func:`set_backend`
+_backend = None
+
+
+def set_backend(backend):
+    """Routes :func:`call` and :func:`check_output` through backend
+
+    The backend must provide ``handles(args)``, ``call(args, suppress_output)``
+    and ``check_output(args)``. Pass ``None`` to go back to spawning a
+    subprocess per call.
+    """
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
 
 
 def random_filename(extension, length=10):
@@ -9,10 +47,349 @@ def random_filename(extension, length=10):
     return '{}.{}'.format(base, extension)
 
 
-def call(args, suppress_output=True):
-    stdout = open(os.devnull, 'w') if suppress_output else None
-    return subprocess.call(args, stdout=stdout)
+def scratch_dir():
+    """Directory for short-lived working files, RAM-backed where available"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class scratch_directory:
+    """Context object creating a private directory under :func:`scratch_dir`
+
+    The directory and everything in it is removed on exit.
+    """
+
+    def __init__(self):
+        self.path = None
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='capybre-', dir=scratch_dir())
+        return self.path
+
+    def __exit__(self, type, value, traceback):
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def write_source(source, path):
+    """Writes bytes, or the contents of a binary file object, to path"""
+    with open(path, 'wb') as f:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            f.write(source)
+        else:
+            shutil.copyfileobj(source, f)
+
+
+def call(args, suppress_output=True, check=False, limits=None, progress=None):
+    """Runs a Calibre tool, returning its exit code
+
+    Args:
+        args (List[str]): Command line
+        suppress_output (bool, optional): Discards the tool's stdout
+        check (bool, optional): Raises ``CalledProcessError`` on a nonzero
+            exit code
+        limits (ResourceLimits, optional): Overrides the global limits,
+            see :mod:`capybre.limits`
+        progress (ProgressWatcher, optional): Reads the tool's stdout as it
+            runs, see :mod:`capybre.progress`. Always runs a fresh
+            subprocess
+    Raises:
+        CalibreTimeout: if the call ran past its timeout
+        ResourceLimitExceeded: if the call was stopped by a resource limit
+        capybre.progress.ConversionStalled: if progress stalled
+    """
+    with observe(args) as invocation:
+        if _backend is not None and _backend.handles(args) and progress is None:
+            code = _backend.call(args, suppress_output)
+        else:
+            stdout = subprocess.DEVNULL if suppress_output else None
+            code, _, _ = _spawn(args, stdout, invocation, effective_limits(limits), progress)
+        invocation.exit_code = code
+        if check and code:
+            raise subprocess.CalledProcessError(code, args)
+    return code
+
+
+def check_output(args, limits=None):
+    """Runs a Calibre tool, returning its stdout as a list of lines
+
+    Raises:
+        subprocess.CalledProcessError: on a nonzero exit code, with the end
+            of the tool's stderr as its ``stderr``
+        CalibreTimeout: if the call ran past its timeout
+        ResourceLimitExceeded: if the call was stopped by a resource limit
+    """
+    with observe(args) as invocation:
+        if _backend is not None and _backend.handles(args):
+            lines = _backend.check_output(args)
+            invocation.exit_code = 0
+            return lines
+        code, output, stderr = _spawn(
+            args, subprocess.PIPE, invocation, effective_limits(limits), capture_stderr=True
+        )
+        invocation.exit_code = code
+        invocation.output_size = len(output)
+        if code:
+            raise subprocess.CalledProcessError(code, args, output, stderr)
+    return decode_lines(output)
+
+
+def _spawn(args, stdout, invocation, limits, progress=None, capture_stderr=False):
+    """Runs args to completion under limits, returning its exit code,
+    captured stdout and, if capture_stderr, the end of its stderr
+
+    The child leads a process group of its own, which is killed outright
+    if the call times out, stalls or is interrupted. It is reaped with
+    ``os.wait4`` where available, so its CPU time and peak RSS can be
+    recorded on the invocation.
+    """
+    if progress is not None:
+        progress.echo = stdout is None
+        stdout = subprocess.PIPE
+    # a memory limit breach is only recognizable from the error printed
+    capture_stderr = capture_stderr or limits.memory_bytes is not None
+    process = subprocess.Popen(
+        command(args, limits),
+        stdout=stdout,
+        stderr=subprocess.PIPE if capture_stderr else None,
+        start_new_session=hasattr(os, 'killpg'),
+    )
+    stderr = _StderrTail(process.stderr) if capture_stderr else None
+    lock = threading.Lock()
+    state = {'exited': False, 'timed_out': False, 'stalled': False}
+
+    def expire(reason='timed_out'):
+        with lock:
+            if not state['exited']:
+                state[reason] = True
+                kill_group(process.pid)
+
+    timer = None
+    if limits.timeout is not None:
+        timer = threading.Timer(limits.timeout, expire)
+        timer.daemon = True
+        timer.start()
+    output = None
+    try:
+        if progress is not None:
+            progress.start(lambda: expire('stalled'))
+            for line in process.stdout:
+                progress.feed(line)
+            process.stdout.close()
+        elif stdout == subprocess.PIPE:
+            output = process.stdout.read()
+            process.stdout.close()
+        if hasattr(os, 'waitid'):
+            # wait without reaping, so the timer can't signal a reused pid
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        with lock:
+            state['exited'] = True
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = _exit_code(status)
+            invocation.set_rusage(rusage)
+        else:
+            process.wait()
+    except BaseException:
+        with lock:
+            state['exited'] = True
+        kill_group(process.pid)
+        process.wait()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if progress is not None:
+            progress.stop()
+        if stderr is not None:
+            stderr.join()
+
+    if state['timed_out']:
+        raise CalibreTimeout(args, limits.timeout, output)
+    if state['stalled']:
+        raise progress.stall_error(args, output)
+    cpu_time = None
+    if invocation.user_time is not None:
+        cpu_time = invocation.user_time + invocation.system_time
+    exceeded = breached(limits, process.returncode, cpu_time, stderr and stderr.tail)
+    if exceeded:
+        raise ResourceLimitExceeded(exceeded, process.returncode, args, output, stderr and stderr.tail)
+    return process.returncode, output, stderr and stderr.tail
+
+
+class _StderrTail(threading.Thread):
+    """Passes a child's stderr through to ours, keeping the end of it"""
+
+    SIZE = 64 * 1024
+
+    def __init__(self, stream):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.tail = b''
+        self.start()
+
+    def run(self):
+        target = getattr(sys.stderr, 'buffer', None)
+        for chunk in iter(lambda: self.stream.read1(8192), b''):
+            self.tail = (self.tail + chunk)[-self.SIZE:]
+            try:
+                if target is not None:
+                    target.write(chunk)
+                    target.flush()
+                else:
+                    sys.stderr.write(chunk.decode('utf-8', 'replace'))
+            except (OSError, ValueError):
+                pass
+        self.stream.close()
+
+
+def _exit_code(status):
+    """Exit code from a wait status, negative for a signal as in subprocess"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def decode_lines(output):
+    return output.decode('UTF-8').split('\n')
+
+
+def file_digest(input_file, chunk_size=1 << 20):
+    """SHA-256 hex digest of the file's contents"""
+    digest = hashlib.sha256()
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def default_workers():
+    """Number of cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def bounded_map(fn, items, max_workers=None):
+    """Runs fn over items on a thread pool, yielding as each call finishes
+
+    At most ``2 * max_workers`` items are pulled from ``items`` ahead of
+    the results, so arbitrarily long iterables can be streamed through.
+    Exceptions are caught per item rather than propagated.
+
+    Yields:
+        ``(item, result, error)`` tuples, where exactly one of result and
+        error is meaningful
+    """
+    max_workers = max_workers or default_workers()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def fill():
+            while len(pending) < 2 * max_workers:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending[executor.submit(fn, item)] = item
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+            fill()
+
+
+class SingleFlight:
+    """Collapses concurrent calls sharing a key into a single call
+
+    While a call for a key is running, other threads calling :meth:`do` with
+    the same key wait for it and receive its result (or exception) instead
+    of running their own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+class SQLiteConnections(threading.local):
+    """Per-thread connections to a SQLite database in WAL mode
+
+    WAL lets readers proceed alongside a writer, so a database opened this
+    way can be shared by threads and by processes on the same host.
+    """
+
+    def __init__(self, path, schema=''):
+        self.path = path
+        self.schema = schema
+        self.connection = None
+
+    def get(self):
+        if self.connection is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            if self.schema:
+                connection.executescript(self.schema)
+            self.connection = connection
+        return self.connection
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter
+
+    Args:
+        rate (float): Tokens added per second
+        burst (int, optional): Most tokens that can be saved up. Defaults
+            to 1, i.e. calls are evenly spaced
+    """
 
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-def check_output(args):
-    return subprocess.check_output(args).decode('UTF-8').split('\n')
+    def acquire(self):
+        """Blocks until a token is available, then takes it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,334 @@
+"""
+Reports every Calibre invocation made through capybre, with its timing and
+resource usage, so slow calls can be attributed to Calibre's startup, the
+conversion itself or I/O. For use like ::
+
+    def log(invocation):
+        logger.info('%s %s->%s took %.1fs, peak RSS %d bytes',
+                    invocation.tool, invocation.input_format,
+                    invocation.output_format, invocation.wall_time,
+                    invocation.max_rss)
+
+    add_listener(log)
+
+Listeners are called with an :class:`Invocation` after each call finishes,
+on the thread that made it. A tracer following the OpenTelemetry API (e.g.
+``opentelemetry.trace.get_tracer(__name__)``) can also be installed with
+:func:`set_tracer`, to wrap each invocation in a span. A
+:class:`PrometheusExporter` aggregates invocations into histograms.
+
+CPU time and peak RSS come from ``os.wait4``, and so are only reported for
+subprocesses started by :func:`capybre.helpers.call` and
+:func:`capybre.helpers.check_output` on POSIX systems; calls served by a
+backend or made through :mod:`capybre.aio` report ``None`` for them.
+"""
+import os
+import sys
+import threading
+import time
+from typing import Callable
+
+_listeners = []
+_tracer = None
+_lock = threading.Lock()
+
+# ru_maxrss is in kilobytes, except on macOS where it is in bytes
+RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+
+class Invocation:
+    """A single run of a Calibre tool
+
+    Args:
+        tool (str): Name of the tool, e.g. ``ebook-convert``
+        args (List[str]): Full command line
+        input_format (str): Lowercase extension of the input file, if any
+        output_format (str): Lowercase extension of the output file, if any
+        input_size (int): Bytes in the input file, if any
+        output_size (int): Bytes in the output file, or written to stdout
+        wall_time (float): Seconds from start to exit
+        user_time (float): Seconds of user CPU used by the tool
+        system_time (float): Seconds of system CPU used by the tool
+        max_rss (int): Peak resident set size of the tool, in bytes
+        exit_code (int): Exit status; negative for a signal, ``None`` if the
+            tool couldn't be started
+        error (Exception): Exception raised by the call, if any
+    """
+
+    def __init__(self, args):
+        self.args = list(args)
+        self.tool = os.path.basename(self.args[0]) if self.args else None
+        self.input_file, self.output_file = _files(self.tool, self.args)
+        self.input_format = _format(self.input_file)
+        self.output_format = _format(self.output_file)
+        self.input_size = None
+        self.output_size = None
+        self.wall_time = None
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        self.exit_code = None
+        self.error = None
+
+    def set_rusage(self, rusage):
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss * RSS_SCALE
+
+    def attributes(self):
+        """The invocation as flat ``capybre.``-prefixed span attributes"""
+        attributes = {}
+        for name in (
+            'tool', 'input_format', 'output_format', 'input_size', 'output_size',
+            'wall_time', 'user_time', 'system_time', 'max_rss', 'exit_code',
+        ):
+            value = getattr(self, name)
+            if value is not None:
+                attributes['capybre.' + name] = value
+        return attributes
+
+    def __repr__(self):
+        return 'Invocation({!r}, exit_code={}, wall_time={})'.format(
+            self.tool, self.exit_code, self.wall_time
+        )
+
+
+def _option(args, name):
+    if name in args[:-1]:
+        return args[args.index(name) + 1]
+    return None
+
+
+def _files(tool, args):
+    """(input, output) paths named on a Calibre command line"""
+    if tool == 'ebook-convert':
+        return (args[1] if len(args) > 1 else None), (args[2] if len(args) > 2 else None)
+    if tool == 'ebook-meta':
+        output = _option(args, '--get-cover') or _option(args, '--to-opf')
+        return (args[1] if len(args) > 1 else None), output
+    if tool == 'fetch-ebook-metadata':
+        return None, _option(args, '-c') or _option(args, '--cover')
+    return None, None
+
+
+def _format(path):
+    if not path:
+        return None
+    return os.path.splitext(path)[1][1:].lower() or None
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def add_listener(listener: Callable[[Invocation], None]):
+    """Calls listener with an :class:`Invocation` after every Calibre call"""
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Stops calling a listener added with :func:`add_listener`"""
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def set_tracer(tracer):
+    """Wraps every Calibre call in a span from tracer
+
+    The tracer needs the OpenTelemetry ``start_as_current_span(name)``
+    method, returning a context manager over a span with
+    ``set_attribute(key, value)`` and ``record_exception(exception)``. Pass
+    ``None`` to stop tracing.
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def enabled() -> bool:
+    return bool(_listeners) or _tracer is not None
+
+
+class observe:
+    """Context object timing a Calibre call and reporting it on exit
+
+    The body fills in what only it knows (exit code, rusage, output size of
+    stdout); input and output file sizes are read here. For use like ::
+
+        with observe(args) as invocation:
+            invocation.exit_code = run(args)
+    """
+
+    def __init__(self, args):
+        self.invocation = Invocation(args)
+        self.span = None
+        self.span_object = None
+        self.started = None
+
+    def __enter__(self):
+        if _tracer is not None:
+            self.span = _tracer.start_as_current_span(self.invocation.tool or 'calibre')
+            self.span_object = self.span.__enter__()
+        if enabled():
+            self.invocation.input_size = _size(self.invocation.input_file)
+        self.started = time.perf_counter()
+        return self.invocation
+
+    def __exit__(self, type, value, traceback):
+        invocation = self.invocation
+        invocation.wall_time = time.perf_counter() - self.started
+        invocation.error = value
+        if self.span is None and not _listeners:
+            return
+        if invocation.output_file:
+            invocation.output_size = _size(invocation.output_file)
+        if self.span is not None:
+            for key, attribute in invocation.attributes().items():
+                self.span_object.set_attribute(key, attribute)
+            if value is not None:
+                self.span_object.record_exception(value)
+            self.span.__exit__(type, value, traceback)
+        with _lock:
+            listeners = list(_listeners)
+        for listener in listeners:
+            listener(invocation)
+
+
+# Upper bounds of the histogram buckets, in seconds and bytes
+WALL_TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RSS_BUCKETS = tuple(1 << shift for shift in range(24, 35))
+
+
+class _Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class PrometheusExporter:
+    """Listener aggregating invocations into Prometheus histograms
+
+    Histograms of wall time, CPU time and peak RSS are kept per tool and
+    (input format, output format) pair, along with a counter of failed
+    calls. For use like ::
+
+        exporter = PrometheusExporter()
+        add_listener(exporter)
+        exporter.serve(9464)
+
+    or by writing :meth:`render` to a node exporter textfile directory.
+    """
+
+    def __init__(self, prefix='capybre'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._series = {}
+        self._failures = {}
+
+    def __call__(self, invocation: Invocation):
+        labels = (
+            invocation.tool or '',
+            invocation.input_format or '',
+            invocation.output_format or '',
+        )
+        with self._lock:
+            if labels not in self._series:
+                self._series[labels] = {
+                    'wall_seconds': _Histogram(WALL_TIME_BUCKETS),
+                    'cpu_seconds': _Histogram(WALL_TIME_BUCKETS),
+                    'max_rss_bytes': _Histogram(RSS_BUCKETS),
+                }
+            series = self._series[labels]
+            series['wall_seconds'].observe(invocation.wall_time)
+            if invocation.user_time is not None:
+                series['cpu_seconds'].observe(invocation.user_time + invocation.system_time)
+            if invocation.max_rss is not None:
+                series['max_rss_bytes'].observe(invocation.max_rss)
+            if invocation.error is not None or invocation.exit_code:
+                self._failures[labels] = self._failures.get(labels, 0) + 1
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for metric, help_text in (
+                ('wall_seconds', 'Wall time of Calibre invocations'),
+                ('cpu_seconds', 'User plus system CPU time of Calibre invocations'),
+                ('max_rss_bytes', 'Peak resident set size of Calibre invocations'),
+            ):
+                name = '{}_{}'.format(self.prefix, metric)
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels, series in sorted(self._series.items()):
+                    histogram = series[metric]
+                    label_text = _labels(labels)
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, bound, count))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label_text, histogram.count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, label_text, histogram.sum))
+                    lines.append('{}_count{{{}}} {}'.format(name, label_text, histogram.count))
+            name = '{}_failures_total'.format(self.prefix)
+            lines.append('# HELP {} Calibre invocations that failed'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for labels, count in sorted(self._failures.items()):
+                lines.append('{}{{{}}} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address=''):
+        """Serves :meth:`render` over HTTP from a daemon thread
+
+        Returns:
+            The running ``HTTPServer``; call its ``shutdown()`` to stop it
+        """
+        # imported here as http.server is slow to import, and rarely needed
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = Server((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _labels(labels):
+    tool, input_format, output_format = labels
+    return 'tool="{}",input_format="{}",output_format="{}"'.format(
+        _escape(tool), _escape(input_format), _escape(output_format)
+    )
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,280 @@
+"""
+Indexes the ebooks under a directory tree into a queryable SQLite store of
+their :class:`capybre.metadata.Metadata`, re-extracting only files that
+changed since the last scan. For use like ::
+
+    index = LibraryIndex('library.db')
+    changes = index.scan('/mnt/library')
+    for path, metadata in index.find(author_sort='Austen, Jane'):
+        print(path, metadata.title)
+
+Ebooks are recognized by extension, and a file counts as changed when its
+size or modification time differs from the last scan, so rescanning an
+unchanged library costs one ``stat`` per file. Every scan appends the files
+it found added, modified or removed to a change feed (see
+:meth:`LibraryIndex.changes_since`).
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Tuple
+
+from .ebook_format import EbookFormat
+from .helpers import bounded_map, default_workers, SQLiteConnections
+from .metadata import extract_metadata, Metadata
+
+ADDED = 'added'
+MODIFIED = 'modified'
+REMOVED = 'removed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    path        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    title       TEXT,
+    author_sort TEXT,
+    isbn        TEXT,
+    series      TEXT,
+    metadata    TEXT,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS books_title ON books (title);
+CREATE INDEX IF NOT EXISTS books_author_sort ON books (author_sort);
+CREATE INDEX IF NOT EXISTS books_isbn ON books (isbn);
+CREATE INDEX IF NOT EXISTS books_series ON books (series);
+CREATE TABLE IF NOT EXISTS changes (
+    sequence   INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind       TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    scanned_at REAL NOT NULL
+);
+'''
+
+QUERY_FIELDS = ('title', 'author_sort', 'isbn', 'series')
+
+COMMIT_EVERY = 500
+
+
+class Change:
+    """An entry in the change feed of a :class:`LibraryIndex`
+
+    Args:
+        sequence (int): Position in the feed, increasing across scans
+        kind (str): One of ``'added'``, ``'modified'`` or ``'removed'``
+        path (str): Absolute path of the file
+        scanned_at (float): Unix time of the scan that saw the change
+    """
+
+    def __init__(self, sequence, kind, path, scanned_at):
+        self.sequence = sequence
+        self.kind = kind
+        self.path = path
+        self.scanned_at = scanned_at
+
+    def __repr__(self):
+        return 'Change({}, {!r}, {!r})'.format(self.sequence, self.kind, self.path)
+
+
+def _scan_directory(directory):
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif (entry.is_file() and
+                          EbookFormat.from_filename(entry.name) != EbookFormat.UNKNOWN):
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files, subdirectories
+
+
+def walk_ebooks(root, max_workers=None):
+    """Lists the ebooks under root, listing directories in parallel
+
+    Parallel listing pays off on network filesystems, where each directory
+    read is a round trip.
+
+    Returns:
+        List of ``(path, size, mtime_ns)`` tuples
+    """
+    files = []
+    with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as executor:
+        pending = {executor.submit(_scan_directory, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirectories = future.result()
+                files.extend(found)
+                pending |= {executor.submit(_scan_directory, d) for d in subdirectories}
+    return files
+
+
+class LibraryIndex:
+    """Incrementally maintained SQLite index of the ebooks in directory trees
+
+    Args:
+        path (str): Path to the SQLite database, created if needed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connections = SQLiteConnections(path, SCHEMA)
+
+    @property
+    def _db(self):
+        return self._connections.get()
+
+    def scan(self, root, max_workers=None, extract=extract_metadata) -> List[Change]:
+        """Brings the index up to date with the ebooks under root
+
+        Args:
+            root (str): Directory to scan
+            max_workers (int, optional): Number of directories listed, and
+                files extracted, at once. Defaults to the number of
+                available cores
+            extract (Callable[[str], Metadata], optional): Function used to
+                read each new or changed file, e.g. a
+                :func:`functools.partial` of :func:`extract_metadata` with a
+                cache. Defaults to :func:`extract_metadata`
+        Returns:
+            List of the :class:`Change` objects this scan added to the feed
+        """
+        root = os.path.abspath(root)
+        seen = {path: (size, mtime_ns) for path, size, mtime_ns in walk_ebooks(root, max_workers)}
+
+        prefix = os.path.join(root, '')
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self._db.execute(
+                'SELECT path, size, mtime_ns FROM books WHERE path >= ? AND path < ?',
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+            )
+        }
+
+        kinds = {}
+        for path, identity in seen.items():
+            if path not in known:
+                kinds[path] = ADDED
+            elif known[path] != identity:
+                kinds[path] = MODIFIED
+        removed = [path for path in known if path not in seen]
+
+        scanned_at = time.time()
+        changes = []
+        db = self._db
+
+        def record(kind, path):
+            cursor = db.execute(
+                'INSERT INTO changes (kind, path, scanned_at) VALUES (?, ?, ?)',
+                (kind, path, scanned_at)
+            )
+            changes.append(Change(cursor.lastrowid, kind, path, scanned_at))
+
+        # committed in batches so an interrupted scan keeps its progress
+        db.execute('BEGIN')
+        try:
+            for path in removed:
+                db.execute('DELETE FROM books WHERE path = ?', (path,))
+                record(REMOVED, path)
+            results = bounded_map(extract, list(kinds), max_workers)
+            for i, (path, metadata, error) in enumerate(results, 1):
+                size, mtime_ns = seen[path]
+                self._store(path, size, mtime_ns, metadata, error)
+                record(kinds[path], path)
+                if i % COMMIT_EVERY == 0:
+                    db.execute('COMMIT')
+                    db.execute('BEGIN')
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return changes
+
+    def _store(self, path, size, mtime_ns, metadata, error):
+        if error is not None:
+            values = (None, None, None, None, None, '{}: {}'.format(type(error).__name__, error))
+        else:
+            values = (
+                metadata.title,
+                metadata.author_sort,
+                metadata.isbn,
+                metadata.series,
+                json.dumps(metadata.to_dict()),
+                None,
+            )
+        self._db.execute(
+            'INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, size, mtime_ns) + values
+        )
+
+    def get(self, path) -> Metadata:
+        """Indexed metadata of the file at path, or ``None`` if it isn't
+        indexed or couldn't be read"""
+        row = self._db.execute(
+            'SELECT metadata FROM books WHERE path = ?',
+            (os.path.abspath(path),)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return Metadata.from_dict(json.loads(row[0]))
+
+    def find(self, **fields) -> List[Tuple[str, Metadata]]:
+        """Looks up books by exact title, author_sort, isbn and/or series
+
+        For use like ``index.find(author_sort='Austen, Jane')``; several
+        fields must all match.
+
+        Returns:
+            List of ``(path, Metadata)`` tuples, ordered by path
+        """
+        unknown = set(fields) - set(QUERY_FIELDS)
+        if unknown:
+            raise Exception('Cannot query by {}'.format(', '.join(sorted(unknown))))
+        if not fields:
+            raise Exception('At least one of {} must be specified'.format(', '.join(QUERY_FIELDS)))
+        where = ' AND '.join('{} = ?'.format(field) for field in fields)
+        return self._select(where, tuple(fields.values()))
+
+    def search_title(self, text) -> List[Tuple[str, Metadata]]:
+        """Looks up books whose title contains text, ignoring ASCII case"""
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return self._select("title LIKE ? ESCAPE '\\'", ('%' + escaped + '%',))
+
+    def _select(self, where, parameters):
+        rows = self._db.execute(
+            'SELECT path, metadata FROM books WHERE metadata IS NOT NULL AND ' +
+            where + ' ORDER BY path',
+            parameters
+        )
+        return [(path, Metadata.from_dict(json.loads(metadata))) for path, metadata in rows]
+
+    def errors(self) -> List[Tuple[str, str]]:
+        """Files that were found but couldn't be read, as ``(path, error)``"""
+        return list(self._db.execute(
+            'SELECT path, error FROM books WHERE error IS NOT NULL ORDER BY path'
+        ))
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+    def changes_since(self, sequence=0) -> List[Change]:
+        """Changes recorded after the given sequence number
+
+        Consumers can remember the sequence of the last change they processed
+        and pass it back to receive only newer ones.
+        """
+        return [
+            Change(*row) for row in self._db.execute(
+                'SELECT sequence, kind, path, scanned_at FROM changes WHERE sequence > ? ORDER BY sequence',
+                (sequence,)
+            )
+        ]
@@ -0,0 +1,220 @@
+"""
+Wall-clock timeouts, resource limits and scheduling priorities for Calibre
+subprocesses, so one pathological input can't spin or swell without bound.
+For use like ::
+
+    set_limits(ResourceLimits(timeout=600, memory_bytes=4 << 30, nice=10))
+    try:
+        convert('huge.pdf', as_ext='epub', limits=ResourceLimits(timeout=60))
+    except CalibreTimeout:
+        quarantine('huge.pdf')
+
+Limits set with :func:`set_limits` apply to every call; those passed to a
+single call override them field by field. CPU time, address space and
+niceness are set by a small wrapper that applies them and then execs the
+tool, as running Python between fork and exec isn't safe in a program with
+threads. Each Calibre process gets a process group of its own, so a
+timeout kills any children it started too.
+Breaches raise :class:`CalibreTimeout` or :class:`ResourceLimitExceeded`.
+
+Calls served by a backend such as :class:`capybre.worker_pool.WorkerPool`
+run inside a long-lived process, and are not subject to these limits.
+"""
+import errno
+import functools
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+from .toolchain import get_toolchain
+
+
+class CalibreTimeout(subprocess.TimeoutExpired):
+    """Raised when a Calibre call runs past its wall-clock timeout
+
+    The whole process group of the call has been killed by the time this
+    is raised.
+    """
+
+
+class ResourceLimitExceeded(subprocess.CalledProcessError):
+    """Raised when a Calibre call is stopped by one of its resource limits
+
+    Attributes:
+        resource (str): ``'cpu'`` or ``'memory'``
+    """
+
+    def __init__(self, resource, returncode, cmd, output=None, stderr=None):
+        super().__init__(returncode, cmd, output, stderr)
+        self.resource = resource
+
+    def __str__(self):
+        return "Command '{}' exceeded its {} limit".format(self.cmd, self.resource)
+
+
+# Printed by Python and C++ code that runs out of address space
+MEMORY_ERROR_MARKERS = (b'MemoryError', b'std::bad_alloc', b'Cannot allocate memory')
+
+IONICE_IDLE = 'idle'
+
+# run as ``python -S -c LIMIT_AND_EXEC nice cpu_seconds memory_bytes program argv...``,
+# argv starting with the tool's own name, and an empty string standing for no limit
+LIMIT_AND_EXEC = (
+    'import os, resource, sys\n'
+    'nice, cpu, memory = (int(value) if value else None for value in sys.argv[1:4])\n'
+    'if nice:\n'
+    '    os.nice(nice)\n'
+    'if cpu is not None:\n'
+    '    # SIGXCPU at the soft limit, SIGKILL a second later\n'
+    '    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))\n'
+    'if memory is not None:\n'
+    '    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))\n'
+    'os.execv(sys.argv[4], sys.argv[5:])\n'
+)
+
+
+class ResourceLimits:
+    """Limits on a Calibre subprocess; fields left as ``None`` are unlimited
+
+    Args:
+        timeout (float, optional): Seconds of wall-clock time before the
+            call's process group is killed
+        cpu_seconds (int, optional): Seconds of CPU time the process may use
+            (``RLIMIT_CPU``)
+        memory_bytes (int, optional): Bytes of address space the process may
+            map (``RLIMIT_AS``). Note this counts reserved as well as
+            resident memory
+        nice (int, optional): Niceness to run at, from 0 to 19
+        ionice (int or str, optional): Best-effort I/O priority from 0
+            (highest) to 7, or ``'idle'``. Needs the ``ionice`` command,
+            and is ignored where it is missing
+    """
+
+    FIELDS = ('timeout', 'cpu_seconds', 'memory_bytes', 'nice', 'ionice')
+
+    def __init__(self, timeout=None, cpu_seconds=None, memory_bytes=None, nice=None, ionice=None):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.nice = nice
+        self.ionice = ionice
+
+    def merged(self, overrides) -> 'ResourceLimits':
+        """These limits with every field set in overrides replaced"""
+        if overrides is None:
+            return self
+        return ResourceLimits(**{
+            field: getattr(overrides, field) if getattr(overrides, field) is not None
+            else getattr(self, field)
+            for field in self.FIELDS
+        })
+
+    def restricts_child(self) -> bool:
+        return any(
+            getattr(self, field) is not None
+            for field in ('cpu_seconds', 'memory_bytes', 'nice')
+        )
+
+    def __repr__(self):
+        return 'ResourceLimits({})'.format(', '.join(
+            '{}={!r}'.format(field, getattr(self, field))
+            for field in self.FIELDS if getattr(self, field) is not None
+        ))
+
+
+_limits = ResourceLimits()
+
+
+def set_limits(limits):
+    """Sets the limits applied to every Calibre call
+
+    Args:
+        limits (ResourceLimits): The new defaults, or ``None`` for none
+    """
+    global _limits
+    _limits = limits or ResourceLimits()
+
+
+def get_limits() -> ResourceLimits:
+    return _limits
+
+
+def effective_limits(limits=None) -> ResourceLimits:
+    """The global limits, overridden by those given for a single call"""
+    return _limits.merged(limits)
+
+
+@functools.lru_cache(maxsize=None)
+def _ionice():
+    return shutil.which('ionice')
+
+
+def command(args, limits):
+    """args, with the tool resolved through :mod:`capybre.toolchain`,
+    wrapped to run under limits and prefixed to run at the requested I/O
+    priority if possible"""
+    args = _limited(get_toolchain().command(args), limits)
+    if limits.ionice is None:
+        return args
+    ionice = _ionice()
+    if ionice is None:
+        return args
+    if limits.ionice == IONICE_IDLE:
+        return [ionice, '-c', '3'] + list(args)
+    return [ionice, '-c', '2', '-n', str(limits.ionice)] + list(args)
+
+
+def _limited(args, limits):
+    """args, run through :data:`LIMIT_AND_EXEC` if the child needs limiting"""
+    if not limits.restricts_child():
+        return args
+    if resource is None:
+        raise Exception('Resource limits are not supported on this platform')
+    program = shutil.which(args[0])
+    if program is None:
+        # as Popen would raise for the tool itself
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), args[0])
+    values = [
+        '' if value is None else str(value)
+        for value in (limits.nice, limits.cpu_seconds, limits.memory_bytes)
+    ]
+    return [sys.executable, '-S', '-c', LIMIT_AND_EXEC] + values + [program] + list(args)
+
+
+def kill_group(pid):
+    """Kills the process group led by pid, i.e. a Calibre call and its children"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def breached(limits, returncode, cpu_time=None, stderr=None):
+    """Which limit, if any, a failed call ran into
+
+    Returns:
+        ``'cpu'``, ``'memory'`` or ``None``
+    """
+    if not returncode:
+        return None
+    if limits.cpu_seconds is not None:
+        if returncode == -getattr(signal, 'SIGXCPU', 0):
+            return 'cpu'
+        if returncode == -signal.SIGKILL and cpu_time is not None and cpu_time >= limits.cpu_seconds:
+            return 'cpu'
+    # a crash without an allocation error is an ordinary failure, not a
+    # sign more memory would help
+    if limits.memory_bytes is not None and stderr:
+        if any(marker in stderr for marker in MEMORY_ERROR_MARKERS):
+            return 'memory'
+    return None
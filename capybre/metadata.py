@@ -5,12 +5,14 @@ ebook files
 ..ebook-meta: https://manual.calibre-ebook.com/generated/en/ebook-meta.html
 """
 
+import io
 import os
 import re
+import sys
 import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
-from .helpers import random_filename, check_output, call
+from .helpers import check_output, call, scratch_directory, write_source
 from .ebook_format import EbookFormat
 
 
@@ -25,6 +27,7 @@ class Metadata():
     Args:
         author (str): Author (Looks like this may be an &-seperated list of
             authors for multi-author works)
+        authors (List[str]): Each of the authors, in order
         author_sort (str): String by which the author should be sorted
         description (str): Paragraph length text
         ebookFormat (EbookFormat): Enum of ebook formats used by Calibre
@@ -37,11 +40,13 @@ class Metadata():
         rating (int): Rating, out of 5?
         series (str): Series that this belongs to
             (possibly including a number indicating rank in the series)
+        series_index (float): Position of this book in the series
         tags (List[str]): List of tags describing the book
         title (str): Title
     """
 
     author:           Optional[str]
+    authors:          Optional[List[str]]
     author_sort:      Optional[str]
     description:      Optional[str]
     ebook_format:     EbookFormat
@@ -53,12 +58,21 @@ class Metadata():
     publisher:        Optional[str]
     rating:           Optional[int]
     series:           Optional[str]
+    series_index:     Optional[float]
     tags:             Optional[List[str]]
     title:            str
 
+    # no per-instance __dict__, as millions of these may be held at once
+    __slots__ = (
+        'author', 'authors', 'author_sort', 'description', 'ebook_format',
+        'identifiers', 'isbn', 'language', 'last_edited', 'publication_date',
+        'publisher', 'rating', 'series', 'series_index', 'tags', 'title',
+    )
+
     def __init__(
         self,
         author=None,
+        authors=None,
         author_sort=None,
         description=None,
         ebook_format=EbookFormat.UNKNOWN,
@@ -70,10 +84,12 @@ class Metadata():
         publisher=None,
         rating=None,
         series=None,
+        series_index=None,
         tags=None,
         title=None
     ):
         self.author = author
+        self.authors = authors
         self.author_sort = author_sort
         self.description = description
         self.ebook_format = ebook_format
@@ -85,9 +101,51 @@ class Metadata():
         self.publisher = publisher
         self.rating = rating
         self.series = series
+        self.series_index = series_index
         self.tags = tags
         self.title = title
 
+    def to_dict(self):
+        """JSON-compatible dict of the fields, with dates as ISO 8601 strings
+        and the ebook format by name"""
+        result = {}
+        for field in METADATA_FIELDS:
+            value = getattr(self, field)
+            if isinstance(value, datetime.date):
+                value = value.isoformat()
+            elif field == 'ebook_format':
+                value = EbookFormat(value).name
+            result[field] = value
+        return result
+
+    @staticmethod
+    def from_dict(values):
+        """Inverse of :meth:`to_dict`"""
+        values = dict(values)
+        for field in DATE_FIELDS:
+            if values.get(field):
+                values[field] = parse_iso_date(values[field])
+        if 'ebook_format' in values:
+            values['ebook_format'] = EbookFormat[values['ebook_format']]
+        return Metadata(**{k: v for k, v in values.items() if k in METADATA_FIELDS})
+
+
+METADATA_FIELDS = tuple(Metadata.__annotations__)
+DATE_FIELDS = ('last_edited', 'publication_date')
+
+
+def parse_iso_date(value):
+    """Parses an ISO 8601 date, or datetime with optional UTC offset"""
+    if len(value) <= 10:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if hasattr(datetime.datetime, 'fromisoformat'):
+        return datetime.datetime.fromisoformat(value)
+    # Python 3.6 can't parse a colon in the UTC offset
+    if value[-3:-2] == ':':
+        value = value[:-3] + value[-2:]
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
 
 TITLE = 'Title'
 AUTHOR = 'Author(s)'
@@ -104,32 +162,86 @@ LAST_EDITED = 'Timestamp'
 
 CALIBRE_AUTHOR_RE = re.compile("(.+)\\[(.+)\\]")
 CALIBRE_ISBN_RE = re.compile('isbn:(.+)')
+CALIBRE_SERIES_RE = re.compile('(.+) #([0-9.]+)$')
 
 
-def extract_metadata(input_file) -> Metadata:
+def extract_metadata(input_file, cache=None, native=True, opf=False, limits=None) -> Metadata:
     """Extracts metadata from an ebook into the standardized :class:`Metadata` format
 
     Args:
         input_file (str): path to the input file
+        cache (MetadataCache, optional): Cache to serve the metadata from,
+            see :class:`capybre.metadata_cache.MetadataCache`
+        native (bool, optional): Read EPUBs directly rather than through
+            ``ebook-meta`` where possible, see :mod:`capybre.epub`.
+            Defaults to ``True``
+        opf (bool, optional): Have ``ebook-meta`` write an OPF document and
+            parse that instead of its text output, see :mod:`capybre.opf`.
+            This keeps timezones and is immune to wrapped or over-long
+            fields, but bypasses the cache and the native EPUB reader.
+            Defaults to ``False``
+        limits (ResourceLimits, optional): Limits for the ebook-meta call,
+            overriding the global ones, see :mod:`capybre.limits`
     Returns:
         :class:`Metadata` object
     """
-    metadata = clean_metadata_map(extract_metadata_map(input_file))
+    if opf:
+        metadata = extract_opf_metadata(input_file, limits)
+    else:
+        metadata = clean_metadata_map(extract_metadata_map(input_file, cache, native, limits))
     metadata.ebook_format = EbookFormat.from_filename(input_file)
     return metadata
 
 
-def extract_metadata_map(input_file: str):
+def extract_metadata_map(input_file: str, cache=None, native=True, limits=None):
     """Extracts metadata from an ebook via an ``ebook-meta`` call, returning a dict
 
     Args:
         input_file (str): path to the input file
+        cache (MetadataCache, optional): Cache to serve the metadata from,
+            see :class:`capybre.metadata_cache.MetadataCache`
+        native (bool, optional): Read EPUBs directly rather than through
+            ``ebook-meta`` where possible, see :mod:`capybre.epub`.
+            Defaults to ``True``
+        limits (ResourceLimits, optional): Limits for the ebook-meta call,
+            overriding the global ones, see :mod:`capybre.limits`
     Returns:
         Dict mapping between metadata keys and values as directly output from
             the ebook-meta call
     """
-    raw_metadata = check_output(['ebook-meta', input_file])
-    return extract_raw_metadata_map(raw_metadata)
+    if cache is not None:
+        metadata_map = cache.get(input_file)
+        if metadata_map is not None:
+            return metadata_map
+    metadata_map = None
+    if native and EbookFormat.from_filename(input_file) == EbookFormat.EPUB:
+        # imported here as the EPUB reader builds on this module
+        from .epub import read_metadata_map
+        metadata_map = read_metadata_map(input_file)
+    if metadata_map is None:
+        raw_metadata = check_output(['ebook-meta', input_file], limits)
+        metadata_map = extract_raw_metadata_map(raw_metadata)
+    if cache is not None:
+        cache.put(input_file, metadata_map)
+    return metadata_map
+
+
+def extract_opf_metadata(input_file, limits=None) -> Metadata:
+    """Extracts metadata from an ebook via the OPF document ``ebook-meta`` writes
+
+    Args:
+        input_file (str): path to the input file
+        limits (ResourceLimits, optional): Limits for the ebook-meta call,
+            overriding the global ones, see :mod:`capybre.limits`
+    Returns:
+        :class:`Metadata` object, without its ebook_format set
+    """
+    # imported here as the OPF parser builds on this module
+    from .opf import parse_opf
+    with scratch_directory() as directory:
+        opf_file = os.path.join(directory, 'metadata.opf')
+        call(['ebook-meta', input_file, '--to-opf', opf_file], check=True, limits=limits)
+        return parse_opf(opf_file)
 
 
 def extract_raw_metadata_map(raw_metadata: List[str]):
@@ -148,13 +260,12 @@ def extract_raw_metadata_map(raw_metadata: List[str]):
         # (as seems to happen often in the description)
         if len(line.strip()) > 20 and line[20] == ':':
             key, _, value = line.partition(':')
-            metadata_lines.append((key.strip(), value))
+            metadata_lines.append((key.strip(), [value]))
         elif len(metadata_lines) > 0:
             # append to the end of the previous line
-            (key, value) = metadata_lines[-1]
-            metadata_lines[-1] = (key, value + ' ' + line)
+            metadata_lines[-1][1].append(line)
 
-    return {key.strip(): value.strip() for key, value in metadata_lines}
+    return {key: ' '.join(parts).strip() for key, parts in metadata_lines}
 
 
 def clean_metadata_map(metadata_map):
@@ -166,6 +277,7 @@ def clean_metadata_map(metadata_map):
         :class:`Metadata` object
     """
     author, author_sort = get_author_and_sort(metadata_map)
+    authors = [a.strip() for a in author.split(' & ')] if author else None
     description = get_string(metadata_map, DESCRIPTION)
     identifiers, isbn = get_identifiers_and_isbn(metadata_map)
     language = get_string(metadata_map, LANGUAGE)
@@ -174,11 +286,13 @@ def clean_metadata_map(metadata_map):
     publisher = get_string(metadata_map, PUBLISHER)
     rating = get_rating(metadata_map)
     series = get_string(metadata_map, SERIES)
+    series_index = get_series_index(series)
     tags = get_tags(metadata_map)
     title = get_string(metadata_map, TITLE)
 
     return Metadata(
         author=author,
+        authors=authors,
         author_sort=author_sort,
         description=description,
         identifiers=identifiers,
@@ -189,6 +303,7 @@ def clean_metadata_map(metadata_map):
         publisher=publisher,
         rating=rating,
         series=series,
+        series_index=series_index,
         tags=tags,
         title=title,
     )
@@ -197,7 +312,9 @@ def clean_metadata_map(metadata_map):
 def extract_cover(
     input_file: str,
     output_file: str = 'cover.jpg',
-    suppress_output=True
+    suppress_output=True,
+    native=True,
+    limits=None
 ):
     """Extracts the cover image from the given ebook, and saves it in the output file
 
@@ -207,10 +324,60 @@ def extract_cover(
             defaults to 'cover.jpg'
         suppress_output (bool, optional): Suppresses stdout from ebook-convert
             call (typically dozens of lines). Defaults to ``True``
+        native (bool, optional): Copy EPUB covers straight out of the archive
+            rather than through ``ebook-meta`` where possible. Defaults to
+            ``True``
+        limits (ResourceLimits, optional): Limits for the ebook-meta call,
+            overriding the global ones, see :mod:`capybre.limits`
+
+
+    """
+    if native and EbookFormat.from_filename(input_file) == EbookFormat.EPUB:
+        from .epub import read_cover
+        cover = read_cover(input_file)
+        if cover is not None:
+            with open(output_file, 'wb') as f:
+                f.write(cover)
+            return
+    call(['ebook-meta', input_file, '--get-cover', output_file], suppress_output, limits=limits)
+
 
+def extract_cover_bytes(source, input_ext, native=True) -> Optional[bytes]:
+    """Extracts the cover image from an in-memory ebook
 
+    EPUB covers are read straight from the archive in memory; other formats
+    pass through a private scratch directory on a RAM-backed filesystem
+    (``/dev/shm``) where one is available, removed before returning.
+
+    Args:
+        source (bytes or file): the ebook, as bytes or a binary file object
+        input_ext (str): extension of the ebook's format, e.g. ``epub``
+        native (bool, optional): Read EPUB covers without ``ebook-meta``
+            where possible. Defaults to ``True``
+    Returns:
+        The cover image's bytes, or ``None`` if the ebook has no cover
     """
-    call(['ebook-meta', input_file, '--get-cover', output_file], suppress_output)
+    if native and EbookFormat.from_ext(input_ext) == EbookFormat.EPUB:
+        from .epub import read_cover
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        elif not source.seekable():
+            # zip archives need random access
+            source = io.BytesIO(source.read())
+        start = source.tell()
+        cover = read_cover(source)
+        if cover is not None:
+            return cover
+        source.seek(start)
+    with scratch_directory() as directory:
+        input_file = os.path.join(directory, 'input.' + input_ext)
+        output_file = os.path.join(directory, 'cover.jpg')
+        write_source(source, input_file)
+        call(['ebook-meta', input_file, '--get-cover', output_file])
+        if not os.path.isfile(output_file):
+            return None
+        with open(output_file, 'rb') as f:
+            return f.read()
 
 
 class extracted_cover_fileobj:
@@ -235,21 +402,163 @@ class extracted_cover_fileobj:
     def __init__(self, input_file, suppress_output=True):
         self.input_file: str = input_file
         self.fp = None
-        self.output_file = None
+        self.scratch = scratch_directory()
         self.suppress_output = suppress_output
 
     def __enter__(self):
-        # make random new file
-        self.output_file = random_filename('jpg')
-        extract_cover(self.input_file, self.output_file, self.suppress_output)
-        self.fp = open(self.output_file, 'rb')
+        output_file = os.path.join(self.scratch.__enter__(), 'cover.jpg')
+        try:
+            extract_cover(self.input_file, output_file, self.suppress_output)
+            self.fp = open(output_file, 'rb')
+        except BaseException:
+            self.scratch.__exit__(*sys.exc_info())
+            raise
         return self.fp
 
     def __exit__(self, type, value, traceback):
         if self.fp:
             self.fp.close()
-        if self.output_file:
-            os.remove(self.output_file)
+        self.scratch.__exit__(type, value, traceback)
+
+
+def extract_metadata_and_cover(
+    input_file,
+    cover_file=None,
+    cache=None,
+    native=True,
+    opf=False,
+    limits=None
+) -> Tuple[Metadata, Optional[bytes]]:
+    """Extracts the metadata and cover image of an ebook with a single ``ebook-meta`` call
+
+    Equivalent to :func:`extract_metadata` followed by
+    :func:`extract_cover`, but ``ebook-meta`` only has to start and open the
+    book once, as it can print the metadata and write the cover in the same
+    run. EPUBs are read without any subprocess where possible.
+
+    Args:
+        input_file (str): path to the input file
+        cover_file (str, optional): path to also save the cover image to
+        cache (MetadataCache, optional): Cache to serve the metadata from,
+            see :class:`capybre.metadata_cache.MetadataCache`. On a hit,
+            only the cover is extracted
+        native (bool, optional): Read EPUBs directly rather than through
+            ``ebook-meta`` where possible, see :mod:`capybre.epub`.
+            Defaults to ``True``
+        opf (bool, optional): Read the metadata from the OPF document
+            ``ebook-meta`` writes, as with :func:`extract_metadata`.
+            Defaults to ``False``
+        limits (ResourceLimits, optional): Limits for the ebook-meta call,
+            overriding the global ones, see :mod:`capybre.limits`
+    Returns:
+        ``(metadata, cover)``: a :class:`Metadata` object, and the cover
+            image's bytes or ``None`` if the ebook has no cover
+    Raises:
+        subprocess.CalledProcessError: if ebook-meta exits unsuccessfully
+    """
+    metadata_map = cache.get(input_file) if cache is not None and not opf else None
+    cover = None
+    if metadata_map is not None:
+        cover = _extract_cover_only(input_file, native, limits)
+    else:
+        metadata_map, cover = _extract_both(input_file, native, opf, limits)
+        if cache is not None and not opf:
+            cache.put(input_file, metadata_map)
+
+    if isinstance(metadata_map, Metadata):
+        metadata = metadata_map
+    else:
+        metadata = clean_metadata_map(metadata_map)
+    metadata.ebook_format = EbookFormat.from_filename(input_file)
+    if cover is not None and cover_file is not None:
+        with open(cover_file, 'wb') as f:
+            f.write(cover)
+    return metadata, cover
+
+
+def _extract_cover_only(input_file, native, limits):
+    with scratch_directory() as directory:
+        output_file = os.path.join(directory, 'cover.jpg')
+        extract_cover(input_file, output_file, native=native, limits=limits)
+        return _read_if_present(output_file)
+
+
+def _extract_both(input_file, native, opf, limits):
+    """The raw metadata map (or, with opf, the Metadata) and the cover bytes"""
+    if native and not opf and EbookFormat.from_filename(input_file) == EbookFormat.EPUB:
+        from .epub import read_metadata_map_and_cover
+        both = read_metadata_map_and_cover(input_file)
+        # without a cover in the OPF, ebook-meta may still find or render one
+        if both is not None and both[1] is not None:
+            return both
+    with scratch_directory() as directory:
+        cover_file = os.path.join(directory, 'cover.jpg')
+        args = ['ebook-meta', input_file, '--get-cover', cover_file]
+        if opf:
+            from .opf import parse_opf
+            opf_file = os.path.join(directory, 'metadata.opf')
+            call(args + ['--to-opf', opf_file], check=True, limits=limits)
+            metadata_map = parse_opf(opf_file)
+        else:
+            raw_metadata = check_output(args, limits)
+            # ebook-meta also reports where it saved the cover
+            metadata_map = extract_raw_metadata_map(
+                line for line in raw_metadata if not line.rstrip().endswith(cover_file)
+            )
+        return metadata_map, _read_if_present(cover_file)
+
+
+def _read_if_present(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class extracted_metadata_and_cover:
+    """Extracts the metadata and cover image inside a context, with one ``ebook-meta`` call
+
+    The cover is presented as a file object, or ``None`` if the ebook has
+    no cover, and is deleted on exit. For use like ::
+
+        with extracted_metadata_and_cover('original.epub') as (metadata, cover):
+            upload(cover, metadata)
+
+    Accepts the same arguments as :func:`extract_metadata_and_cover`,
+    besides cover_file.
+    """
+
+    def __init__(self, input_file, cache=None, native=True, opf=False, limits=None):
+        self.input_file = input_file
+        self.cache = cache
+        self.native = native
+        self.opf = opf
+        self.limits = limits
+        self.fp = None
+        self.scratch = scratch_directory()
+
+    def __enter__(self):
+        cover_file = os.path.join(self.scratch.__enter__(), 'cover.jpg')
+        try:
+            metadata, cover = extract_metadata_and_cover(
+                self.input_file,
+                cover_file,
+                self.cache,
+                self.native,
+                self.opf,
+                self.limits
+            )
+            if cover is not None:
+                self.fp = open(cover_file, 'rb')
+        except BaseException:
+            self.scratch.__exit__(*sys.exc_info())
+            raise
+        return metadata, self.fp
+
+    def __exit__(self, type, value, traceback):
+        if self.fp:
+            self.fp.close()
+        self.scratch.__exit__(type, value, traceback)
 
 
 """
@@ -314,6 +623,17 @@ def get_date(mmap, key):
     return None
 
 
+def get_series_index(series):
+    if series:
+        match = CALIBRE_SERIES_RE.match(series)
+        if match:
+            try:
+                return float(match[2])
+            except ValueError:
+                return None
+    return None
+
+
 def get_rating(mmap):
     if RATING in mmap:
         try:
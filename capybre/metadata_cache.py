@@ -0,0 +1,128 @@
+"""
+A persistent cache of ``ebook-meta`` results, so that extracting metadata
+from a file that hasn't changed skips the subprocess entirely. For use
+like ::
+
+    cache = MetadataCache('/var/cache/capybre/metadata.db')
+    metadata = extract_metadata('PrideAndPrejudice.epub', cache=cache)
+
+Files are identified by their path, inode, size and modification time, and
+optionally also by a hash of their contents. Results are kept in a SQLite
+database in WAL mode, so one cache can be shared by several processes on
+the same host.
+"""
+import json
+import os
+import threading
+
+from .helpers import file_digest, SQLiteConnections
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    path         TEXT PRIMARY KEY,
+    inode        INTEGER NOT NULL,
+    size         INTEGER NOT NULL,
+    mtime_ns     INTEGER NOT NULL,
+    digest       TEXT,
+    metadata_map TEXT NOT NULL
+);
+'''
+
+
+class MetadataCache:
+    """SQLite-backed cache of raw metadata maps
+
+    Args:
+        path (str): Path to the SQLite database, created if needed
+        verify_hash (bool, optional): Also compare a SHA-256 of the file's
+            contents before serving a hit. This catches files rewritten
+            without changing size or mtime, and lets a file that was only
+            touched still hit. Costs a full read of the file per lookup.
+            Defaults to ``False``
+    """
+
+    def __init__(self, path, verify_hash=False):
+        self.path = path
+        self.verify_hash = verify_hash
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connections = SQLiteConnections(path, SCHEMA)
+
+    def _identity(self, input_file):
+        stat = os.stat(input_file)
+        return os.path.realpath(input_file), stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, input_file):
+        """Cached metadata map for input_file, or ``None`` if missing or stale"""
+        path, inode, size, mtime_ns = self._identity(input_file)
+        row = self._connections.get().execute(
+            'SELECT inode, size, mtime_ns, digest, metadata_map FROM metadata WHERE path = ?',
+            (path,)
+        ).fetchone()
+        if row is None:
+            self._count(False)
+            return None
+        unchanged = tuple(row[:3]) == (inode, size, mtime_ns)
+        if self.verify_hash:
+            digest = file_digest(input_file)
+            if row[3] != digest:
+                self._count(False)
+                return None
+            if not unchanged:
+                self._connections.get().execute(
+                    'UPDATE metadata SET inode = ?, size = ?, mtime_ns = ? WHERE path = ?',
+                    (inode, size, mtime_ns, path)
+                )
+        elif not unchanged:
+            self._count(False)
+            return None
+        self._count(True)
+        return json.loads(row[4])
+
+    def put(self, input_file, metadata_map):
+        """Stores the metadata map extracted from input_file"""
+        path, inode, size, mtime_ns = self._identity(input_file)
+        digest = file_digest(input_file) if self.verify_hash else None
+        self._connections.get().execute(
+            'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)',
+            (path, inode, size, mtime_ns, digest, json.dumps(metadata_map))
+        )
+
+    def invalidate(self, input_file=None):
+        """Drops the entry for input_file, or every entry if it isn't given"""
+        connection = self._connections.get()
+        if input_file is None:
+            connection.execute('DELETE FROM metadata')
+        else:
+            connection.execute(
+                'DELETE FROM metadata WHERE path = ?',
+                (os.path.realpath(input_file),)
+            )
+
+    def stats(self):
+        """Lookup statistics for this cache object
+
+        Returns:
+            Dict with the ``hits`` and ``misses`` seen by this object, the
+            resulting ``hit_rate`` (``None`` before any lookup) and the
+            number of ``entries`` in the database
+        """
+        entries = self._connections.get().execute(
+            'SELECT COUNT(*) FROM metadata'
+        ).fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': entries,
+            }
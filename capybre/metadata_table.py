@@ -0,0 +1,310 @@
+"""
+A column-oriented store of :class:`capybre.metadata.Metadata` records, for
+holding metadata about millions of books at once (for deduplication or
+reporting, say) without the cost of millions of objects. For use like ::
+
+    table = MetadataTable()
+    table.extend(index_of_books)
+    duplicates = {
+        isbn: rows for isbn, rows in table.group_by('isbn').items()
+        if isbn is not None and len(rows) > 1
+    }
+    with open('books.jsonl', 'w') as f:
+        table.to_jsonl(f)
+
+Each field is a column backed by an :mod:`array`. Strings are interned into
+one dictionary shared by every column and stored as ``int32`` indices,
+dates as ``int64`` seconds since the epoch, and the list-valued tags,
+authors and identifiers as offsets into a flat array of indices, the same
+layout Arrow uses for list columns. :meth:`MetadataTable.buffers` exposes
+these arrays without copying, for wrapping with ``numpy.frombuffer`` or
+``pyarrow.py_buffer``.
+
+Rows come back out as :class:`Metadata` objects, with two losses: empty
+lists read back as ``None``, and datetimes read back in UTC.
+"""
+import datetime
+import json
+import math
+from array import array
+from typing import Callable, Dict, Iterable, List, Union
+
+from .ebook_format import EbookFormat
+from .metadata import Metadata, METADATA_FIELDS
+
+STRING_FIELDS = (
+    'author', 'author_sort', 'description', 'isbn', 'language',
+    'publisher', 'series', 'title',
+)
+LIST_FIELDS = ('authors', 'tags')
+DATE_FIELDS = ('last_edited', 'publication_date')
+
+# also the value NumPy reads as NaT in a datetime64 array
+MISSING_DATE = -(1 << 63)
+MISSING_STRING = -1
+MISSING_RATING = -1
+
+# kinds of value stored in a date column
+_NONE, _DATE, _DATETIME = 0, 1, 2
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _to_seconds(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int((value - EPOCH).total_seconds()), _DATETIME
+    days = value.toordinal() - EPOCH.date().toordinal()
+    return days * 86400, _DATE
+
+
+def _from_seconds(seconds, kind):
+    if kind == _NONE:
+        return None
+    value = EPOCH + datetime.timedelta(seconds=seconds)
+    return value.date() if kind == _DATE else value
+
+
+class _OffsetColumn:
+    """A list-valued column: row i holds values[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, typecode='i'):
+        self.offsets = array('i', [0])
+        self.values = array(typecode)
+
+    def append(self, values):
+        if values:
+            self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+    def row(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+class MetadataTable:
+    """Column-wise, memory-lean table of :class:`Metadata` records
+
+    Args:
+        records (Iterable[Metadata], optional): Records to start with
+    """
+
+    def __init__(self, records=()):
+        self.strings = []
+        self._string_ids = {}
+        self._length = 0
+        self._strings = {field: array('i') for field in STRING_FIELDS}
+        self._lists = {field: _OffsetColumn() for field in LIST_FIELDS}
+        self._identifiers = _OffsetColumn()
+        self._identifier_values = array('i')
+        self._dates = {field: array('q') for field in DATE_FIELDS}
+        self._date_kinds = {field: bytearray() for field in DATE_FIELDS}
+        self._ebook_format = array('b')
+        self._rating = array('b')
+        self._series_index = array('d')
+        self.extend(records)
+
+    def _intern(self, value) -> int:
+        if value is None:
+            return MISSING_STRING
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self._string_ids[value] = string_id
+            self.strings.append(value)
+        return string_id
+
+    def _string(self, string_id):
+        return None if string_id == MISSING_STRING else self.strings[string_id]
+
+    def append(self, metadata: Metadata):
+        """Adds a record to the end of the table"""
+        for field in STRING_FIELDS:
+            self._strings[field].append(self._intern(getattr(metadata, field)))
+        for field in LIST_FIELDS:
+            values = getattr(metadata, field)
+            self._lists[field].append([self._intern(v) for v in values or ()])
+        identifiers = metadata.identifiers or {}
+        self._identifiers.append([self._intern(k) for k in identifiers])
+        self._identifier_values.extend(self._intern(v) for v in identifiers.values())
+        for field in DATE_FIELDS:
+            value = getattr(metadata, field)
+            if value is None:
+                seconds, kind = MISSING_DATE, _NONE
+            else:
+                seconds, kind = _to_seconds(value)
+            self._dates[field].append(seconds)
+            self._date_kinds[field].append(kind)
+        self._ebook_format.append(int(metadata.ebook_format))
+        self._rating.append(MISSING_RATING if metadata.rating is None else metadata.rating)
+        self._series_index.append(
+            math.nan if metadata.series_index is None else metadata.series_index
+        )
+        self._length += 1
+
+    def extend(self, records: Iterable[Metadata]):
+        """Adds several records to the end of the table"""
+        for metadata in records:
+            self.append(metadata)
+
+    def __len__(self):
+        return self._length
+
+    def value(self, i, field):
+        """The value of one field of row i, without building the whole row"""
+        if field in STRING_FIELDS:
+            return self._string(self._strings[field][i])
+        if field in LIST_FIELDS:
+            return [self.strings[s] for s in self._lists[field].row(i)] or None
+        if field == 'identifiers':
+            start, end = self._identifiers.offsets[i], self._identifiers.offsets[i + 1]
+            return {
+                self.strings[k]: self.strings[v]
+                for k, v in zip(self._identifiers.values[start:end], self._identifier_values[start:end])
+            } or None
+        if field in DATE_FIELDS:
+            return _from_seconds(self._dates[field][i], self._date_kinds[field][i])
+        if field == 'ebook_format':
+            return EbookFormat(self._ebook_format[i])
+        if field == 'rating':
+            rating = self._rating[i]
+            return None if rating == MISSING_RATING else rating
+        if field == 'series_index':
+            index = self._series_index[i]
+            return None if math.isnan(index) else index
+        raise Exception('Unknown field {}'.format(field))
+
+    def __getitem__(self, i) -> Metadata:
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('MetadataTable index out of range')
+        return Metadata(**{field: self.value(i, field) for field in METADATA_FIELDS})
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self[i]
+
+    def column(self, field) -> list:
+        """Every value of one field, in row order"""
+        return [self.value(i, field) for i in range(self._length)]
+
+    def where(self, field, match: Union[object, Callable[[object], bool]]) -> List[int]:
+        """Indices of the rows whose field matches
+
+        For string fields, the test is run once per distinct string rather
+        than once per row, so filtering is a scan of an integer array. For
+        tags and authors, a row matches if any of its values does.
+        Predicates are only called on present values; pass ``None`` to find
+        the rows missing a string field.
+
+        Args:
+            field (str): Name of a :class:`Metadata` field
+            match: Value the field must equal, or a predicate it must satisfy
+        Returns:
+            List of row indices, in order
+        """
+        predicate = match if callable(match) else (lambda value: value == match)
+        if field in STRING_FIELDS or field in LIST_FIELDS:
+            matching = {i for i, string in enumerate(self.strings) if predicate(string)}
+            if field in STRING_FIELDS:
+                if match is None:
+                    matching.add(MISSING_STRING)
+                return [i for i, s in enumerate(self._strings[field]) if s in matching]
+            column = self._lists[field]
+            return [
+                i for i in range(self._length)
+                if any(s in matching for s in column.row(i))
+            ]
+        return [i for i in range(self._length) if predicate(self.value(i, field))]
+
+    def group_by(self, field) -> Dict[object, List[int]]:
+        """Row indices grouped by the value of a string, date, rating,
+        series index or format field"""
+        if field in LIST_FIELDS or field == 'identifiers':
+            raise Exception('Cannot group by list-valued field {}'.format(field))
+        if field in STRING_FIELDS:
+            groups = {}
+            for i, string_id in enumerate(self._strings[field]):
+                groups.setdefault(string_id, []).append(i)
+            return {self._string(string_id): rows for string_id, rows in groups.items()}
+        groups = {}
+        for i in range(self._length):
+            groups.setdefault(self.value(i, field), []).append(i)
+        return groups
+
+    def take(self, indices: Iterable[int]) -> 'MetadataTable':
+        """A new table holding the given rows, e.g. the result of :meth:`where`"""
+        return MetadataTable(self[i] for i in indices)
+
+    def buffers(self) -> Dict[str, memoryview]:
+        """Zero-copy views of the column arrays
+
+        Keys are ``<field>`` for single-valued fields and
+        ``<field>.offsets``/``<field>.values`` for list-valued ones, plus
+        ``identifiers.keys``/``identifiers.values``. String columns hold
+        ``int32`` indices into :attr:`strings`, with ``-1`` for missing;
+        dates are ``int64`` seconds since the epoch in UTC, missing ones
+        being ``NaT`` to NumPy; ratings are ``int8`` with ``-1`` for
+        missing, and series indices ``float64`` with ``NaN`` for missing.
+        For use like ``numpy.frombuffer(buffers['publication_date'],
+        dtype='datetime64[s]')``.
+
+        The views pin the arrays, so the table can't be appended to while
+        any are alive.
+        """
+        buffers = {}
+        for field in STRING_FIELDS:
+            buffers[field] = memoryview(self._strings[field])
+        for field in LIST_FIELDS:
+            buffers[field + '.offsets'] = memoryview(self._lists[field].offsets)
+            buffers[field + '.values'] = memoryview(self._lists[field].values)
+        buffers['identifiers.offsets'] = memoryview(self._identifiers.offsets)
+        buffers['identifiers.keys'] = memoryview(self._identifiers.values)
+        buffers['identifiers.values'] = memoryview(self._identifier_values)
+        for field in DATE_FIELDS:
+            buffers[field] = memoryview(self._dates[field])
+        buffers['ebook_format'] = memoryview(self._ebook_format)
+        buffers['rating'] = memoryview(self._rating)
+        buffers['series_index'] = memoryview(self._series_index)
+        return buffers
+
+    def to_jsonl(self, output):
+        """Writes each row as a line of JSON, in :meth:`Metadata.to_dict` form
+
+        Each distinct string is JSON-encoded once, and lines are assembled
+        from the encoded pieces, so no per-row objects are built.
+
+        Args:
+            output (file): Text file object to write to
+        """
+        encoded = [json.dumps(s) for s in self.strings]
+        formats = {f: json.dumps(f.name) for f in EbookFormat}
+        keys = {field: json.dumps(field) + ': ' for field in METADATA_FIELDS}
+
+        def string(string_id):
+            return 'null' if string_id == MISSING_STRING else encoded[string_id]
+
+        for i in range(self._length):
+            parts = []
+            for field in METADATA_FIELDS:
+                if field in STRING_FIELDS:
+                    value = string(self._strings[field][i])
+                elif field in LIST_FIELDS:
+                    values = self._lists[field].row(i)
+                    value = '[{}]'.format(', '.join(encoded[s] for s in values)) if values else 'null'
+                elif field == 'identifiers':
+                    start, end = self._identifiers.offsets[i], self._identifiers.offsets[i + 1]
+                    value = '{{{}}}'.format(', '.join(
+                        '{}: {}'.format(encoded[k], encoded[v])
+                        for k, v in zip(self._identifiers.values[start:end], self._identifier_values[start:end])
+                    )) if end > start else 'null'
+                elif field in DATE_FIELDS:
+                    date = self.value(i, field)
+                    value = 'null' if date is None else '"{}"'.format(date.isoformat())
+                elif field == 'ebook_format':
+                    value = formats[self._ebook_format[i]]
+                else:
+                    value = json.dumps(self.value(i, field))
+                parts.append(keys[field] + value)
+            output.write('{{{}}}\n'.format(', '.join(parts)))
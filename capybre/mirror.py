@@ -0,0 +1,323 @@
+"""
+Keeps a converted copy of a library in sync with it, converting only what
+changed. For use like ::
+
+    report = sync_converted('/mnt/library', '/mnt/kindle', as_ext='mobi')
+    for output_file, error in report.failed.items():
+        log(output_file, error)
+
+    # or, to see what a sync would do without doing it
+    plan = plan_sync('/mnt/library', '/mnt/kindle', as_ext='mobi')
+    print(len(plan.convert), 'to convert,', len(plan.delete), 'to delete')
+
+Each ebook under the source directory is mirrored at the same relative
+path under the destination, with the new format's extension. A manifest
+in the destination (``.capybre-mirror.json``) records the source each
+output was converted from, that source's size, modification time and
+digest, and the options it was converted with. An output is reconverted
+when it's missing, its options changed, or its source's size or
+modification time changed and its contents did too, so syncing an
+unchanged library costs a ``stat`` per file and converts nothing.
+
+Outputs whose source is gone are deleted. Only files the manifest records
+are ever deleted, so anything else kept in the destination is left alone.
+Outputs are written beside their final path and renamed into place, and a
+conversion that fails leaves the previous output, and its manifest entry,
+as they were, so it's retried by the next sync.
+"""
+import json
+import os
+import tempfile
+
+from .convert import convert
+from .ebook_format import EbookFormat
+from .helpers import bounded_map, file_digest
+from .library import walk_ebooks
+from .profiles import get_profile, profile_args
+
+MANIFEST_NAME = '.capybre-mirror.json'
+MANIFEST_VERSION = 1
+
+MISSING = 'missing'
+CHANGED = 'changed'
+OPTIONS = 'options'
+
+# conversions between saves of the manifest, so an interrupted sync keeps its progress
+SAVE_EVERY = 50
+
+
+class SyncPlan:
+    """What :func:`sync_converted` would do to bring a mirror up to date
+
+    Args:
+        convert (List[Tuple[str, str, str]]): ``(source, output, reason)``
+            for each output to (re)convert, where reason is ``'missing'``,
+            ``'changed'`` or ``'options'``
+        delete (List[str]): Outputs whose source is gone
+        unchanged (int): Number of outputs already up to date
+        conflicts (List[str]): Sources skipped because another source
+            mirrors to the same output
+    """
+
+    def __init__(self, convert, delete, unchanged, conflicts):
+        self.convert = convert
+        self.delete = delete
+        self.unchanged = unchanged
+        self.conflicts = conflicts
+
+    @property
+    def up_to_date(self) -> bool:
+        return not self.convert and not self.delete
+
+    def __repr__(self):
+        return 'SyncPlan(convert={}, delete={}, unchanged={})'.format(
+            len(self.convert), len(self.delete), self.unchanged
+        )
+
+
+class SyncReport:
+    """Outcome of a :func:`sync_converted` run
+
+    Args:
+        plan (SyncPlan): The plan the sync carried out
+        converted (List[str]): Outputs written
+        deleted (List[str]): Outputs removed
+        failed (Dict[str, Exception]): Each output whose conversion failed,
+            with its exception
+        dry_run (bool): Whether the plan was only computed
+    """
+
+    def __init__(self, plan, converted, deleted, failed, dry_run):
+        self.plan = plan
+        self.converted = converted
+        self.deleted = deleted
+        self.failed = failed
+        self.dry_run = dry_run
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+class _Manifest:
+
+    def __init__(self, dst_dir):
+        self.path = os.path.join(dst_dir, MANIFEST_NAME)
+        self.outputs = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                document = json.load(f)
+            if document.get('version') == MANIFEST_VERSION:
+                self.outputs = document['outputs']
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'outputs': self.outputs}, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+def _output_format(as_format, as_ext):
+    if as_ext:
+        as_format = EbookFormat.from_ext(as_ext)
+    if as_format == EbookFormat.UNKNOWN:
+        raise Exception('Please specifiy a real extension')
+    return as_format
+
+
+def _sources(src_dir, dst_dir, output_format, source_formats, max_workers):
+    """Each output's relative path, mapped to its source and the source's stat"""
+    exclude = os.path.join(os.path.abspath(dst_dir), '')
+    if source_formats is not None:
+        source_formats = [
+            fmt if isinstance(fmt, EbookFormat) else EbookFormat.from_ext(fmt) for fmt in source_formats
+        ]
+    outputs = {}
+    conflicts = []
+    root = os.path.abspath(src_dir)
+    for path, size, mtime_ns in sorted(walk_ebooks(root, max_workers)):
+        fmt = EbookFormat.from_filename(path)
+        if path.startswith(exclude) or fmt == output_format:
+            continue
+        if source_formats is not None and fmt not in source_formats:
+            continue
+        relative = os.path.relpath(path, root)
+        output = os.path.splitext(relative)[0] + '.' + output_format.to_ext()
+        if output in outputs:
+            # prefer the source format listed first, else the first path
+            other = outputs[output][0]
+            if source_formats is None or (
+                source_formats.index(fmt) >= source_formats.index(EbookFormat.from_filename(other))
+            ):
+                conflicts.append(relative)
+                continue
+            conflicts.append(other)
+        outputs[output] = (relative, size, mtime_ns)
+    return outputs, conflicts
+
+
+def _plan(src_dir, dst_dir, output_format, profile, source_formats, max_workers, manifest):
+    sources, conflicts = _sources(src_dir, dst_dir, output_format, source_formats, max_workers)
+    to_convert = []
+    unchanged = 0
+    for output, (source, size, mtime_ns) in sources.items():
+        entry = manifest.outputs.get(output)
+        output_file = os.path.join(dst_dir, output)
+        if entry is None or entry['source'] != source or not os.path.exists(output_file):
+            reason = MISSING
+        elif entry['options'] != profile_args(profile, source, output):
+            reason = OPTIONS
+        elif entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+            reason = None
+        elif entry['size'] == size and entry['digest'] == file_digest(os.path.join(src_dir, source)):
+            # touched but not changed: remember the new time so it isn't read again
+            entry['mtime_ns'] = mtime_ns
+            reason = None
+        else:
+            reason = CHANGED
+        if reason is None:
+            unchanged += 1
+        else:
+            to_convert.append((source, output, reason))
+    delete = sorted(output for output in manifest.outputs if output not in sources)
+    return SyncPlan(to_convert, delete, unchanged, sorted(conflicts))
+
+
+def _remove_empty_parents(dst_dir, output):
+    directory = os.path.dirname(output)
+    while directory:
+        try:
+            os.rmdir(os.path.join(dst_dir, directory))
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def plan_sync(
+    src_dir,
+    dst_dir,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None,
+    profile=None,
+    source_formats=None,
+    max_workers=None
+) -> SyncPlan:
+    """Works out what :func:`sync_converted` would convert and delete,
+    without changing anything
+
+    Takes the same arguments as :func:`sync_converted`.
+
+    Returns:
+        :class:`SyncPlan`, with paths relative to src_dir and dst_dir
+    """
+    return sync_converted(
+        src_dir, dst_dir, as_format, as_ext, profile, source_formats,
+        max_workers=max_workers, dry_run=True
+    ).plan
+
+
+def sync_converted(
+    src_dir,
+    dst_dir,
+    as_format=EbookFormat.UNKNOWN,
+    as_ext=None,
+    profile=None,
+    source_formats=None,
+    max_workers=None,
+    dry_run=False,
+    delete=True,
+    suppress_output=True,
+    cache=None,
+    limits=None
+) -> SyncReport:
+    """Brings a converted mirror of src_dir in dst_dir up to date
+
+    Args:
+        src_dir (str): Directory of the library to mirror
+        dst_dir (str): Directory of the mirror, created if needed
+        as_format (EbookFormat, optional): Enum representation of the
+            mirror's format
+        as_ext (str, optional): String representation of the mirror's
+            format, e.g. ``mobi``
+        profile (ConversionProfile or str, optional): Options to convert
+            with, see :mod:`capybre.profiles`. Changing them reconverts
+            every output
+        source_formats (List[EbookFormat or str], optional): Formats to
+            mirror, in order of preference when two sources would mirror to
+            the same output. Defaults to every format but the mirror's
+        max_workers (int, optional): Number of conversions to run at once.
+            Defaults to the number of available cores
+        dry_run (bool, optional): Only work out the plan. Defaults to
+            ``False``
+        delete (bool, optional): Delete outputs whose source is gone.
+            Defaults to ``True``
+        suppress_output (bool, optional): Suppresses stdout from
+            ebook-convert. Defaults to ``True``
+        cache (ConversionCache, optional): Cache to serve conversions from
+        limits (ResourceLimits, optional): Limits for each ebook-convert
+            call, see :mod:`capybre.limits`
+    Returns:
+        :class:`SyncReport`; a failed conversion is reported there rather
+        than raised
+    """
+    output_format = _output_format(as_format, as_ext)
+    profile = get_profile(profile)
+    manifest = _Manifest(dst_dir)
+    plan = _plan(src_dir, dst_dir, output_format, profile, source_formats, max_workers, manifest)
+    if dry_run:
+        return SyncReport(plan, [], [], {}, True)
+
+    deleted = []
+    if delete:
+        for output in plan.delete:
+            try:
+                os.remove(os.path.join(dst_dir, output))
+                _remove_empty_parents(dst_dir, output)
+            except FileNotFoundError:
+                pass
+            del manifest.outputs[output]
+            deleted.append(output)
+
+    def run(job):
+        source, output, _ = job
+        source_file = os.path.join(src_dir, source)
+        output_file = os.path.join(dst_dir, output)
+        stat = os.stat(source_file)
+        digest = file_digest(source_file)
+        directory = os.path.dirname(output_file)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.' + output_format.to_ext(), dir=directory)
+        os.close(fd)
+        try:
+            convert(source_file, tmp, suppress_output=suppress_output, cache=cache, limits=limits, profile=profile)
+            os.replace(tmp, output_file)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return {
+            'source': source,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': digest,
+            'options': profile_args(profile, source, output),
+        }
+
+    converted = []
+    failed = {}
+    for i, ((_, output, _), entry, error) in enumerate(bounded_map(run, plan.convert, max_workers), 1):
+        if error is None:
+            manifest.outputs[output] = entry
+            converted.append(output)
+        else:
+            failed[output] = error
+        if i % SAVE_EVERY == 0:
+            manifest.save()
+    manifest.save()
+    return SyncReport(plan, converted, deleted, failed, False)
@@ -0,0 +1,551 @@
+"""
+Parses OPF package documents, as written by ``ebook-meta --to-opf`` and
+``fetch-ebook-metadata --opf``, into :class:`capybre.metadata.Metadata`,
+and updates the metadata of an OPF from one with :func:`update_opf`.
+
+Unlike the fixed-column text those tools print by default, the OPF keeps
+every author with their sort string, the series index, every identifier and
+the timezone of dates, and doesn't depend on how wide the keys are. The
+document is read in a single streaming pass that stops at the end of the
+``<metadata>`` section, so large manifests are never parsed.
+"""
+import io
+import re
+from typing import Dict, List, Optional
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from .epub import (
+    author_to_author_sort, LANGUAGE_CODES, UnsupportedEpub, _attr, _local, _text
+)
+from .metadata import Metadata, parse_iso_date, CALIBRE_SERIES_RE
+
+DC_FIELDS = (
+    'title', 'creator', 'publisher', 'subject', 'description',
+    'date', 'language', 'identifier', 'rights',
+)
+
+# Calibre writes 0101-01-01 for dates it doesn't know
+UNDEFINED_YEAR = 101
+
+DATE_ONLY_RE = re.compile('^\\d{4}(-\\d{2}(-\\d{2})?)?$')
+
+
+class _Fields:
+    """Everything collected from the metadata section, resolved once the
+    section has been read (EPUB 3 refinements may follow what they refine)"""
+
+    def __init__(self):
+        self.dc = {name: [] for name in DC_FIELDS}
+        self.meta = {}
+        self.refines = {}
+        self.collections = []
+
+    def add(self, element):
+        name = _local(element.tag)
+        if name in self.dc:
+            self.dc[name].append((
+                _text(element),
+                {_local(k): v for k, v in element.attrib.items()},
+            ))
+        elif name == 'meta':
+            refines = _attr(element, 'refines')
+            prop = _attr(element, 'property')
+            if refines and prop:
+                self.refines.setdefault(refines.lstrip('#'), {})[prop] = _text(element)
+            elif _attr(element, 'name'):
+                self.meta.setdefault(_attr(element, 'name'), _attr(element, 'content'))
+            elif prop == 'belongs-to-collection':
+                self.collections.append((_attr(element, 'id'), _text(element)))
+            elif prop:
+                self.meta.setdefault(prop, _text(element))
+
+    def refinement(self, attrs, prop) -> Optional[str]:
+        return self.refines.get(attrs.get('id'), {}).get(prop)
+
+    def first(self, name) -> Optional[str]:
+        for text, _ in self.dc[name]:
+            if text:
+                return text
+        return None
+
+
+def _read(source) -> _Fields:
+    fields = _Fields()
+    depth = 0
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if _local(element.tag) == 'metadata':
+                depth += 1
+            continue
+        if _local(element.tag) == 'metadata':
+            depth -= 1
+            if depth == 0:
+                break
+        elif depth:
+            fields.add(element)
+            element.clear()
+    return fields
+
+
+def _date(value):
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        if DATE_ONLY_RE.match(value):
+            parts = (value.split('-') + ['01', '01'])[:3]
+            value = '-'.join(parts)
+        date = parse_iso_date(value)
+    except ValueError:
+        return None
+    if date.year <= UNDEFINED_YEAR:
+        return None
+    return date
+
+
+def _authors(fields):
+    authors = []
+    sorts = []
+    for name, attrs in fields.dc['creator']:
+        role = attrs.get('role') or fields.refinement(attrs, 'role')
+        if not name or (role and role != 'aut'):
+            continue
+        authors.append(name)
+        sorts.append(
+            attrs.get('file-as') or
+            fields.refinement(attrs, 'file-as') or
+            author_to_author_sort(name)
+        )
+    return authors, sorts
+
+
+def _identifiers(fields) -> Dict[str, str]:
+    identifiers = {}
+    for value, attrs in fields.dc['identifier']:
+        scheme = attrs.get('scheme') or fields.refinement(attrs, 'identifier-type')
+        if not scheme:
+            prefix, _, rest = value.partition(':')
+            if prefix.lower() == 'urn':
+                scheme, _, value = rest.partition(':')
+            elif rest:
+                scheme, value = prefix, rest
+        if not scheme or not value:
+            continue
+        scheme = scheme.lower()
+        if scheme in ('calibre', 'uuid'):
+            continue
+        identifiers.setdefault(scheme, value)
+    return identifiers
+
+
+def _series(fields):
+    series = fields.meta.get('calibre:series')
+    index = fields.meta.get('calibre:series_index')
+    if not series and fields.collections:
+        collection_id, series = fields.collections[0]
+        index = fields.refines.get(collection_id, {}).get('group-position')
+    if not series:
+        return None, None
+    try:
+        index = float(index or 1)
+    except ValueError:
+        index = 1.0
+    return series, index
+
+
+def _rating(fields) -> Optional[int]:
+    rating = fields.meta.get('calibre:rating')
+    if not rating:
+        return None
+    try:
+        # stored out of 10, shown out of 5
+        return int(round(float(rating) / 2))
+    except ValueError:
+        return None
+
+
+def parse_opf(source) -> Metadata:
+    """Parses an OPF package document into a :class:`Metadata` object
+
+    Args:
+        source (str or file): path to, or binary file object of, the OPF
+    Returns:
+        :class:`Metadata` object. Its dates are timezone-aware datetimes
+            when the OPF gives a time, and ``series`` keeps the
+            ``Name #index`` form of the text output
+    """
+    fields = _read(source)
+
+    authors, sorts = _authors(fields)
+    identifiers = _identifiers(fields)
+    series, series_index = _series(fields)
+    if series is not None:
+        series = '{} #{}'.format(
+            series,
+            int(series_index) if series_index.is_integer() else series_index
+        )
+    languages = [text for text, _ in fields.dc['language'] if text]
+    tags = [text for text, _ in fields.dc['subject'] if text]
+
+    publication_date = None
+    for text, attrs in fields.dc['date']:
+        if attrs.get('event') in (None, 'publication') and text:
+            publication_date = _date(text)
+            break
+
+    return Metadata(
+        author=' & '.join(authors) or None,
+        authors=authors or None,
+        author_sort=' & '.join(sorts) or None,
+        description=fields.first('description'),
+        identifiers=identifiers or None,
+        isbn=identifiers.get('isbn'),
+        language=', '.join(languages) or None,
+        last_edited=_date(fields.meta.get('calibre:timestamp')),
+        publication_date=publication_date,
+        publisher=fields.first('publisher'),
+        rating=_rating(fields),
+        series=series,
+        series_index=series_index,
+        tags=tags or None,
+        title=fields.first('title'),
+    )
+
+
+def parse_opf_lines(lines: List[str]) -> Metadata:
+    """Parses an OPF printed to stdout, as returned by
+    :func:`capybre.helpers.check_output`"""
+    return parse_opf(io.BytesIO('\n'.join(lines).encode('utf-8')))
+
+
+OPF_NS = 'http://www.idpf.org/2007/opf'
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+METADATA_START_RE = re.compile(b'<(?:([\\w.-]+):)?metadata(?=[\\s/>])[^>]*>')
+METADATA_END_RE = re.compile(b'</(?:[\\w.-]+:)?metadata\\s*>')
+XML_ENCODING_RE = re.compile(b'^<\\?xml[^>]*encoding=[\'"]([\\w.-]+)[\'"]')
+
+LANGUAGE_TAGS = {code: tag for tag, code in LANGUAGE_CODES.items()}
+
+
+def _dc(name):
+    return '{%s}%s' % (DC_NS, name)
+
+
+def _opf(name):
+    return '{%s}%s' % (OPF_NS, name)
+
+
+class _Rewrite:
+    """The children of an OPF metadata section, with those describing the
+    fields of a :class:`Metadata` replaced"""
+
+    def __init__(self, metadata_element, epub3, unique_identifier):
+        self.children = list(metadata_element)
+        self.epub3 = epub3
+        self.unique_identifier = unique_identifier
+        self.removed_ids = set()
+        self.added = []
+        self.ids = {_attr(e, 'id') for e in self.children if _attr(e, 'id')}
+
+    def remove(self, predicate):
+        kept = []
+        for element in self.children:
+            if predicate(element):
+                if element.get('id'):
+                    self.removed_ids.add(element.get('id'))
+            else:
+                kept.append(element)
+        self.children = kept
+
+    def remove_dc(self, name, predicate=None):
+        self.remove(lambda e: _local(e.tag) == name and e.tag.startswith('{' + DC_NS)
+                    and (predicate is None or predicate(e)))
+
+    def remove_meta(self, *names):
+        self.remove(lambda e: _local(e.tag) == 'meta' and (
+            _attr(e, 'name') in names or _attr(e, 'property') in names
+        ) and not _attr(e, 'refines'))
+
+    def new_id(self, prefix):
+        n = 1
+        while '{}{}'.format(prefix, n) in self.ids:
+            n += 1
+        self.ids.add('{}{}'.format(prefix, n))
+        return '{}{}'.format(prefix, n)
+
+    def add(self, tag, text=None, attrib=None, refines=None):
+        """Adds an element, with any EPUB 3 refinements as (property, value) pairs"""
+        element = ElementTree.Element(tag, attrib or {})
+        element.text = text
+        self.added.append(element)
+        if refines:
+            element.set('id', self.new_id(_local(tag)))
+            for prop, value in refines:
+                self.add_meta(property=prop, refines='#' + element.get('id'), text=value)
+        return element
+
+    def add_meta(self, name=None, content=None, property=None, refines=None, text=None):
+        attrib = {}
+        if name is not None:
+            attrib = {'name': name, 'content': content}
+        else:
+            if refines:
+                attrib['refines'] = refines
+            attrib['property'] = property
+        self.add(_opf('meta'), text, attrib)
+
+    def finish(self):
+        """Children to write, dropping refinements of removed elements"""
+        orphans = {'#' + i for i in self.removed_ids}
+        return [
+            e for e in self.children
+            if not (_local(e.tag) == 'meta' and _attr(e, 'refines') in orphans)
+        ] + self.added
+
+
+def _authors_and_sorts(metadata):
+    authors = metadata.authors
+    if not authors and metadata.author:
+        authors = [a.strip() for a in metadata.author.split(' & ')]
+    if not authors:
+        return None
+    sorts = metadata.author_sort.split(' & ') if metadata.author_sort else []
+    if len(sorts) != len(authors):
+        sorts = [author_to_author_sort(author) for author in authors]
+    return list(zip(authors, sorts))
+
+
+def _is_author(element):
+    role = _attr(element, 'role')
+    return not role or role == 'aut'
+
+
+def _identifier_scheme(element, refinements):
+    scheme = _attr(element, 'scheme') or refinements.get(element.get('id'), {}).get('identifier-type')
+    if scheme:
+        return scheme.lower()
+    prefix, _, rest = _text(element).partition(':')
+    if prefix.lower() == 'urn':
+        return rest.partition(':')[0].lower()
+    return prefix.lower() if rest else None
+
+
+def _date_text(value):
+    return value.isoformat()
+
+
+def _series_name_and_index(metadata):
+    name = metadata.series
+    index = metadata.series_index
+    match = CALIBRE_SERIES_RE.match(name)
+    if match:
+        name = match[1].strip()
+        if index is None:
+            index = float(match[2])
+    index = float(index if index is not None else 1)
+    return name, int(index) if index.is_integer() else index
+
+
+def _rewrite(rewrite, metadata):
+    refinements = {}
+    for element in rewrite.children:
+        if _local(element.tag) == 'meta' and _attr(element, 'refines'):
+            refinements.setdefault(_attr(element, 'refines').lstrip('#'), {})[
+                _attr(element, 'property')
+            ] = _text(element)
+    epub3 = rewrite.epub3
+
+    if metadata.title is not None:
+        rewrite.remove_dc('title')
+        rewrite.add(_dc('title'), metadata.title)
+
+    authors = _authors_and_sorts(metadata)
+    if authors is not None:
+        rewrite.remove_dc('creator', lambda e: _is_author(e) and (
+            refinements.get(e.get('id'), {}).get('role') in (None, 'aut')
+        ))
+        for author, sort in authors:
+            if epub3:
+                rewrite.add(_dc('creator'), author, refines=(('role', 'aut'), ('file-as', sort)))
+            else:
+                rewrite.add(_dc('creator'), author, {_opf('role'): 'aut', _opf('file-as'): sort})
+
+    for field, name in (('description', 'description'), ('publisher', 'publisher')):
+        value = getattr(metadata, field)
+        if value is not None:
+            rewrite.remove_dc(name)
+            rewrite.add(_dc(name), value)
+
+    if metadata.tags is not None:
+        rewrite.remove_dc('subject')
+        for tag in metadata.tags:
+            rewrite.add(_dc('subject'), tag)
+
+    if metadata.language is not None:
+        rewrite.remove_dc('language')
+        for code in metadata.language.split(','):
+            code = code.strip()
+            rewrite.add(_dc('language'), LANGUAGE_TAGS.get(code, code))
+
+    identifiers = dict(metadata.identifiers or {})
+    if metadata.isbn is not None:
+        identifiers['isbn'] = metadata.isbn
+    if identifiers:
+        replace_all = metadata.identifiers is not None
+
+        def replaced(element):
+            if element.get('id') == rewrite.unique_identifier:
+                return False
+            scheme = _identifier_scheme(element, refinements)
+            if scheme in ('calibre', 'uuid'):
+                return False
+            return replace_all or scheme == 'isbn'
+
+        rewrite.remove_dc('identifier', replaced)
+        kept = {_text(e) for e in rewrite.children if _local(e.tag) == 'identifier'}
+        for scheme, value in sorted(identifiers.items()):
+            if value in kept:
+                continue
+            if epub3:
+                rewrite.add(_dc('identifier'), value, refines=(('identifier-type', scheme),))
+            else:
+                rewrite.add(_dc('identifier'), value, {_opf('scheme'): scheme.upper()})
+
+    if metadata.publication_date is not None:
+        rewrite.remove_dc('date', lambda e: _attr(e, 'event') in (None, 'publication'))
+        attrib = {} if epub3 else {_opf('event'): 'publication'}
+        rewrite.add(_dc('date'), _date_text(metadata.publication_date), attrib)
+
+    if metadata.last_edited is not None:
+        rewrite.remove_meta('calibre:timestamp')
+        rewrite.add_meta('calibre:timestamp', _date_text(metadata.last_edited))
+
+    if metadata.rating is not None:
+        rewrite.remove_meta('calibre:rating')
+        # stored out of 10
+        rewrite.add_meta('calibre:rating', str(metadata.rating * 2))
+
+    if metadata.series is not None:
+        rewrite.remove_meta('calibre:series', 'calibre:series_index', 'belongs-to-collection')
+        name, index = _series_name_and_index(metadata)
+        rewrite.add_meta('calibre:series', name)
+        rewrite.add_meta('calibre:series_index', str(index))
+
+    return rewrite.finish()
+
+
+def _whitespace(text, default):
+    if text and '\n' in text and not text.strip():
+        return text
+    return default
+
+
+class _Writer:
+    """Serializes elements with fixed namespace prefixes"""
+
+    def __init__(self, element_prefix):
+        self.element_prefixes = {OPF_NS: element_prefix, DC_NS: 'dc', XML_NS: 'xml'}
+        self.attribute_prefixes = {OPF_NS: 'opf', DC_NS: 'dc', XML_NS: 'xml'}
+        self.declarations = {}
+        self.unknown = 0
+
+    def qname(self, tag, prefixes):
+        if not tag.startswith('{'):
+            return tag
+        uri, _, local = tag[1:].partition('}')
+        if uri not in prefixes:
+            prefix = 'ns{}'.format(self.unknown)
+            self.unknown += 1
+            self.element_prefixes.setdefault(uri, prefix)
+            self.attribute_prefixes.setdefault(uri, prefix)
+        prefix = prefixes[uri]
+        if prefix and prefix != 'xml':
+            self.declarations[prefix] = uri
+        return '{}:{}'.format(prefix, local) if prefix else local
+
+    def write(self, element) -> str:
+        tag = self.qname(element.tag, self.element_prefixes)
+        parts = ['<', tag]
+        for key, value in element.attrib.items():
+            parts.append(' {}="{}"'.format(
+                self.qname(key, self.attribute_prefixes),
+                escape(value, {'"': '&quot;'})
+            ))
+        if element.text is None and not len(element):
+            parts.append('/>')
+        else:
+            parts.append('>')
+            parts.append(escape(element.text or ''))
+            for child in element:
+                parts.append(self.write(child))
+                parts.append(escape(child.tail or ''))
+            parts.append('</{}>'.format(tag))
+        return ''.join(parts)
+
+
+def update_opf(document: bytes, metadata: Metadata) -> bytes:
+    """Rewrites the metadata section of an OPF package document
+
+    Every field of metadata that isn't ``None`` replaces the elements
+    describing it; everything else in the document, including the rest of
+    the metadata section and the package's unique identifier, is kept as
+    it was. EPUB 3 packages get refinements where EPUB 2 ones get ``opf:``
+    attributes.
+
+    Args:
+        document (bytes): The OPF, encoded as UTF-8
+        metadata (Metadata): Fields to write
+    Returns:
+        The updated OPF
+    Raises:
+        capybre.epub.UnsupportedEpub: if the OPF isn't one this can rewrite
+            without losing information
+    """
+    encoding = XML_ENCODING_RE.match(document)
+    if encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8'):
+        raise UnsupportedEpub('OPF is not UTF-8')
+    root = ElementTree.fromstring(document)
+    metadata_element = next((e for e in root if _local(e.tag) == 'metadata'), None)
+    if metadata_element is None:
+        raise UnsupportedEpub('No metadata section')
+    if any(_local(e.tag) in ('dc-metadata', 'x-metadata') for e in metadata_element):
+        raise UnsupportedEpub('Nested metadata sections')
+    start = METADATA_START_RE.search(document)
+    end = METADATA_END_RE.search(document, start.end()) if start else None
+    if end is None:
+        raise UnsupportedEpub('Empty metadata section')
+
+    rewrite = _Rewrite(
+        metadata_element,
+        (root.get('version') or '2.0').startswith('3'),
+        root.get('unique-identifier')
+    )
+    children = _rewrite(rewrite, metadata)
+
+    prefix = start.group(1).decode('utf-8') if start.group(1) else ''
+    writer = _Writer(prefix)
+    indent = _whitespace(metadata_element.text, '\n    ')
+    closing = _whitespace(metadata_element[-1].tail if len(metadata_element) else None, '\n')
+    body = ''.join(indent + writer.write(child) for child in children) + closing
+
+    start_tag = start.group(0).decode('utf-8')
+    declarations = []
+    for name, uri in sorted(writer.declarations.items()):
+        declared = re.search('xmlns:{}\\s*=\\s*["\']([^"\']*)["\']'.format(re.escape(name)), start_tag)
+        if declared is None:
+            declarations.append(' xmlns:{}="{}"'.format(name, escape(uri, {'"': '&quot;'})))
+        elif declared.group(1) != uri:
+            raise UnsupportedEpub('Prefix {} is bound to {}'.format(name, declared.group(1)))
+    if declarations:
+        start_tag = start_tag[:-1] + ''.join(declarations) + '>'
+
+    return b''.join((
+        document[:start.start()],
+        start_tag.encode('utf-8'),
+        body.encode('utf-8'),
+        end.group(0),
+        document[end.end():],
+    ))
@@ -0,0 +1,280 @@
+"""
+Named sets of ``ebook-convert`` options, so a conversion can skip the
+stages it doesn't need. For use like ::
+
+    convert('PrideAndPrejudice.epub', as_ext='mobi', profile='fast')
+
+    profile = ConversionProfile(
+        common={'smarten_punctuation': True},
+        output_options={EbookFormat.PDF: {'paper_size': 'a5'}},
+    )
+    convert('PrideAndPrejudice.epub', as_ext='pdf', profile=profile)
+
+Options are given by their ``ebook-convert`` names with underscores, and
+are checked when the profile is made: each must exist for the format it's
+given under, and its value must have the option's type. Input and output
+options only reach ``ebook-convert`` when converting from or to their
+format, so one profile can carry options for every format it is used
+with.
+
+Three presets are built in:
+
+``fast``
+    Skips font rescaling, cover generation, inline tables of contents and
+    splitting, for previews where throughput matters more than typography
+``balanced``
+    Calibre's own defaults
+``quality``
+    Runs heuristic processing, smartens punctuation and adds page numbers
+    and a table of contents to PDFs
+"""
+from typing import List
+
+from .ebook_format import EbookFormat
+
+
+class Option:
+    """An ``ebook-convert`` command line option
+
+    Args:
+        flag (str): The option as written on the command line
+        type (type): ``bool`` for switches, else the type of its value
+        choices (Tuple, optional): The values it accepts, if limited
+    """
+
+    def __init__(self, flag, type=bool, choices=None):
+        self.flag = flag
+        self.type = type
+        self.choices = choices
+
+    def validate(self, name, value):
+        if self.type is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if not isinstance(value, self.type) or (self.type is int and isinstance(value, bool)):
+            raise Exception('Option {} takes a {}, not {!r}'.format(name, self.type.__name__, value))
+        if self.choices is not None and value not in self.choices:
+            raise Exception('Option {} must be one of {}, not {!r}'.format(
+                name, ', '.join(map(str, self.choices)), value
+            ))
+        return value
+
+    def args(self, value) -> List[str]:
+        if self.type is bool:
+            return [self.flag] if value else []
+        return [self.flag, str(value)]
+
+
+COMMON_OPTIONS = {
+    'base_font_size': Option('--base-font-size', float),
+    'change_justification': Option('--change-justification', str, ('original', 'left', 'justify')),
+    'disable_font_rescaling': Option('--disable-font-rescaling'),
+    'embed_all_fonts': Option('--embed-all-fonts'),
+    'enable_heuristics': Option('--enable-heuristics'),
+    'insert_blank_line': Option('--insert-blank-line'),
+    'keep_ligatures': Option('--keep-ligatures'),
+    'linearize_tables': Option('--linearize-tables'),
+    'remove_paragraph_spacing': Option('--remove-paragraph-spacing'),
+    'smarten_punctuation': Option('--smarten-punctuation'),
+    'subset_embedded_fonts': Option('--subset-embedded-fonts'),
+    'unsmarten_punctuation': Option('--unsmarten-punctuation'),
+}
+
+INPUT_OPTIONS = {
+    EbookFormat.PDF: {
+        'no_images': Option('--no-images'),
+        'unwrap_factor': Option('--unwrap-factor', float),
+    },
+    EbookFormat.TXT: {
+        'formatting_type': Option(
+            '--formatting-type', str,
+            ('auto', 'plain', 'heuristic', 'textile', 'markdown')
+        ),
+        'paragraph_type': Option(
+            '--paragraph-type', str,
+            ('auto', 'block', 'single', 'print', 'unformatted', 'off')
+        ),
+    },
+}
+
+OUTPUT_OPTIONS = {
+    EbookFormat.EPUB: {
+        'dont_split_on_page_breaks': Option('--dont-split-on-page-breaks'),
+        'epub_flatten': Option('--epub-flatten'),
+        'epub_inline_toc': Option('--epub-inline-toc'),
+        'epub_version': Option('--epub-version', str, ('2', '3')),
+        'flow_size': Option('--flow-size', int),
+        'no_default_epub_cover': Option('--no-default-epub-cover'),
+        'no_svg_cover': Option('--no-svg-cover'),
+        'preserve_cover_aspect_ratio': Option('--preserve-cover-aspect-ratio'),
+    },
+    EbookFormat.MOBI: {
+        'dont_compress': Option('--dont-compress'),
+        'mobi_file_type': Option('--mobi-file-type', str, ('old', 'both', 'new')),
+        'mobi_keep_original_images': Option('--mobi-keep-original-images'),
+        'no_inline_toc': Option('--no-inline-toc'),
+        'prefer_author_sort': Option('--prefer-author-sort'),
+    },
+    EbookFormat.PDF: {
+        'paper_size': Option(
+            '--paper-size', str,
+            ('a0', 'a1', 'a2', 'a3', 'a4', 'a5', 'a6', 'b0', 'b1', 'b2', 'b3', 'b4',
+             'b5', 'b6', 'legal', 'letter')
+        ),
+        'pdf_add_toc': Option('--pdf-add-toc'),
+        'pdf_default_font_size': Option('--pdf-default-font-size', int),
+        'pdf_page_numbers': Option('--pdf-page-numbers'),
+        'preserve_cover_aspect_ratio': Option('--preserve-cover-aspect-ratio'),
+    },
+    EbookFormat.AZW3: {
+        'dont_compress': Option('--dont-compress'),
+        'no_inline_toc': Option('--no-inline-toc'),
+        'prefer_author_sort': Option('--prefer-author-sort'),
+    },
+    EbookFormat.TXT: {
+        'max_line_length': Option('--max-line-length', int),
+        'newline': Option('--newline', str, ('system', 'unix', 'old_mac', 'windows')),
+        'txt_output_encoding': Option('--txt-output-encoding', str),
+        'txt_output_formatting': Option(
+            '--txt-output-formatting', str, ('plain', 'markdown', 'textile')
+        ),
+    },
+}
+
+
+def _validated(options, known, scope):
+    validated = {}
+    for name, value in (options or {}).items():
+        if name not in known:
+            raise Exception('{} is not an option {}'.format(name, scope))
+        validated[name] = known[name].validate(name, value)
+    return validated
+
+
+class ConversionProfile:
+    """A validated set of ``ebook-convert`` options
+
+    Args:
+        name (str, optional): Name to identify the profile by
+        common (Dict[str, object], optional): Options applying to every
+            conversion, from :data:`COMMON_OPTIONS`
+        input_options (Dict[EbookFormat, Dict[str, object]], optional):
+            Options applying when converting from each format, from
+            :data:`INPUT_OPTIONS`
+        output_options (Dict[EbookFormat, Dict[str, object]], optional):
+            Options applying when converting to each format, from
+            :data:`OUTPUT_OPTIONS`
+    Raises:
+        Exception: if an option doesn't exist for its format, or has a
+            value of the wrong type
+    """
+
+    def __init__(self, name=None, common=None, input_options=None, output_options=None):
+        self.name = name
+        self.common = _validated(common, COMMON_OPTIONS, 'of ebook-convert')
+        self.input_options = {
+            EbookFormat(fmt): _validated(
+                options, INPUT_OPTIONS.get(fmt, {}),
+                'for {} input'.format(EbookFormat(fmt).name)
+            )
+            for fmt, options in (input_options or {}).items()
+        }
+        self.output_options = {
+            EbookFormat(fmt): _validated(
+                options, OUTPUT_OPTIONS.get(fmt, {}),
+                'for {} output'.format(EbookFormat(fmt).name)
+            )
+            for fmt, options in (output_options or {}).items()
+        }
+
+    def args(self, input_format, output_format, common=True) -> List[str]:
+        """The ``ebook-convert`` arguments for converting between two formats
+
+        Args:
+            input_format (EbookFormat): Format converted from
+            output_format (EbookFormat): Format converted to
+            common (bool, optional): Include the common options, which
+                only need applying once when a conversion goes through an
+                intermediate format. Defaults to ``True``
+        Returns:
+            List of arguments, in a stable order so they can key a cache
+        """
+        args = []
+        for options, known in (
+            (self.common if common else {}, COMMON_OPTIONS),
+            (self.input_options.get(input_format, {}), INPUT_OPTIONS.get(input_format, {})),
+            (self.output_options.get(output_format, {}), OUTPUT_OPTIONS.get(output_format, {})),
+        ):
+            for name in sorted(options):
+                args.extend(known[name].args(options[name]))
+        return args
+
+    def updated(self, name=None, common=None, input_options=None, output_options=None) -> 'ConversionProfile':
+        """A copy of this profile with some options added or replaced"""
+        def merge(base, extra):
+            merged = {fmt: dict(options) for fmt, options in base.items()}
+            for fmt, options in (extra or {}).items():
+                merged.setdefault(EbookFormat(fmt), {}).update(options)
+            return merged
+
+        return ConversionProfile(
+            name or self.name,
+            dict(self.common, **(common or {})),
+            merge(self.input_options, input_options),
+            merge(self.output_options, output_options),
+        )
+
+    def __repr__(self):
+        return 'ConversionProfile({!r})'.format(self.name)
+
+
+PRESETS = {
+    'fast': ConversionProfile(
+        'fast',
+        common={'disable_font_rescaling': True},
+        output_options={
+            EbookFormat.EPUB: {
+                'dont_split_on_page_breaks': True,
+                'no_default_epub_cover': True,
+                'no_svg_cover': True,
+            },
+            EbookFormat.MOBI: {'no_inline_toc': True, 'dont_compress': True},
+            EbookFormat.AZW3: {'no_inline_toc': True, 'dont_compress': True},
+        },
+    ),
+    'balanced': ConversionProfile('balanced'),
+    'quality': ConversionProfile(
+        'quality',
+        common={'enable_heuristics': True, 'smarten_punctuation': True},
+        output_options={
+            EbookFormat.EPUB: {'preserve_cover_aspect_ratio': True},
+            EbookFormat.PDF: {
+                'pdf_add_toc': True,
+                'pdf_page_numbers': True,
+                'preserve_cover_aspect_ratio': True,
+            },
+        },
+    ),
+}
+
+
+def get_profile(profile) -> ConversionProfile:
+    """The profile itself, or the preset of that name"""
+    if profile is None or isinstance(profile, ConversionProfile):
+        return profile
+    if profile not in PRESETS:
+        raise Exception('Unknown conversion profile {}; presets are {}'.format(
+            profile, ', '.join(PRESETS)
+        ))
+    return PRESETS[profile]
+
+
+def profile_args(profile, input_file, output_file, common=True) -> List[str]:
+    """Arguments for converting input_file to output_file under profile"""
+    profile = get_profile(profile)
+    if profile is None:
+        return []
+    return profile.args(
+        EbookFormat.from_filename(input_file),
+        EbookFormat.from_filename(output_file),
+        common
+    )
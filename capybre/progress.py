@@ -0,0 +1,154 @@
+"""
+Follows a conversion as it runs, from the percentage and stage lines
+``ebook-convert`` prints, e.g. ``34% Running transforms on e-book``. For
+use like ::
+
+    def report(progress):
+        print('{:.0%} {} after {:.1f}s'.format(progress.fraction, progress.stage, progress.elapsed))
+
+    convert('Manual.pdf', as_ext='epub', on_progress=report, stall_timeout=120)
+
+or, from a coroutine, with :func:`capybre.aio.async_convert_progress` ::
+
+    async for progress in async_convert_progress('Manual.pdf', as_ext='epub'):
+        print(progress.fraction)
+
+A conversion given a ``stall_timeout`` is killed, and raises
+:class:`ConversionStalled`, if its progress doesn't advance for that many
+seconds, so a stuck job can be told apart from a slow one, and retried,
+long before an overall timeout would catch it. As a
+:class:`capybre.limits.CalibreTimeout`, a stall is handled by anything
+that already handles timeouts.
+"""
+import re
+import sys
+import threading
+import time
+from typing import Optional
+
+from .limits import CalibreTimeout
+
+PROGRESS_RE = re.compile(r'^\s*(\d{1,3}(?:\.\d+)?)%\s*(.*?)\s*$')
+
+
+class Progress:
+    """A point reached by a conversion
+
+    Args:
+        stage (str): What Calibre is doing, as it describes it
+        fraction (float): How much of the conversion is done, from 0 to 1
+        elapsed (float): Seconds since the conversion started
+    """
+
+    def __init__(self, stage, fraction, elapsed):
+        self.stage = stage
+        self.fraction = fraction
+        self.elapsed = elapsed
+
+    def __iter__(self):
+        return iter((self.stage, self.fraction, self.elapsed))
+
+    def __repr__(self):
+        return 'Progress({!r}, {:.2f}, {:.1f})'.format(self.stage, self.fraction, self.elapsed)
+
+
+class ConversionStalled(CalibreTimeout):
+    """Raised when a conversion is killed for making no progress
+
+    Attributes:
+        progress (Progress): The last progress seen, or ``None``
+    """
+
+    def __init__(self, cmd, timeout, progress=None, output=None):
+        super().__init__(cmd, timeout, output)
+        self.progress = progress
+
+    def __str__(self):
+        return "Command '{}' made no progress for {} seconds{}".format(
+            self.cmd,
+            self.timeout,
+            ' at {:.0%} {}'.format(self.progress.fraction, self.progress.stage) if self.progress else ''
+        )
+
+
+def parse_progress(line) -> Optional[tuple]:
+    """The ``(stage, fraction)`` of a progress line of ``ebook-convert``
+    output, or ``None`` for any other line"""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+    match = PROGRESS_RE.match(line)
+    if match is None:
+        return None
+    percent = float(match.group(1))
+    if percent > 100:
+        return None
+    return match.group(2), percent / 100
+
+
+class ProgressWatcher:
+    """Parses one conversion's output as it's read, and watches it for stalls
+
+    Args:
+        on_progress (Callable[[Progress], None], optional): Called with
+            each progress line
+        stall_timeout (float, optional): Seconds progress may go without
+            advancing before the conversion is killed
+    """
+
+    def __init__(self, on_progress=None, stall_timeout=None):
+        self.on_progress = on_progress
+        self.stall_timeout = stall_timeout
+        # set by the call being watched, to pass unsuppressed output through
+        self.echo = False
+        self.last = None
+        self.stalled = False
+        self._started = None
+        self._advanced = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, kill):
+        """Starts the clock, and the stall detector, which stops the
+        conversion by calling kill"""
+        self._started = self._advanced = time.monotonic()
+        if self.stall_timeout is not None:
+            threading.Thread(target=self._watch, args=(kill,), daemon=True).start()
+
+    def _watch(self, kill):
+        remaining = self.stall_timeout
+        while not self._stopped.wait(remaining):
+            with self._lock:
+                remaining = self._advanced + self.stall_timeout - time.monotonic()
+                if remaining <= 0:
+                    self.stalled = True
+            if self.stalled:
+                kill()
+                return
+
+    def feed(self, line) -> Optional[Progress]:
+        """Takes a line of output, returning its progress if it has any"""
+        if self.echo:
+            target = getattr(sys.stdout, 'buffer', None)
+            if target is not None:
+                target.write(line)
+                target.flush()
+            else:
+                sys.stdout.write(line.decode('utf-8', 'replace'))
+        parsed = parse_progress(line)
+        if parsed is None:
+            return None
+        now = time.monotonic()
+        progress = Progress(parsed[0], parsed[1], now - self._started)
+        with self._lock:
+            if self.last is None or (progress.fraction, progress.stage) != (self.last.fraction, self.last.stage):
+                self._advanced = now
+            self.last = progress
+        if self.on_progress is not None:
+            self.on_progress(progress)
+        return progress
+
+    def stop(self):
+        self._stopped.set()
+
+    def stall_error(self, cmd, output=None) -> ConversionStalled:
+        return ConversionStalled(cmd, self.stall_timeout, self.last, output)
@@ -0,0 +1,554 @@
+"""
+Spreads conversions over several machines. Each runs a worker, e.g. ::
+
+    capybre worker --host 0.0.0.0 --port 8765 --slots 4 --token s3cret
+
+and a :class:`RemoteConverter` sends conversions to whichever worker has
+the most free slots ::
+
+    converter = RemoteConverter(
+        ['http://10.0.0.1:8765', 'http://10.0.0.2:8765'],
+        token='s3cret'
+    )
+    converter.convert('PrideAndPrejudice.epub', as_ext='mobi')
+
+The protocol is plain HTTP:
+
+``POST /convert?input_ext=epub&output_ext=mobi[&profile=fast]``
+    The body is the input ebook, and the response body the converted one.
+    Both are streamed through files rather than held in memory. A worker
+    with every slot busy answers 503 at once rather than queueing. A failed
+    conversion answers 422 (or 504 for a timeout) with a JSON error
+``GET /capacity``
+    JSON ``slots``, ``busy`` and ``free`` counts, plus running totals
+``GET /health``
+    The capacity, plus :func:`capybre.toolchain.health_check`; 503 if
+    Calibre is unusable
+
+Workers run each job through :func:`capybre.convert.convert`, under the
+worker's resource limits. Workers bind to localhost unless told otherwise,
+and when given a token reject requests that don't present it as
+``Authorization: Bearer <token>``.
+
+A client that loses a worker mid-job (the connection drops or the worker
+stops answering) marks it down and retries the job on another, and keeps
+probing down workers so they rejoin once back.
+"""
+import http.client
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from .convert import convert, job_kwargs, output_filename, ConversionResult
+from .ebook_format import EbookFormat
+from .helpers import bounded_map, default_workers, scratch_directory, write_source
+from .limits import CalibreTimeout, ResourceLimitExceeded
+from .toolchain import health_check
+
+DEFAULT_PORT = 8765
+
+EXT_RE = re.compile('^[a-z0-9]{1,10}$')
+CHUNK_SIZE = 1 << 20
+
+# seconds a capacity probe may take before the worker counts as down
+PROBE_TIMEOUT = 5
+
+
+class WorkerUnavailable(Exception):
+    """Raised when no worker could be reached to run a job"""
+
+
+def _copy(source, destination, length):
+    """Copies exactly length bytes between file objects"""
+    remaining = length
+    while remaining:
+        chunk = source.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError('Stream ended {} bytes early'.format(remaining))
+        destination.write(chunk)
+        remaining -= len(chunk)
+
+
+def _drain(source, length):
+    remaining = length
+    while remaining:
+        chunk = source.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'capybre-worker'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        token = self.server.worker.token
+        if token is None or self.headers.get('Authorization') == 'Bearer ' + token:
+            return True
+        self.close_connection = True
+        self._json(401, {'error': 'Missing or wrong token'})
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        path = urlsplit(self.path).path
+        if path == '/capacity':
+            self._json(200, self.server.worker.capacity())
+        elif path == '/health':
+            health = self.server.worker.health()
+            self._json(200 if health['ok'] else 503, health)
+        else:
+            self._json(404, {'error': 'No such endpoint'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            self.close_connection = True
+            self._json(404, {'error': 'No such endpoint'})
+            return
+        if not self._authorized():
+            return
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        input_ext = params.get('input_ext', '').lower()
+        output_ext = params.get('output_ext', '').lower()
+        length = self.headers.get('Content-Length')
+        error = None
+        if not EXT_RE.match(input_ext) or not EXT_RE.match(output_ext):
+            error = (400, 'input_ext and output_ext must be plain extensions')
+        elif length is None or not length.isdigit():
+            error = (411, 'Content-Length is required')
+        if error:
+            self.close_connection = True
+            self._json(error[0], {'error': error[1]})
+            return
+
+        worker = self.server.worker
+        if not worker.acquire():
+            # drained so the client sees the 503 rather than a broken pipe
+            _drain(self.rfile, int(length))
+            self._json(503, dict(worker.capacity(), error='No free slots'))
+            return
+        try:
+            with scratch_directory() as directory:
+                input_file = os.path.join(directory, 'input.' + input_ext)
+                output_file = os.path.join(directory, 'output.' + output_ext)
+                with open(input_file, 'wb') as f:
+                    _copy(self.rfile, f, int(length))
+                try:
+                    convert(
+                        input_file,
+                        output_file,
+                        limits=worker.limits,
+                        profile=params.get('profile')
+                    )
+                except CalibreTimeout as e:
+                    worker.finish(False)
+                    self._json(504, {'error': str(e), 'timeout': e.timeout})
+                    return
+                except ResourceLimitExceeded as e:
+                    worker.finish(False)
+                    self._json(422, {'error': str(e), 'returncode': e.returncode, 'resource': e.resource})
+                    return
+                except subprocess.CalledProcessError as e:
+                    worker.finish(False)
+                    self._json(422, {'error': str(e), 'returncode': e.returncode})
+                    return
+                except Exception as e:
+                    worker.finish(False)
+                    self._json(400, {'error': str(e)})
+                    return
+                worker.finish(True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(os.path.getsize(output_file)))
+                self.end_headers()
+                with open(output_file, 'rb') as f:
+                    shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+        finally:
+            worker.release()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WorkerServer:
+    """HTTP server running conversions for :class:`RemoteConverter` clients
+
+    Args:
+        host (str, optional): Address to listen on. Defaults to localhost
+        port (int, optional): Port to listen on, or 0 for any free port.
+            Defaults to 8765
+        slots (int, optional): Conversions to run at once. Defaults to the
+            number of available cores
+        token (str, optional): Token clients must present
+        limits (ResourceLimits, optional): Limits for each conversion, see
+            :mod:`capybre.limits`
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, slots=None, token=None, limits=None):
+        self.slots = slots or default_workers()
+        self.token = token
+        self.limits = limits
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.worker = self
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.busy >= self.slots:
+                return False
+            self.busy += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.busy -= 1
+
+    def finish(self, ok):
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def capacity(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'busy': self.busy,
+                'free': self.slots - self.busy,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+    def health(self):
+        health = health_check()
+        return dict(self.capacity(), ok=health['ok'], toolchain=health)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self) -> 'WorkerServer':
+        """Serves from a daemon thread, returning at once"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Remote:
+    """A client's view of one worker"""
+
+    def __init__(self, url):
+        parts = urlsplit(url if '://' in url else 'http://' + url)
+        self.url = '{}://{}'.format(parts.scheme, parts.netloc)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.alive = True
+        self.error = None
+        self.slots = 0
+        self.free = 0
+        self.checked = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def connection(self, timeout):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+
+class RemoteConverter:
+    """Client running conversions on a set of :class:`WorkerServer` workers
+
+    Args:
+        workers (List[str]): Base URLs of the workers, e.g.
+            ``http://10.0.0.1:8765``
+        token (str, optional): Token the workers expect
+        retries (int, optional): Times a job is retried on another worker
+            after losing the one it ran on. Defaults to 2
+        refresh (float, optional): Seconds between probes of each worker's
+            free slots. Defaults to 1
+        timeout (float, optional): Seconds to wait on a worker's socket
+            before counting it as lost. Defaults to waiting indefinitely,
+            as conversions can take minutes
+    """
+
+    def __init__(self, workers, token=None, retries=2, refresh=1.0, timeout=None):
+        if not workers:
+            raise Exception('RemoteConverter needs at least one worker')
+        self.workers = [_Remote(url) for url in workers]
+        self.token = token
+        self.retries = retries
+        self.refresh = refresh
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def _headers(self):
+        return {'Authorization': 'Bearer ' + self.token} if self.token else {}
+
+    def _probe(self, remote):
+        connection = remote.connection(PROBE_TIMEOUT)
+        try:
+            connection.request('GET', '/capacity', headers=self._headers())
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise ValueError('answered {}: {}'.format(response.status, body.decode('utf-8', 'replace')))
+            capacity = json.loads(body.decode('utf-8'))
+            with self._lock:
+                remote.alive = True
+                remote.error = None
+                remote.slots = capacity['slots']
+                remote.free = capacity['free']
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            with self._lock:
+                remote.alive = False
+                remote.error = str(e)
+        finally:
+            connection.close()
+            remote.checked = time.monotonic()
+
+    def _pick(self) -> _Remote:
+        """The worker with the most free slots, waiting for one to free up"""
+        while True:
+            now = time.monotonic()
+            for remote in self.workers:
+                if remote.checked is None or now - remote.checked >= self.refresh:
+                    self._probe(remote)
+            with self._lock:
+                alive = [r for r in self.workers if r.alive]
+                if not alive:
+                    raise WorkerUnavailable('No worker is reachable: {}'.format(
+                        '; '.join('{} {}'.format(r.url, r.error) for r in self.workers)
+                    ))
+                remote = max(alive, key=lambda r: (r.free, -r.in_flight))
+                if remote.free > 0:
+                    remote.free -= 1
+                    remote.in_flight += 1
+                    return remote
+            time.sleep(min(self.refresh, 0.05))
+
+    def _run(self, source, length, input_ext, output_ext, profile, sink):
+        """Sends a job to workers until one completes it, writing the output to sink()"""
+        if profile is not None and not isinstance(profile, str):
+            raise Exception('Remote conversions take the name of a preset profile')
+        query = {'input_ext': input_ext, 'output_ext': output_ext}
+        if profile:
+            query['profile'] = profile
+        path = '/convert?' + urlencode(query)
+        cmd = ['ebook-convert', 'input.' + input_ext, 'output.' + output_ext]
+        start = source.tell() if hasattr(source, 'seek') else None
+        lost = 0
+        while True:
+            remote = self._pick()
+            connection = remote.connection(self.timeout)
+            done = False
+            try:
+                if start is not None:
+                    source.seek(start)
+                headers = dict(self._headers(), **{'Content-Length': str(length)})
+                connection.request('POST', path, body=source, headers=headers)
+                response = connection.getresponse()
+                if response.status == 200:
+                    with sink() as output:
+                        _copy(response, output, int(response.getheader('Content-Length')))
+                    done = True
+                    with self._lock:
+                        remote.completed += 1
+                    return
+                body = response.read()
+                if response.status == 503:
+                    # full after all: another client got there first
+                    with self._lock:
+                        remote.free = 0
+                    continue
+                error = json.loads(body.decode('utf-8')) if body else {}
+                message = error.get('error', body.decode('utf-8', 'replace'))
+                done = True
+                if response.status == 504:
+                    raise CalibreTimeout(cmd, error.get('timeout'))
+                if response.status == 422 and 'resource' in error:
+                    raise ResourceLimitExceeded(error['resource'], error['returncode'], cmd, stderr=message)
+                if response.status == 422:
+                    raise subprocess.CalledProcessError(error['returncode'], cmd, stderr=message)
+                raise Exception('Worker {} rejected the job ({}): {}'.format(remote.url, response.status, message))
+            except (OSError, http.client.HTTPException, socket.timeout) as e:
+                if done:
+                    raise
+                with self._lock:
+                    remote.alive = False
+                    remote.error = str(e)
+                    remote.failed += 1
+                lost += 1
+                if lost > self.retries:
+                    raise WorkerUnavailable('Lost {} workers running the job'.format(lost)) from e
+            finally:
+                connection.close()
+                with self._lock:
+                    remote.in_flight -= 1
+                    if remote.alive and done:
+                        remote.free = min(remote.free + 1, remote.slots)
+                    elif remote.alive:
+                        # a 503: its capacity is stale, so probe it again
+                        remote.checked = None
+
+    def convert(
+        self,
+        input_file,
+        output_file=None,
+        as_format=EbookFormat.UNKNOWN,
+        as_ext=None,
+        profile=None
+    ) -> str:
+        """Converts a local ebook on a worker, like :func:`capybre.convert.convert`
+
+        Args:
+            input_file (str): path to the input file
+            output_file (str, optional): fully-specified path to the output file
+            as_format (EbookFormat, optional): Enum representation of desired
+                output format
+            as_ext (str, optional): String representation of desired output
+                format, e.g. ``mobi``
+            profile (str, optional): Name of a preset to convert with, see
+                :mod:`capybre.profiles`
+        Returns:
+            Path to the output file
+        Raises:
+            subprocess.CalledProcessError: if ebook-convert failed on the worker
+            capybre.limits.CalibreTimeout: if it ran past the worker's timeout
+            WorkerUnavailable: if no worker could be reached, or too many
+                were lost while running the job
+        """
+        output_file = output_filename(input_file, output_file, as_format, as_ext)
+        with open(input_file, 'rb') as source:
+            self._run(
+                source,
+                os.path.getsize(input_file),
+                _ext(input_file),
+                _ext(output_file),
+                profile,
+                lambda: _output(output_file)
+            )
+        return output_file
+
+    def convert_bytes(
+        self,
+        source,
+        input_ext,
+        as_format=EbookFormat.UNKNOWN,
+        as_ext=None,
+        profile=None
+    ) -> bytes:
+        """Converts an in-memory ebook on a worker, like
+        :func:`capybre.convert.convert_bytes`"""
+        if not isinstance(source, (bytes, bytearray, memoryview)):
+            source = source.read()
+        output_ext = _ext(output_filename('input.' + input_ext, None, as_format, as_ext))
+        with scratch_directory() as directory:
+            output_file = os.path.join(directory, 'output.' + output_ext)
+            input_file = os.path.join(directory, 'input.' + input_ext)
+            write_source(source, input_file)
+            self.convert(input_file, output_file, profile=profile)
+            with open(output_file, 'rb') as f:
+                return f.read()
+
+    def convert_many(self, jobs, max_workers=None, as_format=EbookFormat.UNKNOWN, as_ext=None, profile=None):
+        """Converts many ebooks across the workers, like
+        :func:`capybre.convert.convert_many`
+
+        Args:
+            jobs (Iterable[str or dict]): Paths, or dicts of keyword
+                arguments to :meth:`convert`
+            max_workers (int, optional): Jobs in flight at once. Defaults to
+                the total slots of the workers
+        Yields:
+            :class:`capybre.convert.ConversionResult` for each job, in
+            order of completion
+        """
+        if max_workers is None:
+            for remote in self.workers:
+                self._probe(remote)
+            max_workers = sum(r.slots for r in self.workers if r.alive) or 1
+        defaults = {'as_format': as_format, 'as_ext': as_ext, 'profile': profile}
+
+        def run(job):
+            if isinstance(job, dict):
+                return self.convert(**job_kwargs(defaults, job))
+            return self.convert(job, **defaults)
+
+        for job, output_file, error in bounded_map(run, jobs, max_workers):
+            yield ConversionResult(job, output_file, error)
+
+    def status(self):
+        """The client's view of each worker: its ``url``, whether it is
+        ``alive``, its ``slots`` and ``free`` slots as last probed, and the
+        jobs it has ``in_flight``, ``completed`` and ``failed``"""
+        with self._lock:
+            return [
+                {
+                    'url': r.url,
+                    'alive': r.alive,
+                    'slots': r.slots,
+                    'free': r.free,
+                    'in_flight': r.in_flight,
+                    'completed': r.completed,
+                    'failed': r.failed,
+                }
+                for r in self.workers
+            ]
+
+
+def _ext(path):
+    return os.path.splitext(path)[1][1:].lower()
+
+
+class _output:
+    """Context object writing to path, which is removed if writing fails"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'wb')
+        return self.file
+
+    def __exit__(self, type, value, traceback):
+        self.file.close()
+        if value is not None and os.path.exists(self.path):
+            os.remove(self.path)
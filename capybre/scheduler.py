@@ -0,0 +1,308 @@
+"""
+Runs conversion, extraction and fetching jobs by priority, with a separate
+concurrency limit for each class of job, so a burst of slow conversions
+can't hold up quick metadata reads. For use like ::
+
+    scheduler = Scheduler(concurrency={'convert': 2, 'extract': 8})
+    future = scheduler.extract_metadata('book.epub', priority=10, tenant='reader')
+    metadata = future.result()
+
+Jobs are grouped into the classes ``convert`` (``ebook-convert``),
+``extract`` (``ebook-meta``) and ``fetch`` (``fetch-ebook-metadata``), each
+with its own workers and its own bounded queue. Within a class, a job of
+higher priority always starts before one of lower priority; among jobs of
+equal priority, the tenant with the fewest jobs running goes next, so one
+tenant's backlog can't starve the others. When a class's queue is full,
+submitting to it either blocks until there is room or raises
+:class:`QueueFull`.
+
+Every job runs the same function the caller would have, e.g.
+:func:`capybre.convert.convert`, and its outcome is reported through a
+:class:`concurrent.futures.Future`.
+"""
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from .convert import convert
+from .fetch_metadata import fetch_metadata
+from .helpers import default_workers
+from .instrumentation import WALL_TIME_BUCKETS, _Histogram
+from .metadata import extract_cover, extract_metadata, extract_metadata_and_cover
+
+CONVERT = 'convert'
+EXTRACT = 'extract'
+FETCH = 'fetch'
+
+
+def default_concurrency():
+    """One conversion per core, with room for quick reads and network-bound lookups"""
+    workers = default_workers()
+    return {CONVERT: workers, EXTRACT: 2 * workers, FETCH: 4}
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted to a class whose queue is full"""
+
+
+class _Job:
+
+    def __init__(self, fn, args, kwargs, priority, tenant):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.tenant = tenant
+        self.future = Future()
+        self.submitted = None
+
+
+class _JobClass:
+    """The queue, workers and counters of one class of job"""
+
+    def __init__(self, name, concurrency, max_queued, lock):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        # per tenant, a heap of (-priority, sequence, job)
+        self.queues = {}
+        self.queued = 0
+        self.running = {}
+        self.served = {}
+        self.workers = []
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_seconds = _Histogram(WALL_TIME_BUCKETS)
+        self.work = threading.Condition(lock)
+
+    def push(self, job, sequence):
+        heapq.heappush(self.queues.setdefault(job.tenant, []), (-job.priority, sequence, job))
+        self.queued += 1
+
+    def pop(self):
+        """The next job: highest priority first, then the tenant with the
+        fewest jobs running, then the one served least recently"""
+        def rank(tenant):
+            priority, sequence, _ = self.queues[tenant][0]
+            return priority, self.running.get(tenant, 0), self.served.get(tenant, -1), sequence
+
+        tenant = min(self.queues, key=rank)
+        _, _, job = heapq.heappop(self.queues[tenant])
+        if not self.queues[tenant]:
+            del self.queues[tenant]
+        self.queued -= 1
+        return job
+
+
+class Scheduler:
+    """Priority scheduler running Calibre jobs on per-class worker threads
+
+    Can be used as a context manager, shutting down on exit.
+
+    Args:
+        concurrency (Dict[str, int], optional): Jobs of each class that may
+            run at once, overriding :func:`default_concurrency`
+        max_queued (int or Dict[str, int], optional): Jobs of each class
+            that may wait to run, overall or per class. Defaults to 1000
+        block (bool, optional): Whether submitting to a full queue waits
+            for room (``True``) or raises :class:`QueueFull`. Defaults to
+            ``True``
+    """
+
+    def __init__(self, concurrency=None, max_queued=1000, block=True):
+        limits = dict(default_concurrency(), **(concurrency or {}))
+        self.block = block
+        self._lock = threading.Lock()
+        self._classes = {
+            name: _JobClass(
+                name,
+                limit,
+                max_queued.get(name, 1000) if isinstance(max_queued, dict) else max_queued,
+                self._lock
+            )
+            for name, limit in limits.items()
+        }
+        self._room = threading.Condition(self._lock)
+        self._sequence = itertools.count()
+        self._closed = False
+
+    def submit(self, job_class, fn, *args, priority=0, tenant=None, block=None, timeout=None, **kwargs) -> Future:
+        """Queues ``fn(*args, **kwargs)`` to run as a job of job_class
+
+        Args:
+            job_class (str): Class to run the job in, e.g. ``'convert'``
+            fn (Callable): Function to run
+            priority (int, optional): Higher runs sooner. Defaults to 0
+            tenant (Hashable, optional): Key to share the class's workers
+                fairly between
+            block (bool, optional): Overrides the scheduler's block setting
+            timeout (float, optional): Seconds to block for before raising
+                :class:`QueueFull`
+        Returns:
+            ``Future`` of the job's result
+        Raises:
+            QueueFull: if the class's queue is full and either blocking is
+                off or the timeout passed
+        """
+        if job_class not in self._classes:
+            raise Exception('Unknown job class {}; classes are {}'.format(
+                job_class, ', '.join(sorted(self._classes))
+            ))
+        job = _Job(fn, args, kwargs, priority, tenant)
+        block = self.block if block is None else block
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if self._closed:
+                raise Exception('Scheduler has been shut down')
+            jobs = self._classes[job_class]
+            while jobs.queued >= jobs.max_queued:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    jobs.rejected += 1
+                    raise QueueFull('{} queue is full ({} jobs)'.format(job_class, jobs.max_queued))
+                self._room.wait(remaining)
+                if self._closed:
+                    raise Exception('Scheduler has been shut down')
+            job.submitted = time.perf_counter()
+            jobs.push(job, next(self._sequence))
+            jobs.submitted += 1
+            self._start_worker(jobs)
+            jobs.work.notify()
+        return job.future
+
+    def convert(self, *args, priority=0, tenant=None, **kwargs) -> Future:
+        """Schedules :func:`capybre.convert.convert` as a ``convert`` job"""
+        return self.submit(CONVERT, convert, *args, priority=priority, tenant=tenant, **kwargs)
+
+    def extract_metadata(self, *args, priority=0, tenant=None, **kwargs) -> Future:
+        """Schedules :func:`capybre.metadata.extract_metadata` as an ``extract`` job"""
+        return self.submit(EXTRACT, extract_metadata, *args, priority=priority, tenant=tenant, **kwargs)
+
+    def extract_cover(self, *args, priority=0, tenant=None, **kwargs) -> Future:
+        """Schedules :func:`capybre.metadata.extract_cover` as an ``extract`` job"""
+        return self.submit(EXTRACT, extract_cover, *args, priority=priority, tenant=tenant, **kwargs)
+
+    def extract_metadata_and_cover(self, *args, priority=0, tenant=None, **kwargs) -> Future:
+        """Schedules :func:`capybre.metadata.extract_metadata_and_cover` as an
+        ``extract`` job"""
+        return self.submit(
+            EXTRACT, extract_metadata_and_cover, *args, priority=priority, tenant=tenant, **kwargs
+        )
+
+    def fetch_metadata(self, *args, priority=0, tenant=None, **kwargs) -> Future:
+        """Schedules :func:`capybre.fetch_metadata.fetch_metadata` as a ``fetch`` job"""
+        return self.submit(FETCH, fetch_metadata, *args, priority=priority, tenant=tenant, **kwargs)
+
+    def _start_worker(self, jobs):
+        busy = sum(jobs.running.values())
+        if len(jobs.workers) < jobs.concurrency and len(jobs.workers) < busy + jobs.queued:
+            worker = threading.Thread(
+                target=self._work_loop,
+                args=(jobs,),
+                name='capybre-{}-{}'.format(jobs.name, len(jobs.workers)),
+                daemon=True
+            )
+            jobs.workers.append(worker)
+            worker.start()
+
+    def _work_loop(self, jobs):
+        while True:
+            with self._lock:
+                while not jobs.queued and not self._closed:
+                    jobs.work.wait()
+                if not jobs.queued:
+                    return
+                job = jobs.pop()
+                jobs.running[job.tenant] = jobs.running.get(job.tenant, 0) + 1
+                jobs.served[job.tenant] = next(self._sequence)
+                jobs.wait_seconds.observe(time.perf_counter() - job.submitted)
+                self._room.notify_all()
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        result = job.fn(*job.args, **job.kwargs)
+                    except BaseException as e:
+                        job.future.set_exception(e)
+                    else:
+                        job.future.set_result(result)
+            finally:
+                with self._lock:
+                    jobs.running[job.tenant] -= 1
+                    if not jobs.running[job.tenant]:
+                        del jobs.running[job.tenant]
+                    if not job.future.cancelled():
+                        if job.future.exception() is None:
+                            jobs.completed += 1
+                        else:
+                            jobs.failed += 1
+
+    def metrics(self):
+        """Snapshot of each class's queue
+
+        Returns:
+            Dict of each job class to a dict of ``queued`` and ``running``
+            job counts (overall, and per tenant under ``tenants``), the
+            ``submitted``, ``completed``, ``failed`` and ``rejected`` totals,
+            and ``wait_seconds``, a histogram of the time jobs queued for
+            (``count``, ``sum``, ``max`` and cumulative ``buckets``)
+        """
+        with self._lock:
+            metrics = {}
+            for name, jobs in self._classes.items():
+                tenants = {}
+                for tenant, queue in jobs.queues.items():
+                    tenants.setdefault(tenant, {'queued': 0, 'running': 0})['queued'] = len(queue)
+                for tenant, running in jobs.running.items():
+                    tenants.setdefault(tenant, {'queued': 0, 'running': 0})['running'] = running
+                histogram = jobs.wait_seconds
+                metrics[name] = {
+                    'concurrency': jobs.concurrency,
+                    'queued': jobs.queued,
+                    'running': sum(jobs.running.values()),
+                    'submitted': jobs.submitted,
+                    'completed': jobs.completed,
+                    'failed': jobs.failed,
+                    'rejected': jobs.rejected,
+                    'tenants': tenants,
+                    'wait_seconds': {
+                        'count': histogram.count,
+                        'sum': histogram.sum,
+                        'max': histogram.max,
+                        'buckets': dict(zip(histogram.buckets, histogram.counts)),
+                    },
+                }
+            return metrics
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stops accepting jobs, and lets the workers finish
+
+        Args:
+            wait (bool, optional): Wait for the workers to exit. Defaults to
+                ``True``
+            cancel_pending (bool, optional): Cancel jobs that haven't
+                started, rather than running them first. Defaults to
+                ``False``
+        """
+        with self._lock:
+            self._closed = True
+            if cancel_pending:
+                for jobs in self._classes.values():
+                    while jobs.queued:
+                        jobs.pop().future.cancel()
+            for jobs in self._classes.values():
+                jobs.work.notify_all()
+            self._room.notify_all()
+            workers = [w for jobs in self._classes.values() for w in jobs.workers]
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
@@ -0,0 +1,254 @@
+"""
+Finds the Calibre command line tools once per process, rather than on
+every call. For use like ::
+
+    status = health_check()
+    if not status['ok']:
+        sys.exit('Calibre is unusable: {}'.format('; '.join(status['errors'])))
+
+    toolchain = get_toolchain()
+    if toolchain.supports('cbz', 'azw3'):
+        convert('comic.cbz', as_ext='azw3')
+
+Each tool is looked up in ``$CAPYBRE_CALIBRE_DIR`` if set, then on the
+``PATH``, then in the macOS app bundle (which doesn't add itself to the
+``PATH``), and its absolute path is kept for every later call. A tool that
+can't be found raises :class:`CalibreNotFound` naming the places searched,
+before anything is started.
+
+Calibre's version and the formats it can convert between are only probed
+when first asked for, as that starts a Calibre process, and are then kept
+too. Call :func:`set_toolchain` with a fresh :class:`Toolchain` to forget
+them, e.g. after changing the ``PATH``.
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+from typing import Dict, FrozenSet, Optional, Tuple
+
+TOOLS = ('ebook-convert', 'ebook-meta', 'fetch-ebook-metadata', 'calibre-debug')
+
+# only needed by capybre.worker_pool.WorkerPool, so not missed by health_check
+OPTIONAL_TOOLS = ('calibre-debug',)
+
+CALIBRE_DIR_ENV = 'CAPYBRE_CALIBRE_DIR'
+
+# the calibre app bundle, installed system-wide or for the user
+MACOS_DIRS = (
+    '/Applications/calibre.app/Contents/MacOS',
+    os.path.expanduser('~/Applications/calibre.app/Contents/MacOS'),
+)
+
+VERSION_RE = re.compile('calibre ([0-9]+(?:\\.[0-9]+)*)')
+
+# seconds to wait on a probe before giving up on it
+PROBE_TIMEOUT = 60
+
+FORMATS_SCRIPT = (
+    'from calibre.customize.ui import available_input_formats, available_output_formats; '
+    'print(" ".join(sorted(available_input_formats()))); '
+    'print(" ".join(sorted(available_output_formats())))'
+)
+
+# What a stock Calibre 5 install converts between, for when it can't be asked
+DEFAULT_INPUT_FORMATS = frozenset((
+    'azw', 'azw3', 'azw4', 'cb7', 'cbc', 'cbr', 'cbz', 'chm', 'djvu', 'docx',
+    'epub', 'fb2', 'fbz', 'html', 'htmlz', 'lit', 'lrf', 'mobi', 'odt', 'pdb',
+    'pdf', 'pml', 'prc', 'rb', 'rtf', 'snb', 'tcr', 'txt', 'txtz',
+))
+DEFAULT_OUTPUT_FORMATS = frozenset((
+    'azw3', 'docx', 'epub', 'fb2', 'htmlz', 'lit', 'lrf', 'mobi', 'oeb', 'pdb',
+    'pdf', 'pml', 'rb', 'rtf', 'snb', 'tcr', 'txt', 'txtz', 'zip',
+))
+
+
+class CalibreNotFound(FileNotFoundError):
+    """Raised when a Calibre tool isn't installed where capybre looks for it"""
+
+
+def _ext(fmt):
+    if hasattr(fmt, 'to_ext'):
+        return fmt.to_ext()
+    return fmt.lower().lstrip('.')
+
+
+class Toolchain:
+    """The Calibre tools of one installation, resolved and probed once
+
+    Args:
+        directory (str, optional): Directory holding the tools. Defaults to
+            ``$CAPYBRE_CALIBRE_DIR``, then the ``PATH``, then the macOS app
+            bundle
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get(CALIBRE_DIR_ENV) or None
+        self._paths = {}
+        self._version = None
+        self._formats = None
+        self._lock = threading.Lock()
+
+    def _search(self):
+        if self.directory:
+            return [self.directory]
+        search = os.environ.get('PATH', '').split(os.pathsep)
+        if sys.platform == 'darwin':
+            search.extend(MACOS_DIRS)
+        return search
+
+    def find(self, tool) -> Optional[str]:
+        """Absolute path to tool, or ``None`` if it isn't installed"""
+        path = self._paths.get(tool)
+        if path is None:
+            path = shutil.which(tool, path=os.pathsep.join(self._search()))
+            if path is not None:
+                path = os.path.abspath(path)
+                self._paths[tool] = path
+        return path
+
+    def path(self, tool) -> str:
+        """Absolute path to tool
+
+        Raises:
+            CalibreNotFound: if the tool isn't installed
+        """
+        path = self.find(tool)
+        if path is None:
+            raise CalibreNotFound(
+                'Calibre tool {} not found in {}; install Calibre, or set {} to '
+                'the directory holding its command line tools'.format(
+                    tool, os.pathsep.join(self._search()), CALIBRE_DIR_ENV
+                )
+            )
+        return path
+
+    def command(self, args):
+        """args, with a Calibre tool at its head replaced by its absolute path"""
+        if args and args[0] in TOOLS:
+            return [self.path(args[0])] + list(args[1:])
+        return list(args)
+
+    @property
+    def version(self) -> Tuple[int, ...]:
+        """Calibre's version, e.g. ``(5, 0, 1)``
+
+        Raises:
+            CalibreNotFound: if ebook-convert isn't installed
+            Exception: if its version can't be read
+        """
+        with self._lock:
+            if self._version is None:
+                output = subprocess.run(
+                    [self.path('ebook-convert'), '--version'],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    timeout=PROBE_TIMEOUT
+                ).stdout.decode('utf-8', 'replace')
+                match = VERSION_RE.search(output)
+                if match is None:
+                    raise Exception('Unrecognized ebook-convert version: {!r}'.format(output.strip()))
+                self._version = tuple(int(part) for part in match.group(1).split('.'))
+            return self._version
+
+    def _probe_formats(self):
+        debug = self.find('calibre-debug')
+        if debug is not None:
+            try:
+                result = subprocess.run(
+                    [debug, '-c', FORMATS_SCRIPT],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    timeout=PROBE_TIMEOUT
+                )
+                lines = result.stdout.decode('utf-8', 'replace').strip().splitlines()
+                if result.returncode == 0 and len(lines) >= 2:
+                    return frozenset(lines[-2].lower().split()), frozenset(lines[-1].lower().split())
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        return DEFAULT_INPUT_FORMATS, DEFAULT_OUTPUT_FORMATS
+
+    def _get_formats(self):
+        with self._lock:
+            if self._formats is None:
+                self._formats = self._probe_formats()
+            return self._formats
+
+    @property
+    def input_formats(self) -> FrozenSet[str]:
+        """Extensions of the formats Calibre can convert from"""
+        return self._get_formats()[0]
+
+    @property
+    def output_formats(self) -> FrozenSet[str]:
+        """Extensions of the formats Calibre can convert to"""
+        return self._get_formats()[1]
+
+    def supports(self, input_format, output_format) -> bool:
+        """Whether Calibre can convert between two formats
+
+        Args:
+            input_format (EbookFormat or str): Format, or extension, to
+                convert from
+            output_format (EbookFormat or str): Format, or extension, to
+                convert to
+        """
+        return _ext(input_format) in self.input_formats and _ext(output_format) in self.output_formats
+
+    def health_check(self) -> Dict:
+        """Checks every required tool can be found and Calibre runs
+
+        ``calibre-debug`` is only needed by
+        :class:`capybre.worker_pool.WorkerPool`, so is reported in ``tools``
+        but isn't an error when missing.
+
+        Returns:
+            Dict with ``ok`` (bool), ``version`` (str or ``None``), ``tools``
+            (each tool's path, or ``None`` if missing) and ``errors`` (list
+            of problems found)
+        """
+        tools = {tool: self.find(tool) for tool in TOOLS}
+        errors = [
+            '{} not found'.format(tool) for tool, path in tools.items()
+            if path is None and tool not in OPTIONAL_TOOLS
+        ]
+        version = None
+        if tools['ebook-convert'] is not None:
+            try:
+                version = '.'.join(str(part) for part in self.version)
+            except Exception as e:
+                errors.append('ebook-convert --version failed: {}'.format(e))
+        return {
+            'ok': not errors,
+            'version': version,
+            'tools': tools,
+            'errors': errors,
+        }
+
+    def __repr__(self):
+        return 'Toolchain({!r})'.format(self.directory)
+
+
+_toolchain = Toolchain()
+
+
+def get_toolchain() -> Toolchain:
+    return _toolchain
+
+
+def set_toolchain(toolchain):
+    """Sets the toolchain every Calibre call is resolved through
+
+    Args:
+        toolchain (Toolchain): The new toolchain, or ``None`` for a fresh
+            default one
+    """
+    global _toolchain
+    _toolchain = toolchain or Toolchain()
+
+
+def health_check() -> Dict:
+    """:meth:`Toolchain.health_check` of the current toolchain"""
+    return _toolchain.health_check()
@@ -0,0 +1,229 @@
+"""
+Keeps a pool of long-lived Calibre interpreters (started through
+`calibre-debug`_) that run ``ebook-convert``, ``ebook-meta`` and
+``fetch-ebook-metadata`` requests in-process, so each call skips the
+second or so Calibre takes to start up.
+
+Installed as the backend for the rest of capybre, every public function
+routes through the pool transparently ::
+
+    with WorkerPool(size=4):
+        metadata = extract_metadata('PrideAndPrejudice.epub')
+
+Workers are recycled after a configurable number of jobs, and a worker
+that crashes is replaced the next time it is needed.
+
+..calibre-debug: https://manual.calibre-ebook.com/generated/en/calibre-debug.html
+"""
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+from . import helpers
+from .ebook_format import EbookFormat
+from .helpers import bounded_map, default_workers
+from .metadata import extract_raw_metadata_map, clean_metadata_map
+from .toolchain import get_toolchain
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '_calibre_worker.py')
+
+TOOLS = ('ebook-convert', 'ebook-meta', 'fetch-ebook-metadata')
+
+
+class WorkerCrashed(Exception):
+    """Raised when a worker dies twice in a row while handling a request"""
+
+
+class _Worker:
+    def __init__(self, command):
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        self.jobs = 0
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def request(self, calls):
+        message = json.dumps({'calls': calls}).encode('utf-8') + b'\n'
+        try:
+            self.process.stdin.write(message)
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (OSError, ValueError):
+            line = b''
+        if not line:
+            raise WorkerCrashed('Calibre worker exited with {}'.format(self.process.poll()))
+        self.jobs += len(calls)
+        return json.loads(line.decode('utf-8'))['results']
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+
+
+class WorkerPool:
+    """Pool of warm Calibre worker processes
+
+    Workers are started lazily, the first time each is needed. Used as a
+    context manager the pool installs itself as capybre's backend (see
+    :meth:`install`) and shuts its workers down on exit.
+
+    Args:
+        size (int, optional): Number of worker processes. Defaults to the
+            number of available cores
+        max_jobs (int, optional): Number of tool calls a worker handles
+            before it is replaced, limiting any state or memory Calibre
+            leaks between calls. Defaults to 200
+        calibre_debug (str, optional): Path to the ``calibre-debug`` binary
+    """
+
+    def __init__(self, size=None, max_jobs=200, calibre_debug='calibre-debug'):
+        self.size = size or default_workers()
+        self.max_jobs = max_jobs
+        self.command = [calibre_debug, '-e', WORKER_SCRIPT]
+        self._idle = queue.LifoQueue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(self.size):
+            self._idle.put(None)
+
+    def _spawn(self):
+        worker = _Worker(get_toolchain().command(self.command))
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _retire(self, worker):
+        with self._lock:
+            self._workers.discard(worker)
+        worker.close()
+
+    def run(self, calls):
+        """Runs a batch of tool calls on a single worker in one round trip
+
+        If the worker dies mid-request the batch is retried once on a
+        fresh worker.
+
+        Args:
+            calls (List[List[str]]): Argument lists, each starting with the
+                tool name, e.g. ``['ebook-meta', 'book.epub']``
+        Returns:
+            List of ``{'code': int, 'output': str, 'stderr': str}`` dicts,
+            one per call, stderr being the end of what the call wrote there
+        """
+        if self._closed:
+            raise Exception('WorkerPool has been closed')
+        worker = self._idle.get()
+        try:
+            for attempt in range(2):
+                if worker is not None and (not worker.alive or worker.jobs >= self.max_jobs):
+                    self._retire(worker)
+                    worker = None
+                if worker is None:
+                    worker = self._spawn()
+                try:
+                    return worker.request(calls)
+                except WorkerCrashed:
+                    self._retire(worker)
+                    worker = None
+                    if attempt:
+                        raise
+        finally:
+            self._idle.put(worker)
+
+    def handles(self, args):
+        return not self._closed and len(args) > 0 and args[0] in TOOLS
+
+    def call(self, args, suppress_output=True):
+        result = self.run([list(args)])[0]
+        if not suppress_output:
+            sys.stdout.write(result['output'])
+        return result['code']
+
+    def check_output(self, args):
+        result = self.run([list(args)])[0]
+        if result['code']:
+            # bytes, as from a subprocess
+            raise subprocess.CalledProcessError(
+                result['code'],
+                args,
+                result['output'].encode('utf-8'),
+                result['stderr'].encode('utf-8')
+            )
+        return result['output'].split('\n')
+
+    def extract_metadata_many(self, input_files, batch_size=100):
+        """Extracts metadata for many files, batching calls per round trip
+
+        Batches are spread over the workers in parallel.
+
+        Args:
+            input_files (List[str]): paths to the input files
+            batch_size (int, optional): Number of files sent to a worker in
+                a single request. Defaults to 100
+        Returns:
+            List of :class:`capybre.metadata.Metadata` objects, in the order
+            of input_files, with an exception in place of any file that
+            could not be read
+        """
+        input_files = list(input_files)
+        # results are placed by position, so a path listed twice gets two
+        results = [None] * len(input_files)
+
+        def run_batch(start):
+            batch = input_files[start:start + batch_size]
+            return self.run([['ebook-meta', f] for f in batch])
+
+        starts = range(0, len(input_files), batch_size)
+        for start, outputs, error in bounded_map(run_batch, starts, self.size):
+            for i, input_file in enumerate(input_files[start:start + batch_size]):
+                if error:
+                    results[start + i] = error
+                elif outputs[i]['code']:
+                    results[start + i] = subprocess.CalledProcessError(
+                        outputs[i]['code'], ['ebook-meta', input_file], outputs[i]['output']
+                    )
+                else:
+                    metadata = clean_metadata_map(
+                        extract_raw_metadata_map(outputs[i]['output'].split('\n'))
+                    )
+                    metadata.ebook_format = EbookFormat.from_filename(input_file)
+                    results[start + i] = metadata
+        return results
+
+    def install(self):
+        """Routes capybre's Calibre calls through this pool"""
+        helpers.set_backend(self)
+
+    def uninstall(self):
+        if helpers.get_backend() is self:
+            helpers.set_backend(None)
+
+    def close(self):
+        """Uninstalls the pool and shuts down its workers"""
+        self.uninstall()
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.close()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,175 @@
+"""
+Writes metadata back into ebook files. For use like ::
+
+    metadata = extract_metadata('PrideAndPrejudice.epub')
+    metadata.tags = ['Classics', 'Romance']
+    write_metadata('PrideAndPrejudice.epub', metadata)
+
+Only the fields of the :class:`capybre.metadata.Metadata` that aren't
+``None`` are written; the rest are left as they are in the file.
+
+EPUBs are updated natively by rewriting the OPF package document inside
+the archive, copying every other member without recompressing it; other
+formats, and EPUBs the native writer can't handle, go through Calibre's
+`ebook-meta`_ tool. Either way the new file is written beside the old one
+and renamed over it, so concurrent readers see either the old or the new
+file, never a partial one.
+
+.. _ebook-meta: https://manual.calibre-ebook.com/generated/en/ebook-meta.html
+"""
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import List
+from xml.etree import ElementTree
+
+from .ebook_format import EbookFormat
+from .epub import UnsupportedEpub, read_opf, replace_member
+from .helpers import bounded_map, call
+from .opf import update_opf, _series_name_and_index
+
+
+def write_metadata(input_file, metadata, native=True, suppress_output=True, limits=None):
+    """Writes metadata into an ebook file, replacing it atomically
+
+    Args:
+        input_file (str): path to the ebook
+        metadata (Metadata): Fields to write; those that are ``None`` are
+            left unchanged
+        native (bool, optional): Update EPUBs without ``ebook-meta`` where
+            possible. Defaults to ``True``
+        suppress_output (bool, optional): Suppresses stdout from the
+            ebook-meta call. Defaults to ``True``
+        limits (ResourceLimits, optional): Limits for the ebook-meta call,
+            overriding the global ones, see :mod:`capybre.limits`
+    Raises:
+        subprocess.CalledProcessError: if ebook-meta exits unsuccessfully,
+            in which case the file is left unchanged
+    """
+    if native and EbookFormat.from_filename(input_file) == EbookFormat.EPUB:
+        try:
+            path, document = read_opf(input_file)
+            document = update_opf(document, metadata)
+        except (zipfile.BadZipFile, KeyError, ValueError, ElementTree.ParseError, UnsupportedEpub):
+            pass
+        else:
+            try:
+                with _replacement(input_file) as output_file:
+                    replace_member(input_file, output_file, path, document)
+                return
+            except UnsupportedEpub:
+                pass
+    with _replacement(input_file) as output_file:
+        shutil.copyfile(input_file, output_file)
+        call(
+            ['ebook-meta', output_file] + metadata_args(metadata),
+            suppress_output,
+            check=True,
+            limits=limits
+        )
+
+
+def metadata_args(metadata) -> List[str]:
+    """The ``ebook-meta`` options setting each field of metadata that isn't ``None``"""
+    args = []
+    if metadata.title is not None:
+        args += ['--title', metadata.title]
+    if metadata.authors:
+        args += ['--authors', ' & '.join(metadata.authors)]
+    elif metadata.author is not None:
+        args += ['--authors', metadata.author]
+    if metadata.author_sort is not None:
+        args += ['--author-sort', metadata.author_sort]
+    if metadata.description is not None:
+        args += ['--comments', metadata.description]
+    if metadata.publisher is not None:
+        args += ['--publisher', metadata.publisher]
+    if metadata.tags is not None:
+        args += ['--tags', ','.join(metadata.tags)]
+    if metadata.series is not None:
+        series, index = _series_name_and_index(metadata)
+        args += ['--series', series, '--index', str(index)]
+    if metadata.rating is not None:
+        args += ['--rating', str(metadata.rating)]
+    if metadata.language is not None:
+        args += ['--language', metadata.language]
+    for scheme, value in sorted((metadata.identifiers or {}).items()):
+        args += ['--identifier', '{}:{}'.format(scheme, value)]
+    if metadata.isbn is not None:
+        args += ['--isbn', metadata.isbn]
+    if metadata.publication_date is not None:
+        args += ['--date', metadata.publication_date.isoformat()]
+    return args
+
+
+class _replacement:
+    """Context object giving a temporary path beside path, renamed over path
+    if the body succeeds and removed otherwise"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = None
+
+    def __enter__(self):
+        directory, name = os.path.split(self.path)
+        fd, self.tmp = tempfile.mkstemp(
+            prefix='.tmp-', suffix=os.path.splitext(name)[1], dir=directory or '.'
+        )
+        os.close(fd)
+        return self.tmp
+
+    def __exit__(self, type, value, traceback):
+        if value is None:
+            shutil.copymode(self.path, self.tmp)
+            os.replace(self.tmp, self.path)
+        elif os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+class WriteResult:
+    """Outcome of a single write run by :func:`write_metadata_many`
+
+    Args:
+        input_file (str): The ebook written to
+        metadata (Metadata): The metadata written
+        error (Exception): The exception raised by the write, if any
+    """
+
+    def __init__(self, input_file, metadata, error=None):
+        self.input_file = input_file
+        self.metadata = metadata
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def write_metadata_many(writes, max_workers=None, native=True, limits=None):
+    """Writes metadata into many ebooks in parallel, yielding results as each finishes
+
+    A failing write does not stop the others; its exception is reported on
+    the yielded result instead. For use like ::
+
+        fixes = ((path, Metadata(publisher='Penguin')) for path in paths)
+        for result in write_metadata_many(fixes):
+            if not result.ok:
+                log(result.input_file, result.error)
+
+    Args:
+        writes (Iterable[Tuple[str, Metadata]]): (path, metadata) pairs to
+            write. Consumed lazily
+        max_workers (int, optional): Number of writes to run at once.
+            Defaults to the number of available cores
+        native (bool, optional): Update EPUBs without ``ebook-meta`` where
+            possible. Defaults to ``True``
+        limits (ResourceLimits, optional): Limits for each ebook-meta call
+    Yields:
+        :class:`WriteResult` for each write, in order of completion
+    """
+    def run(write):
+        write_metadata(write[0], write[1], native=native, limits=limits)
+
+    for (input_file, metadata), _, error in bounded_map(run, writes, max_workers):
+        yield WriteResult(input_file, metadata, error)
@@ -14,6 +14,9 @@ setup(
     author_email='nolanhhawkins@gmail.com',
     license='MIT',
     packages=['capybre'],
+    entry_points={
+        'console_scripts': ['capybre=capybre.cli:main'],
+    },
     zip_safe=False,
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -1,4 +1,5 @@
 import os
+import sys
 
 SAMPLE = 'PrideAndPrejudice.epub'
 
@@ -11,6 +12,28 @@ def local_path(file):
 
 SAMPLE_FILE = local_path(SAMPLE)
 
+# stand-ins for the Calibre tools, whose speed is set by CAPYBRE_STUB_LATENCY
+STUBS = os.path.join(os.path.dirname(THIS_DIR), 'benchmarks', 'stubs')
+
 
 def local_files():
     return os.listdir(local_path('.'))
+
+
+def alive(pid):
+    """Whether pid is a running, unreaped process"""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def write_tool(directory, name, source):
+    """Writes a Python script named name into directory, runnable as a
+    Calibre tool by a :class:`capybre.toolchain.Toolchain` over directory"""
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write('#!{}\n{}'.format(sys.executable, source))
+    os.chmod(path, 0o755)
+    return path
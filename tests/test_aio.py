@@ -0,0 +1,88 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from capybre import (
+    async_convert,
+    async_extract_cover,
+    async_extract_metadata,
+    EbookFormat,
+)
+from capybre.toolchain import set_toolchain, Toolchain
+
+from . import helpers
+
+
+# an ebook-convert that starts a grandchild, records both pids and hangs
+HANGING_CONVERT = '''
+import os, subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+with open(os.environ["CAPYBRE_TEST_PIDS"], "w") as f:
+    f.write("{} {}".format(os.getpid(), child.pid))
+time.sleep(60)
+'''
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class AsyncTest(TestCase):
+    def test_async_convert(self):
+        output_file = helpers.local_path('async.mobi')
+        run(async_convert(helpers.SAMPLE_FILE, output_file=output_file))
+        self.assertTrue(os.path.isfile(output_file))
+        os.remove(output_file)
+
+    def test_async_metadata(self):
+        metadata = run(async_extract_metadata(helpers.SAMPLE_FILE))
+        self.assertEqual(metadata.title, 'Pride and Prejudice')
+        self.assertEqual(metadata.author_sort, 'Austen, Jane')
+        self.assertEqual(metadata.ebook_format, EbookFormat.EPUB)
+
+    def test_async_cover_extraction(self):
+        file = helpers.local_path('async_cover.jpg')
+        run(async_extract_cover(helpers.SAMPLE_FILE, file))
+        self.assertTrue(os.path.isfile(file))
+        os.remove(file)
+
+    def test_concurrent_metadata(self):
+        async def gather():
+            return await asyncio.gather(*[
+                async_extract_metadata(helpers.SAMPLE_FILE) for _ in range(4)
+            ])
+        results = run(gather())
+        self.assertEqual([m.title for m in results], ['Pride and Prejudice'] * 4)
+
+    def test_cancel_kills_process_group(self):
+        if not os.path.isdir('/proc'):
+            self.skipTest('needs /proc')
+        with tempfile.TemporaryDirectory() as directory:
+            helpers.write_tool(directory, 'ebook-convert', HANGING_CONVERT)
+            pid_file = os.path.join(directory, 'pids')
+            os.environ['CAPYBRE_TEST_PIDS'] = pid_file
+            set_toolchain(Toolchain(directory))
+            try:
+                async def cancel():
+                    task = asyncio.ensure_future(
+                        async_convert(helpers.SAMPLE_FILE, os.path.join(directory, 'out.mobi'))
+                    )
+                    while not os.path.exists(pid_file) or not os.path.getsize(pid_file):
+                        await asyncio.sleep(0.05)
+                    task.cancel()
+                    with self.assertRaises(asyncio.CancelledError):
+                        await task
+
+                run(asyncio.wait_for(cancel(), 30))
+                with open(pid_file) as f:
+                    pids = [int(pid) for pid in f.read().split()]
+            finally:
+                del os.environ['CAPYBRE_TEST_PIDS']
+                set_toolchain(None)
+        for _ in range(50):
+            if not any(helpers.alive(pid) for pid in pids):
+                break
+            time.sleep(0.1)
+        self.assertEqual([pid for pid in pids if helpers.alive(pid)], [])
@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from capybre.cli import main
+
+from . import helpers
+
+
+class BatchTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.directory, 'books.jsonl')
+        self.results = os.path.join(self.directory, 'books.results.jsonl')
+        self.books = []
+        for i in range(3):
+            path = os.path.join(self.directory, 'book{}.epub'.format(i))
+            shutil.copyfile(helpers.SAMPLE_FILE, path)
+            self.books.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_manifest(self, items):
+        with open(self.manifest, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+
+    def run_main(self, *argv):
+        stderr = io.StringIO()
+        with mock.patch('sys.stderr', stderr):
+            code = main(list(argv))
+        return code, stderr.getvalue()
+
+    def read_results(self):
+        with open(self.results) as f:
+            return [json.loads(line) for line in f]
+
+    def test_convert(self):
+        output_file = os.path.join(self.directory, 'out.txt')
+        self.write_manifest(self.books[:2] + [{'input_file': self.books[2], 'output_file': output_file}])
+        code, stderr = self.run_main('convert', self.manifest, '--as-ext', 'mobi', '--jobs', '2')
+        self.assertEqual(code, 0)
+        self.assertIn('3/3 done, 0 failed', stderr)
+        results = self.read_results()
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(r['ok'] and r['seconds'] >= 0 for r in results))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'book0.mobi')))
+        self.assertTrue(os.path.exists(output_file))
+
+    def test_meta(self):
+        self.write_manifest(self.books)
+        code, _ = self.run_main('meta', self.manifest)
+        self.assertEqual(code, 0)
+        for result in self.read_results():
+            self.assertEqual(result['result']['metadata']['title'], 'Pride and Prejudice')
+
+    def test_cover(self):
+        cover_file = os.path.join(self.directory, 'cover.jpg')
+        self.write_manifest([{'input_file': self.books[0], 'output_file': cover_file}])
+        code, _ = self.run_main('cover', self.manifest)
+        self.assertEqual(code, 0)
+        self.assertGreater(os.path.getsize(cover_file), 0)
+
+    def test_resume(self):
+        missing = os.path.join(self.directory, 'missing.epub')
+        self.write_manifest(self.books[:2] + [missing])
+        code, _ = self.run_main('convert', self.manifest, '--as-ext', 'mobi')
+        self.assertEqual(code, 1)
+        failed = [r for r in self.read_results() if not r['ok']]
+        self.assertEqual([r['item'] for r in failed], [missing])
+
+        shutil.copyfile(helpers.SAMPLE_FILE, missing)
+        code, stderr = self.run_main('convert', self.manifest, '--as-ext', 'mobi', '--resume')
+        self.assertEqual(code, 0)
+        self.assertIn('Skipping 2 items', stderr)
+        results = self.read_results()
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[-1]['item'], missing)
+        self.assertTrue(results[-1]['ok'])
+
+    def test_bad_manifest(self):
+        with open(self.manifest, 'w') as f:
+            f.write('"book.epub"\nnot json\n')
+        code, stderr = self.run_main('meta', self.manifest)
+        self.assertEqual(code, 2)
+        self.assertIn('line 2', stderr)
+
+    def test_sync_dry_run(self):
+        mirror = os.path.join(self.directory, 'mirror')
+        stdout = io.StringIO()
+        with mock.patch('sys.stdout', stdout):
+            code, stderr = self.run_main('sync', self.directory, mirror, '--as-ext', 'mobi', '--dry-run')
+        self.assertEqual(code, 0)
+        self.assertIn('convert book0.epub -> book0.mobi (missing)', stdout.getvalue())
+        self.assertIn('3 to convert', stderr)
+        self.assertFalse(os.path.exists(mirror))
@@ -1,7 +1,21 @@
 import os
+import shutil
+import subprocess
+import tempfile
 from unittest import TestCase
 
-from capybre import convert, converted_fileobj, EbookFormat
+from capybre import (
+    convert,
+    convert_bytes,
+    convert_many,
+    convert_to_buffer,
+    convert_to_many,
+    converted_fileobj,
+    EbookFormat,
+)
+
+from capybre.helpers import scratch_dir
+from capybre.instrumentation import add_listener, remove_listener
 
 from . import helpers
 
@@ -34,3 +48,84 @@ class ConversionTest(TestCase):
             self.assertEqual(f.mode, 'rb')
         self.assertTrue(f_file.closed)
         self.assertEqual(helpers.local_files(), initial_dir)
+
+    def test_convert_context_failure(self):
+        initial_scratch = set(os.listdir(scratch_dir()))
+        with self.assertRaises(Exception):
+            with converted_fileobj(helpers.local_path('missing.epub'), as_ext='mobi'):
+                pass
+        self.assertEqual(set(os.listdir(scratch_dir())), initial_scratch)
+
+    def test_convert_many(self):
+        outputs = [helpers.local_path('many{}.mobi'.format(i)) for i in range(3)]
+        jobs = [
+            {'input_file': helpers.SAMPLE_FILE, 'output_file': output}
+            for output in outputs
+        ] + [helpers.local_path('missing.epub')]
+        results = list(convert_many(jobs, max_workers=2, as_ext='mobi'))
+
+        self.assertEqual(len(results), 4)
+        failed = [r for r in results if not r.ok]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].job, helpers.local_path('missing.epub'))
+        for output in outputs:
+            self.assertTrue(os.path.isfile(output))
+            os.remove(output)
+
+    def test_convert_many_job_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'book.epub')
+            shutil.copyfile(helpers.SAMPLE_FILE, input_file)
+            jobs = [{'input_file': input_file, 'as_format': EbookFormat.TXT}]
+            results = list(convert_many(jobs, as_ext='mobi'))
+            self.assertEqual(results[0].output_file, os.path.join(directory, 'book.txt'))
+
+    def test_convert_bytes(self):
+        initial_dir = helpers.local_files()
+        with open(helpers.SAMPLE_FILE, 'rb') as f:
+            converted = convert_bytes(f, 'epub', as_ext='mobi')
+        self.assertTrue(len(converted) > 0)
+
+        with open(helpers.SAMPLE_FILE, 'rb') as f:
+            buffer = convert_to_buffer(f.read(), 'epub', as_format=EbookFormat.MOBI)
+        self.assertEqual(buffer.read(), converted)
+        self.assertEqual(helpers.local_files(), initial_dir)
+
+    def test_convert_to_many(self):
+        invocations = []
+        add_listener(invocations.append)
+        try:
+            formats = [EbookFormat.MOBI, EbookFormat.AZW3, EbookFormat.TXT, EbookFormat.HTMLZ]
+            outputs = convert_to_many(helpers.SAMPLE_FILE, formats, profile='quality')
+        finally:
+            remove_listener(invocations.append)
+
+        self.assertEqual(sorted(outputs), sorted(formats))
+        for fmt, output in outputs.items():
+            self.assertEqual(output, helpers.local_path('PrideAndPrejudice.' + fmt.to_ext()))
+            self.assertTrue(os.path.isfile(output))
+            os.remove(output)
+
+        # parsed once, then one conversion per format besides the intermediate
+        self.assertEqual(len(invocations), 4)
+        first, rest = invocations[0], invocations[1:]
+        self.assertEqual(first.input_file, helpers.SAMPLE_FILE)
+        self.assertEqual(first.output_format, 'htmlz')
+        self.assertIn('--smarten-punctuation', first.args)
+        for invocation in rest:
+            self.assertEqual(invocation.input_file, first.output_file)
+            self.assertNotIn('--smarten-punctuation', invocation.args)
+
+    def test_convert_to_many_single(self):
+        with tempfile.TemporaryDirectory() as directory:
+            outputs = convert_to_many(helpers.SAMPLE_FILE, [EbookFormat.MOBI], output_dir=directory)
+            self.assertEqual(outputs, {EbookFormat.MOBI: os.path.join(directory, 'PrideAndPrejudice.mobi')})
+            self.assertTrue(os.path.isfile(outputs[EbookFormat.MOBI]))
+
+    def test_convert_to_many_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bad = os.path.join(directory, 'bad.epub')
+            with open(bad, 'wb') as f:
+                f.write(b'not an ebook')
+            with self.assertRaises(subprocess.CalledProcessError):
+                convert_to_many(bad, [EbookFormat.MOBI, EbookFormat.PDF])
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from capybre import convert, converted_fileobj, ConversionCache
+
+from . import helpers
+
+
+class ConversionCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ConversionCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache_hit(self):
+        output_file = helpers.local_path('cached.mobi')
+        for _ in range(2):
+            convert(helpers.SAMPLE_FILE, output_file=output_file, cache=self.cache)
+            self.assertTrue(os.path.isfile(output_file))
+            os.remove(output_file)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_cache_context(self):
+        initial_dir = helpers.local_files()
+        for _ in range(2):
+            with converted_fileobj(helpers.SAMPLE_FILE, as_ext='mobi', cache=self.cache) as f:
+                self.assertTrue(len(f.read()) > 0)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(helpers.local_files(), initial_dir)
+
+    def test_concurrent_requests_convert_once(self):
+        outputs = [helpers.local_path('flight{}.mobi'.format(i)) for i in range(4)]
+        threads = [
+            threading.Thread(
+                target=convert,
+                args=(helpers.SAMPLE_FILE, output),
+                kwargs={'cache': self.cache}
+            )
+            for output in outputs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.misses, 1)
+        for output in outputs:
+            self.assertTrue(os.path.isfile(output))
+            os.remove(output)
+
+    def test_eviction(self):
+        cache = ConversionCache(self.directory, max_bytes=1)
+        output_file = helpers.local_path('evicted.mobi')
+        convert(helpers.SAMPLE_FILE, output_file=output_file, cache=cache)
+        convert(helpers.SAMPLE_FILE, output_file=helpers.local_path('evicted.txt'), cache=cache)
+        self.assertEqual(len(list(cache._entries())), 1)
+        # an evicted entry's lock file goes with it
+        mobi_key = cache.key(helpers.SAMPLE_FILE, 'mobi')
+        self.assertFalse(os.path.exists(cache._lock_path(mobi_key)))
+        os.remove(output_file)
+        os.remove(helpers.local_path('evicted.txt'))
+
+    def test_eviction_skips_entries_in_use(self):
+        output_file = helpers.local_path('in_use.mobi')
+        convert(helpers.SAMPLE_FILE, output_file=output_file, cache=self.cache)
+        os.remove(output_file)
+        key = self.cache.key(helpers.SAMPLE_FILE, 'mobi')
+        cached = self.cache.path(key, 'mobi')
+        self.cache.max_bytes = 1
+        # as held by a hit while it copies the entry out
+        with self.cache._file_lock(key, shared=True):
+            self.cache.evict()
+            self.assertTrue(os.path.exists(cached))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(cached))
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'locks')), [])
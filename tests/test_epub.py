@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import date
+from unittest import TestCase
+
+from capybre import epub, EbookFormat
+from capybre.metadata import clean_metadata_map
+
+from . import helpers
+
+CONTAINER = '''<?xml version="1.0"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles>
+    <rootfile full-path="OPS/package.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+EPUB3_OPF = '''<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="uid">urn:isbn:978-0-679-78326-8</dc:identifier>
+    <dc:title>Pride and Prejudice</dc:title>
+    <dc:creator id="a1">Jane Austen</dc:creator>
+    <meta refines="#a1" property="file-as">Austen, Jane</meta>
+    <dc:creator id="a2">Some Editor</dc:creator>
+    <meta refines="#a2" property="role">edt</meta>
+    <dc:language>en-GB</dc:language>
+    <dc:publisher>Modern Library</dc:publisher>
+    <dc:date>1995-10-10</dc:date>
+    <meta property="belongs-to-collection" id="c1">Austen Novels</meta>
+    <meta refines="#c1" property="group-position">2</meta>
+  </metadata>
+  <manifest>
+    <item id="img" href="images/front%20cover.png" media-type="image/png" properties="cover-image"/>
+  </manifest>
+</package>'''
+
+
+class EpubTest(TestCase):
+    def test_metadata_map_parity(self):
+        # same expectations as MetadataTest.test_metadata_map, made exact
+        self.assertEqual(epub.read_metadata_map(helpers.SAMPLE_FILE), {
+            'Title':       'Pride and Prejudice',
+            'Author(s)':   'Jane Austen [Austen, Jane]',
+            'Tags':        'England -- Fiction, Young women -- Fiction, ' +
+                           'Love stories, Sisters -- Fiction, Domestic fiction, ' +
+                           'Courtship -- Fiction, Social classes -- Fiction',
+            'Languages':   'eng',
+            'Published':   '1998-06-01T00:00:00+00:00',
+            'Rights':      'Public domain in the USA.',
+            'Identifiers': 'uri:http://www.gutenberg.org/1342'
+        })
+
+    def test_metadata_parity(self):
+        metadata = clean_metadata_map(epub.read_metadata_map(helpers.SAMPLE_FILE))
+        self.assertEqual(metadata.author, 'Jane Austen')
+        self.assertEqual(metadata.author_sort, 'Austen, Jane')
+        self.assertEqual(metadata.identifiers, {'uri': 'http://www.gutenberg.org/1342'})
+        self.assertEqual(metadata.language, 'eng')
+        self.assertEqual(metadata.publication_date, date(1998, 6, 1))
+        self.assertEqual(len(metadata.tags), 7)
+        self.assertEqual(metadata.ebook_format, EbookFormat.UNKNOWN)
+
+    def test_cover(self):
+        with zipfile.ZipFile(helpers.SAMPLE_FILE) as archive:
+            expected = archive.read(
+                'OEBPS/@public@vhost@g@gutenberg@html@files@1342@1342-h@images@cover.jpg'
+            )
+        self.assertEqual(epub.read_cover(helpers.SAMPLE_FILE), expected)
+
+    def test_epub3(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'book.epub')
+            with zipfile.ZipFile(path, 'w') as archive:
+                archive.writestr('mimetype', 'application/epub+zip')
+                archive.writestr('META-INF/container.xml', CONTAINER)
+                archive.writestr('OPS/package.opf', EPUB3_OPF)
+                archive.writestr('OPS/images/front cover.png', b'png')
+            metadata = clean_metadata_map(epub.read_metadata_map(path))
+            self.assertEqual(metadata.author, 'Jane Austen')
+            self.assertEqual(metadata.author_sort, 'Austen, Jane')
+            self.assertEqual(metadata.isbn, '9780679783268')
+            self.assertEqual(metadata.language, 'eng')
+            self.assertEqual(metadata.series, 'Austen Novels #2')
+            self.assertEqual(epub.read_cover(path), b'png')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unreadable_falls_back(self):
+        self.assertIsNone(epub.read_metadata_map(helpers.local_path('__init__.py')))
+        self.assertIsNone(epub.read_cover(helpers.local_path('__init__.py')))
@@ -0,0 +1,96 @@
+# This tests requires internet, so should be skipped by GitHub Actions
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from capybre import fetch_metadata, fetch_metadata_many, fetch_cover, FetchCache, MetadataNotFound
+from capybre.fetch_cache import normalize_query
+from capybre.toolchain import set_toolchain, Toolchain
+
+from . import helpers
+
+
+class FetchCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FetchCache(os.path.join(self.directory, 'fetch.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            normalize_query('  Pride and  PREJUDICE', 'Jane Austen', '978-0-679-78326-8'),
+            ('pride and prejudice', 'jane austen', '9780679783268')
+        )
+
+    def test_cache_hit(self):
+        first = fetch_metadata(isbn='9780679783268', cache=self.cache)
+        second = fetch_metadata(isbn='978-0679783268', cache=self.cache)
+        self.assertEqual(first.title, second.title)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_cached_cover(self):
+        output_file = helpers.local_path('cached_cover.jpg')
+        for _ in range(2):
+            metadata = fetch_cover(isbn='9780679783268', output_file=output_file, cache=self.cache)
+            self.assertEqual(metadata.author, 'Jane Austen')
+            self.assertTrue(os.path.isfile(output_file))
+            os.remove(output_file)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_negative_cache(self):
+        for _ in range(2):
+            with self.assertRaises(MetadataNotFound):
+                fetch_metadata(isbn='0000', cache=self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        expired = FetchCache(self.cache.path, negative_ttl=0)
+        with self.assertRaises(MetadataNotFound):
+            fetch_metadata(isbn='0000', cache=expired)
+        self.assertEqual(expired.misses, 1)
+
+    def test_failed_lookup_not_cached(self):
+        # exits 1 like a lookup that found nothing, but for another reason
+        helpers.write_tool(self.directory, 'fetch-ebook-metadata', 'import sys\nsys.exit("network is unreachable")\n')
+        set_toolchain(Toolchain(self.directory))
+        try:
+            for _ in range(2):
+                with self.assertRaises(subprocess.CalledProcessError) as raised:
+                    fetch_metadata(isbn='9780679783268', cache=self.cache)
+                self.assertNotIsInstance(raised.exception, MetadataNotFound)
+        finally:
+            set_toolchain(None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_cache_hits_not_rate_limited(self):
+        fetch_metadata(isbn='9780679783268', cache=self.cache)
+        self.assertTrue(self.cache.cached(isbn='978-0-679-78326-8'))
+        started = time.monotonic()
+        results = list(fetch_metadata_many(
+            [(None, None, '9780679783268')] * 4,
+            rate_limits={'*': 0.5},
+            cache=self.cache
+        ))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(self.cache.hits, 4)
+
+    def test_concurrent_lookups_coalesce(self):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(fetch_metadata(isbn='9780679783268', cache=self.cache))
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(set(m.title for m in results)), 1)
@@ -1,8 +1,15 @@
 # This tests requires internet, so should be skipped by GitHub Actions
 import os
+import tempfile
 from unittest import TestCase
 
-from capybre import fetch_metadata, fetch_cover, fetched_metadata_and_cover
+from capybre import (
+    fetch_metadata,
+    fetch_metadata_many,
+    fetch_cover,
+    fetched_metadata_and_cover,
+    MetadataNotFound,
+)
 
 from . import helpers
 
@@ -56,3 +63,31 @@ class FetchMetadataTest(TestCase):
 
         self.assertTrue(c_file.closed)
         self.assertEqual(helpers.local_files(), initial_dir)
+
+    def test_fetch_metadata_many(self):
+        queries = [
+            (None, None, '9780679783268'),
+            {'title': 'Pride and Prejudice', 'author': 'Jane Austen'},
+            (None, None, '0000'),
+        ]
+        fd, checkpoint = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        try:
+            results = list(fetch_metadata_many(
+                queries,
+                max_workers=2,
+                rate_limits={'*': 5},
+                checkpoint=checkpoint
+            ))
+            self.assertEqual(len(results), 3)
+            found = [r for r in results if r.ok]
+            self.assertEqual(len(found), 2)
+            for result in found:
+                self.assertEqual(result.metadata.author_sort, 'Austen, Jane')
+            missing = [r for r in results if not r.ok]
+            self.assertIsInstance(missing[0].error, MetadataNotFound)
+
+            # everything is checkpointed, so a rerun has nothing left to do
+            self.assertEqual(list(fetch_metadata_many(queries, checkpoint=checkpoint)), [])
+        finally:
+            os.remove(checkpoint)
@@ -0,0 +1,99 @@
+import os
+from unittest import TestCase
+from capybre import convert, extract_metadata
+from capybre.instrumentation import (
+    add_listener,
+    remove_listener,
+    set_tracer,
+    PrometheusExporter,
+)
+
+from . import helpers
+
+
+class RecordingSpan:
+
+    def __init__(self, name):
+        self.name = name
+        self.attributes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exception):
+        self.exception = exception
+
+
+class RecordingTracer:
+
+    def __init__(self):
+        self.spans = []
+
+    def start_as_current_span(self, name):
+        self.spans.append(RecordingSpan(name))
+        return self.spans[-1]
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.invocations = []
+        add_listener(self.invocations.append)
+
+    def tearDown(self):
+        remove_listener(self.invocations.append)
+        set_tracer(None)
+
+    def test_listener(self):
+        extract_metadata(helpers.SAMPLE_FILE, native=False)
+        self.assertEqual(len(self.invocations), 1)
+        invocation = self.invocations[0]
+        self.assertEqual(invocation.tool, 'ebook-meta')
+        self.assertEqual(invocation.input_format, 'epub')
+        self.assertEqual(invocation.input_size, os.path.getsize(helpers.SAMPLE_FILE))
+        self.assertEqual(invocation.exit_code, 0)
+        self.assertGreater(invocation.output_size, 0)
+        self.assertGreater(invocation.wall_time, 0)
+        self.assertIsNotNone(invocation.user_time)
+        self.assertGreater(invocation.max_rss, 0)
+
+    def test_failed_call(self):
+        with self.assertRaises(Exception):
+            extract_metadata(helpers.local_path('missing.epub'), native=False)
+        self.assertNotEqual(self.invocations[0].exit_code, 0)
+        self.assertIsNotNone(self.invocations[0].error)
+
+    def test_tracer(self):
+        tracer = RecordingTracer()
+        set_tracer(tracer)
+        output_file = helpers.local_path('instrumented.mobi')
+        try:
+            convert(helpers.SAMPLE_FILE, output_file)
+        finally:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        span = tracer.spans[0]
+        self.assertEqual(span.name, 'ebook-convert')
+        self.assertEqual(span.attributes['capybre.input_format'], 'epub')
+        self.assertEqual(span.attributes['capybre.output_format'], 'mobi')
+        self.assertGreater(span.attributes['capybre.output_size'], 0)
+
+    def test_prometheus_exporter(self):
+        exporter = PrometheusExporter()
+        add_listener(exporter)
+        try:
+            extract_metadata(helpers.SAMPLE_FILE, native=False)
+        finally:
+            remove_listener(exporter)
+        text = exporter.render()
+        self.assertIn('# TYPE capybre_wall_seconds histogram', text)
+        self.assertIn(
+            'capybre_wall_seconds_count{tool="ebook-meta",input_format="epub",output_format=""} 1',
+            text
+        )
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from capybre import LibraryIndex
+
+from . import helpers
+
+
+class LibraryIndexTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.library = os.path.join(self.directory, 'library')
+        os.makedirs(os.path.join(self.library, 'austen', 'novels'))
+        self.books = [
+            os.path.join(self.library, 'austen', 'novels', 'pride.epub'),
+            os.path.join(self.library, 'austen', 'prejudice.epub'),
+        ]
+        for book in self.books:
+            shutil.copyfile(helpers.SAMPLE_FILE, book)
+        with open(os.path.join(self.library, 'notes.txt.bak'), 'w') as f:
+            f.write('not an ebook')
+        self.index = LibraryIndex(os.path.join(self.directory, 'index.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scan_and_query(self):
+        changes = self.index.scan(self.library)
+        self.assertEqual(sorted(c.path for c in changes), sorted(self.books))
+        self.assertEqual(set(c.kind for c in changes), {'added'})
+        self.assertEqual(len(self.index), 2)
+
+        found = self.index.find(author_sort='Austen, Jane')
+        self.assertEqual([path for path, _ in found], sorted(self.books))
+        self.assertEqual(found[0][1].title, 'Pride and Prejudice')
+        self.assertEqual(len(self.index.search_title('prejudice')), 2)
+        self.assertEqual(self.index.get(self.books[0]).language, 'eng')
+
+    def test_incremental_rescan(self):
+        first = self.index.scan(self.library)
+        self.assertEqual(self.index.scan(self.library), [])
+
+        stat = os.stat(self.books[0])
+        os.utime(self.books[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        os.remove(self.books[1])
+        added = os.path.join(self.library, 'emma.epub')
+        shutil.copyfile(helpers.SAMPLE_FILE, added)
+
+        changes = self.index.scan(self.library)
+        self.assertEqual(
+            sorted((c.kind, c.path) for c in changes),
+            sorted([('modified', self.books[0]), ('removed', self.books[1]), ('added', added)])
+        )
+        feed = self.index.changes_since(first[-1].sequence)
+        self.assertEqual([c.sequence for c in feed], [c.sequence for c in changes])
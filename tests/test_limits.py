@@ -0,0 +1,104 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+from capybre import (
+    async_convert,
+    CalibreTimeout,
+    ResourceLimitExceeded,
+    ResourceLimits,
+    set_limits,
+)
+from capybre.helpers import call
+from capybre.toolchain import set_toolchain, Toolchain
+
+from . import helpers
+
+SPIN = 'while True: pass'
+ALLOCATE = 'b = bytearray(1 << 33)'
+# starts a grandchild that outlives its parent unless its group is killed
+SPAWN = (
+    'import subprocess, sys, time\n'
+    'child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])\n'
+    'open(sys.argv[1], "w").write(str(child.pid))\n'
+    'time.sleep(30)\n'
+)
+
+
+class LimitsTest(TestCase):
+
+    def tearDown(self):
+        set_limits(None)
+
+    def test_timeout(self):
+        started = time.time()
+        with self.assertRaises(CalibreTimeout):
+            call([sys.executable, '-c', 'import time; time.sleep(30)'], limits=ResourceLimits(timeout=0.5))
+        self.assertLess(time.time() - started, 10)
+
+    def test_global_timeout(self):
+        set_limits(ResourceLimits(timeout=0.5))
+        with self.assertRaises(CalibreTimeout):
+            call([sys.executable, '-c', 'import time; time.sleep(30)'])
+        # per-call limits override the global ones
+        call([sys.executable, '-c', 'import time; time.sleep(1)'], limits=ResourceLimits(timeout=10))
+
+    def test_timeout_kills_process_group(self):
+        if not os.path.isdir('/proc'):
+            self.skipTest('needs /proc')
+        pid_file = helpers.local_path('grandchild.pid')
+        try:
+            with self.assertRaises(CalibreTimeout):
+                call([sys.executable, '-c', SPAWN, pid_file], limits=ResourceLimits(timeout=2))
+            with open(pid_file) as f:
+                grandchild = int(f.read())
+        finally:
+            if os.path.exists(pid_file):
+                os.remove(pid_file)
+        for _ in range(50):
+            if not helpers.alive(grandchild):
+                break
+            time.sleep(0.1)
+        self.assertFalse(helpers.alive(grandchild))
+
+    def test_cpu_limit(self):
+        with self.assertRaises(ResourceLimitExceeded) as context:
+            call([sys.executable, '-c', SPIN], limits=ResourceLimits(cpu_seconds=1, timeout=30))
+        self.assertEqual(context.exception.resource, 'cpu')
+
+    def test_memory_limit(self):
+        with self.assertRaises(ResourceLimitExceeded) as context:
+            call([sys.executable, '-c', ALLOCATE], limits=ResourceLimits(memory_bytes=512 << 20))
+        self.assertEqual(context.exception.resource, 'memory')
+
+    def test_nice(self):
+        code = call([sys.executable, '-c', 'import os, sys; sys.exit(os.nice(0))'], limits=ResourceLimits(nice=5))
+        self.assertEqual(code, os.nice(0) + 5)
+
+    def test_crash_is_not_a_memory_breach(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            call(
+                [sys.executable, '-c', 'import os, signal; os.kill(os.getpid(), signal.SIGABRT)'],
+                check=True,
+                limits=ResourceLimits(memory_bytes=4 << 30)
+            )
+        self.assertNotIsInstance(context.exception, ResourceLimitExceeded)
+
+    def test_async_timeout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            helpers.write_tool(directory, 'ebook-convert', 'import time\ntime.sleep(30)\n')
+            set_toolchain(Toolchain(directory))
+            try:
+                started = time.monotonic()
+                with self.assertRaises(CalibreTimeout):
+                    asyncio.get_event_loop().run_until_complete(async_convert(
+                        helpers.SAMPLE_FILE,
+                        os.path.join(directory, 'timeout.mobi'),
+                        limits=ResourceLimits(timeout=0.5)
+                    ))
+                self.assertLess(time.monotonic() - started, 10)
+            finally:
+                set_toolchain(None)
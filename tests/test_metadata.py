@@ -4,10 +4,16 @@ from datetime import date
 from capybre import (
     extract_metadata,
     extract_metadata_map,
+    extract_metadata_and_cover,
     extract_cover,
+    extract_cover_bytes,
     extracted_cover_fileobj,
+    extracted_metadata_and_cover,
     EbookFormat,
 )
+from capybre.helpers import scratch_dir
+from capybre.instrumentation import add_listener, remove_listener
+from capybre.metadata import METADATA_FIELDS
 
 from . import helpers
 
@@ -18,6 +24,7 @@ class MetadataTest(TestCase):
         metadata = extract_metadata(helpers.SAMPLE_FILE)
         expected_dict = {
             'author': 'Jane Austen',
+            'authors': ['Jane Austen'],
             'author_sort': 'Austen, Jane',
             'description': None,
             'ebook_format': EbookFormat.EPUB,
@@ -29,6 +36,7 @@ class MetadataTest(TestCase):
             'publisher': None,
             'rating': None,
             'series': None,
+            'series_index': None,
             'tags': [
                 'England -- Fiction',
                 'Young women -- Fiction',
@@ -40,9 +48,9 @@ class MetadataTest(TestCase):
             ],
             'title': 'Pride and Prejudice'
         }
-        for key, value in metadata.__dict__.items():
+        for key in METADATA_FIELDS:
             self.assertEqual(
-                value,
+                getattr(metadata, key),
                 expected_dict[key],
                 'Metadata item {} doesn\t match'.format(key)
             )
@@ -84,3 +92,45 @@ class MetadataTest(TestCase):
             self.assertTrue(True)
         self.assertTrue(f_file.closed)
         self.assertEqual(helpers.local_files(), initial_dir)
+
+    def test_cover_bytes(self):
+        with open(helpers.SAMPLE_FILE, 'rb') as f:
+            data = f.read()
+        native = extract_cover_bytes(data, 'epub')
+        self.assertTrue(native.startswith(b'\xff\xd8'))
+        self.assertIsNotNone(extract_cover_bytes(data, 'epub', native=False))
+
+    def test_metadata_and_cover(self):
+        invocations = []
+        add_listener(invocations.append)
+        try:
+            native = extract_metadata_and_cover(helpers.SAMPLE_FILE)
+            self.assertEqual(invocations, [])
+            spawned = extract_metadata_and_cover(helpers.SAMPLE_FILE, native=False)
+            self.assertEqual(len(invocations), 1)
+        finally:
+            remove_listener(invocations.append)
+
+        for metadata, cover in (native, spawned):
+            self.assertEqual(metadata.title, 'Pride and Prejudice')
+            self.assertEqual(metadata.author, 'Jane Austen')
+            self.assertEqual(metadata.ebook_format, EbookFormat.EPUB)
+            self.assertTrue(cover.startswith(b'\xff\xd8'))
+        separate = extract_metadata(helpers.SAMPLE_FILE, native=False)
+        self.assertEqual(spawned[0].to_dict(), separate.to_dict())
+
+    def test_metadata_and_cover_temporary(self):
+        initial_dir = helpers.local_files()
+        with extracted_metadata_and_cover(helpers.SAMPLE_FILE, native=False) as (metadata, cover):
+            self.assertEqual(metadata.title, 'Pride and Prejudice')
+            self.assertEqual(cover.mode, 'rb')
+            self.assertTrue(cover.read().startswith(b'\xff\xd8'))
+        self.assertTrue(cover.closed)
+        self.assertEqual(helpers.local_files(), initial_dir)
+
+    def test_metadata_and_cover_temporary_failure(self):
+        initial_scratch = set(os.listdir(scratch_dir()))
+        with self.assertRaises(Exception):
+            with extracted_metadata_and_cover(helpers.local_path('missing.epub'), native=False):
+                pass
+        self.assertEqual(set(os.listdir(scratch_dir())), initial_scratch)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from capybre import extract_metadata, extract_metadata_map, MetadataCache
+
+from . import helpers
+
+
+class MetadataCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sample = os.path.join(self.directory, helpers.SAMPLE)
+        shutil.copyfile(helpers.SAMPLE_FILE, self.sample)
+        self.cache = MetadataCache(os.path.join(self.directory, 'metadata.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache_hit(self):
+        first = extract_metadata_map(self.sample, cache=self.cache)
+        second = extract_metadata_map(self.sample, cache=self.cache)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            extract_metadata(self.sample, cache=self.cache).title,
+            'Pride and Prejudice'
+        )
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_modified_file_misses(self):
+        extract_metadata_map(self.sample, cache=self.cache)
+        stat = os.stat(self.sample)
+        os.utime(self.sample, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertIsNone(self.cache.get(self.sample))
+
+    def test_verified_hash_survives_touch(self):
+        cache = MetadataCache(os.path.join(self.directory, 'verified.db'), verify_hash=True)
+        extract_metadata_map(self.sample, cache=cache)
+        stat = os.stat(self.sample)
+        os.utime(self.sample, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertIsNotNone(cache.get(self.sample))
+
+    def test_invalidate(self):
+        extract_metadata_map(self.sample, cache=self.cache)
+        self.cache.invalidate(self.sample)
+        self.assertIsNone(self.cache.get(self.sample))
+        self.assertEqual(self.cache.stats()['entries'], 0)
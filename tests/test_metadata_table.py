@@ -0,0 +1,95 @@
+import io
+import json
+from unittest import TestCase
+from datetime import date, datetime, timedelta, timezone
+from capybre import EbookFormat, Metadata, MetadataTable
+from capybre.metadata import METADATA_FIELDS
+
+
+def sample_records():
+    return [
+        Metadata(
+            title='Good Omens',
+            author='Terry Pratchett & Neil Gaiman',
+            authors=['Terry Pratchett', 'Neil Gaiman'],
+            author_sort='Pratchett, Terry & Gaiman, Neil',
+            ebook_format=EbookFormat.EPUB,
+            identifiers={'isbn': '9780060853983', 'google': '4kWbAAAACAAJ'},
+            isbn='9780060853983',
+            language='eng',
+            publication_date=datetime(1990, 5, 1, 4, tzinfo=timezone(timedelta(hours=-4))),
+            rating=4,
+            tags=['Fantasy', 'Humor'],
+        ),
+        Metadata(
+            title='The Colour of Magic',
+            author='Terry Pratchett',
+            authors=['Terry Pratchett'],
+            author_sort='Pratchett, Terry',
+            ebook_format=EbookFormat.MOBI,
+            language='eng',
+            last_edited=date(2020, 1, 2),
+            series='Discworld #1',
+            series_index=1.0,
+            tags=['Fantasy'],
+        ),
+        Metadata(title='Pride and Prejudice', language='eng', isbn='9780060853983'),
+    ]
+
+
+class MetadataTableTest(TestCase):
+
+    def assertSameMetadata(self, first, second):
+        # datetimes compare equal across timezones, unlike their ISO strings
+        for field in METADATA_FIELDS:
+            self.assertEqual(getattr(first, field), getattr(second, field), field)
+
+    def test_slots(self):
+        self.assertEqual(set(Metadata.__slots__), set(METADATA_FIELDS))
+        self.assertFalse(hasattr(Metadata(), '__dict__'))
+
+    def test_round_trip(self):
+        records = sample_records()
+        table = MetadataTable(records)
+        self.assertEqual(len(table), 3)
+        for record, row in zip(records, table):
+            self.assertSameMetadata(record, row)
+        self.assertEqual(table[-1].title, 'Pride and Prejudice')
+        # interned once, however many rows and columns use it
+        self.assertEqual(table.strings.count('Terry Pratchett'), 1)
+
+    def test_where_and_group_by(self):
+        table = MetadataTable(sample_records())
+        self.assertEqual(table.where('tags', 'Fantasy'), [0, 1])
+        self.assertEqual(table.where('title', lambda t: t.startswith('The ')), [1])
+        self.assertEqual(table.where('series', None), [0, 2])
+        self.assertEqual(table.where('rating', 4), [0])
+        self.assertEqual(
+            table.group_by('isbn'),
+            {'9780060853983': [0, 2], None: [1]}
+        )
+        self.assertEqual(
+            [m.title for m in table.take(table.where('ebook_format', EbookFormat.MOBI))],
+            ['The Colour of Magic']
+        )
+
+    def test_buffers(self):
+        table = MetadataTable(sample_records())
+        buffers = table.buffers()
+        self.assertEqual(buffers['title'].format, 'i')
+        self.assertEqual(buffers['publication_date'].itemsize, 8)
+        self.assertEqual(buffers['tags.offsets'].tolist(), [0, 2, 3, 3])
+        self.assertEqual(
+            [table.strings[i] for i in buffers['tags.values'].tolist()],
+            ['Fantasy', 'Humor', 'Fantasy']
+        )
+        self.assertEqual(buffers['publication_date'][0], 641548800)
+
+    def test_to_jsonl(self):
+        records = sample_records()
+        output = io.StringIO()
+        MetadataTable(records).to_jsonl(output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        for record, line in zip(records, lines):
+            self.assertSameMetadata(Metadata.from_dict(json.loads(line)), record)
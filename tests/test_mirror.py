@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from capybre import plan_sync, sync_converted
+from capybre.mirror import CHANGED, MISSING, OPTIONS
+
+from . import helpers
+
+
+class MirrorTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, 'library')
+        self.dst = os.path.join(self.directory, 'mirror')
+        os.makedirs(os.path.join(self.src, 'austen'))
+        for name in ('austen/pride.epub', 'austen/emma.epub', 'persuasion.epub'):
+            shutil.copyfile(helpers.SAMPLE_FILE, os.path.join(self.src, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def sync(self, **kwargs):
+        return sync_converted(self.src, self.dst, as_ext='mobi', **kwargs)
+
+    def test_initial_sync(self):
+        report = self.sync()
+        self.assertTrue(report.ok)
+        self.assertEqual(
+            sorted(report.converted),
+            ['austen/emma.mobi', 'austen/pride.mobi', 'persuasion.mobi']
+        )
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'austen', 'pride.mobi')))
+        self.assertEqual([name for name in os.listdir(self.dst) if name.startswith('.tmp-')], [])
+
+    def test_unchanged_sync_converts_nothing(self):
+        self.sync()
+        report = self.sync()
+        self.assertTrue(report.plan.up_to_date)
+        self.assertEqual(report.plan.unchanged, 3)
+        self.assertEqual(report.converted, [])
+
+    def test_reconverts_stale_outputs(self):
+        self.sync()
+        touched = os.path.join(self.src, 'persuasion.epub')
+        os.utime(touched, ns=(0, 0))
+        with open(os.path.join(self.src, 'austen', 'emma.epub'), 'ab') as f:
+            f.write(b'edited')
+        os.remove(os.path.join(self.dst, 'austen', 'pride.mobi'))
+        plan = plan_sync(self.src, self.dst, as_ext='mobi')
+        self.assertEqual(
+            sorted(plan.convert),
+            [('austen/emma.epub', 'austen/emma.mobi', CHANGED),
+             ('austen/pride.epub', 'austen/pride.mobi', MISSING)]
+        )
+        self.assertEqual(plan.unchanged, 1)
+
+    def test_profile_change_reconverts(self):
+        self.sync()
+        plan = plan_sync(self.src, self.dst, as_ext='mobi', profile='fast')
+        self.assertEqual(len(plan.convert), 3)
+        self.assertTrue(all(reason == OPTIONS for _, _, reason in plan.convert))
+
+    def test_deletes_orphans(self):
+        self.sync()
+        unrelated = os.path.join(self.dst, 'notes.txt')
+        with open(unrelated, 'w') as f:
+            f.write('keep me')
+        shutil.rmtree(os.path.join(self.src, 'austen'))
+        report = self.sync()
+        self.assertEqual(sorted(report.deleted), ['austen/emma.mobi', 'austen/pride.mobi'])
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'austen')))
+        self.assertTrue(os.path.exists(unrelated))
+
+    def test_dry_run(self):
+        report = self.sync(dry_run=True)
+        self.assertTrue(report.dry_run)
+        self.assertEqual(len(report.plan.convert), 3)
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_failed_conversion_retried(self):
+        with open(os.path.join(self.src, 'bad.epub'), 'wb') as f:
+            f.write(b'not an ebook')
+        report = self.sync()
+        self.assertEqual(list(report.failed), ['bad.mobi'])
+        plan = plan_sync(self.src, self.dst, as_ext='mobi')
+        self.assertEqual(plan.convert, [('bad.epub', 'bad.mobi', MISSING)])
+
+    def test_conflicts(self):
+        shutil.copyfile(helpers.SAMPLE_FILE, os.path.join(self.src, 'persuasion.azw3'))
+        plan = plan_sync(self.src, self.dst, as_ext='mobi', source_formats=['azw3', 'epub'])
+        self.assertEqual(plan.conflicts, ['persuasion.epub'])
+        self.assertIn(('persuasion.azw3', 'persuasion.mobi', MISSING), plan.convert)
@@ -0,0 +1,133 @@
+import io
+from unittest import TestCase
+from datetime import date, datetime, timedelta, timezone
+from capybre import extract_metadata, EbookFormat
+from capybre.metadata import Metadata, extract_raw_metadata_map
+from capybre.opf import parse_opf, update_opf
+
+from . import helpers
+
+OPF2 = b'''<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="uuid_id" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:identifier opf:scheme="calibre" id="calibre_id">7</dc:identifier>
+    <dc:identifier opf:scheme="uuid" id="uuid_id">1b5e0f3c-0000-4000-8000-000000000000</dc:identifier>
+    <dc:title>Good Omens</dc:title>
+    <dc:creator opf:file-as="Pratchett, Terry" opf:role="aut">Terry Pratchett</dc:creator>
+    <dc:creator opf:file-as="Gaiman, Neil" opf:role="aut">Neil Gaiman</dc:creator>
+    <dc:contributor opf:file-as="calibre" opf:role="bkp">calibre (5.0)</dc:contributor>
+    <dc:date>1990-05-01T04:00:00-04:00</dc:date>
+    <dc:description>An angel and a demon
+      avert the apocalypse.</dc:description>
+    <dc:identifier opf:scheme="ISBN">9780060853983</dc:identifier>
+    <dc:identifier opf:scheme="GOOGLE">4kWbAAAACAAJ</dc:identifier>
+    <dc:language>eng</dc:language>
+    <dc:subject>Fantasy</dc:subject>
+    <dc:subject>Humor</dc:subject>
+    <meta name="calibre:series" content="Standalone"/>
+    <meta name="calibre:series_index" content="1.5"/>
+    <meta name="calibre:rating" content="8"/>
+    <meta name="calibre:timestamp" content="0101-01-01T00:00:00+00:00"/>
+  </metadata>
+  <manifest><item id="x" href="x.html" media-type="application/xhtml+xml"/></manifest>
+</package>
+'''
+
+OPF3 = b'''<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>The Colour of Magic</dc:title>
+    <dc:creator id="author">Terry Pratchett</dc:creator>
+    <dc:identifier id="isbn">urn:isbn:9780062225672</dc:identifier>
+    <dc:date>1983</dc:date>
+    <meta property="belongs-to-collection" id="c1">Discworld</meta>
+    <meta refines="#c1" property="group-position">1</meta>
+    <meta refines="#author" property="file-as">Pratchett, Terry</meta>
+  </metadata>
+</package>
+'''
+
+
+class OPFTest(TestCase):
+
+    def test_parse_opf(self):
+        metadata = parse_opf(io.BytesIO(OPF2))
+        self.assertEqual(metadata.title, 'Good Omens')
+        self.assertEqual(metadata.authors, ['Terry Pratchett', 'Neil Gaiman'])
+        self.assertEqual(metadata.author, 'Terry Pratchett & Neil Gaiman')
+        self.assertEqual(metadata.author_sort, 'Pratchett, Terry & Gaiman, Neil')
+        self.assertEqual(
+            metadata.identifiers,
+            {'isbn': '9780060853983', 'google': '4kWbAAAACAAJ'}
+        )
+        self.assertEqual(metadata.isbn, '9780060853983')
+        self.assertEqual(metadata.description, 'An angel and a demon avert the apocalypse.')
+        self.assertEqual(metadata.series, 'Standalone #1.5')
+        self.assertEqual(metadata.series_index, 1.5)
+        self.assertEqual(metadata.rating, 4)
+        self.assertEqual(metadata.tags, ['Fantasy', 'Humor'])
+        self.assertEqual(
+            metadata.publication_date,
+            datetime(1990, 5, 1, 4, tzinfo=timezone(timedelta(hours=-4)))
+        )
+        # Calibre's placeholder for an unknown date
+        self.assertIsNone(metadata.last_edited)
+
+    def test_parse_epub3_opf(self):
+        metadata = parse_opf(io.BytesIO(OPF3))
+        self.assertEqual(metadata.author_sort, 'Pratchett, Terry')
+        self.assertEqual(metadata.isbn, '9780062225672')
+        self.assertEqual(metadata.series, 'Discworld #1')
+        self.assertEqual(metadata.series_index, 1.0)
+        self.assertEqual(metadata.publication_date, date(1983, 1, 1))
+
+    def test_extract_opf_metadata(self):
+        metadata = extract_metadata(helpers.SAMPLE_FILE, opf=True)
+        self.assertEqual(metadata.title, 'Pride and Prejudice')
+        self.assertEqual(metadata.authors, ['Jane Austen'])
+        self.assertEqual(metadata.ebook_format, EbookFormat.EPUB)
+
+    def test_text_continuation_lines(self):
+        metadata_map = extract_raw_metadata_map([
+            'Title               : Good Omens',
+            'Comments            : An angel and a demon',
+            'avert the apocalypse.',
+        ])
+        self.assertEqual(metadata_map['Comments'], 'An angel and a demon avert the apocalypse.')
+
+    def test_update_opf(self):
+        updated = update_opf(OPF2, Metadata(
+            title='Good Omens: The Nice and Accurate Prophecies',
+            authors=['Neil Gaiman', 'Terry Pratchett'],
+            series='Standalone #2',
+            isbn='9780552137034',
+        ))
+        metadata = parse_opf(io.BytesIO(updated))
+        self.assertEqual(metadata.title, 'Good Omens: The Nice and Accurate Prophecies')
+        self.assertEqual(metadata.author_sort, 'Gaiman, Neil & Pratchett, Terry')
+        self.assertEqual(metadata.series_index, 2)
+        self.assertEqual(
+            metadata.identifiers,
+            {'isbn': '9780552137034', 'google': '4kWbAAAACAAJ'}
+        )
+        # untouched fields and the rest of the package are kept
+        self.assertEqual(metadata.tags, ['Fantasy', 'Humor'])
+        self.assertEqual(metadata.rating, 4)
+        self.assertIn(b'opf:role="bkp">calibre (5.0)</dc:contributor>', updated)
+        self.assertIn(b'id="uuid_id">1b5e0f3c', updated)
+        self.assertTrue(updated.endswith(OPF2[OPF2.index(b'</metadata>'):]))
+
+    def test_update_epub3_opf(self):
+        updated = update_opf(OPF3, Metadata(
+            authors=['Terry Pratchett'],
+            author_sort='Pratchett, T.',
+            identifiers={'isbn': '9780062225672', 'google': 'abc'},
+            series='Discworld #1',
+        ))
+        self.assertNotIn(b'opf:', updated)
+        self.assertNotIn(b'belongs-to-collection', updated)
+        metadata = parse_opf(io.BytesIO(updated))
+        self.assertEqual(metadata.author_sort, 'Pratchett, T.')
+        self.assertEqual(metadata.identifiers, {'isbn': '9780062225672', 'google': 'abc'})
+        self.assertEqual(metadata.series, 'Discworld #1')
+        self.assertEqual(metadata.title, 'The Colour of Magic')
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from capybre import convert, ConversionCache, ConversionProfile, EbookFormat
+from capybre.profiles import get_profile, profile_args
+
+from . import helpers
+
+
+class ProfileTest(TestCase):
+
+    def test_args(self):
+        profile = ConversionProfile(
+            common={'smarten_punctuation': True, 'base_font_size': 12},
+            input_options={EbookFormat.PDF: {'unwrap_factor': 0.5}},
+            output_options={
+                EbookFormat.PDF: {'paper_size': 'a5', 'pdf_page_numbers': True},
+                EbookFormat.MOBI: {'no_inline_toc': True},
+            },
+        )
+        self.assertEqual(
+            profile.args(EbookFormat.EPUB, EbookFormat.PDF),
+            ['--base-font-size', '12.0', '--smarten-punctuation',
+             '--paper-size', 'a5', '--pdf-page-numbers']
+        )
+        self.assertEqual(
+            profile.args(EbookFormat.PDF, EbookFormat.MOBI),
+            ['--base-font-size', '12.0', '--smarten-punctuation',
+             '--unwrap-factor', '0.5', '--no-inline-toc']
+        )
+
+    def test_validation(self):
+        with self.assertRaises(Exception):
+            ConversionProfile(common={'no_such_option': True})
+        with self.assertRaises(Exception):
+            # a PDF option given for MOBI output
+            ConversionProfile(output_options={EbookFormat.MOBI: {'paper_size': 'a4'}})
+        with self.assertRaises(Exception):
+            ConversionProfile(output_options={EbookFormat.PDF: {'paper_size': 'huge'}})
+        with self.assertRaises(Exception):
+            ConversionProfile(output_options={EbookFormat.EPUB: {'flow_size': 'big'}})
+
+    def test_presets(self):
+        self.assertEqual(get_profile('fast').name, 'fast')
+        self.assertEqual(profile_args('balanced', 'a.epub', 'a.mobi'), [])
+        self.assertIn('--no-inline-toc', profile_args('fast', 'a.epub', 'a.mobi'))
+        self.assertIn('--enable-heuristics', profile_args('quality', 'a.epub', 'a.pdf'))
+        with self.assertRaises(Exception):
+            get_profile('fastest')
+
+    def test_updated(self):
+        profile = get_profile('fast').updated(output_options={EbookFormat.MOBI: {'mobi_file_type': 'new'}})
+        args = profile.args(EbookFormat.EPUB, EbookFormat.MOBI)
+        self.assertIn('--no-inline-toc', args)
+        self.assertIn('new', args)
+        self.assertNotIn('new', get_profile('fast').args(EbookFormat.EPUB, EbookFormat.MOBI))
+
+    def test_profile_in_cache_key(self):
+        directory = tempfile.mkdtemp()
+        output_file = helpers.local_path('profiled.mobi')
+        try:
+            cache = ConversionCache(directory)
+            for profile in ('fast', 'quality', 'fast'):
+                convert(helpers.SAMPLE_FILE, output_file, cache=cache, profile=profile)
+                self.assertTrue(os.path.isfile(output_file))
+            self.assertEqual(cache.misses, 2)
+            self.assertEqual(cache.hits, 1)
+        finally:
+            shutil.rmtree(directory)
+            if os.path.exists(output_file):
+                os.remove(output_file)
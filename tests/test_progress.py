@@ -0,0 +1,74 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from capybre import async_convert_progress, CalibreTimeout, convert, ConversionStalled
+from capybre.progress import parse_progress
+from capybre.toolchain import set_toolchain, Toolchain
+
+from . import helpers
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+async def collect(iterator):
+    return [progress async for progress in iterator]
+
+
+class ProgressTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_file = os.path.join(self.directory.name, 'out.mobi')
+
+    def tearDown(self):
+        set_toolchain(None)
+        os.environ.pop('CAPYBRE_STUB_LATENCY', None)
+        self.directory.cleanup()
+
+    def hang(self):
+        """Swaps in stub tools that print nothing for 30 seconds"""
+        os.environ['CAPYBRE_STUB_LATENCY'] = '30'
+        set_toolchain(Toolchain(helpers.STUBS))
+
+    def test_parse_progress(self):
+        self.assertEqual(parse_progress(b'34% Running transforms on e-book\n'), ('Running transforms on e-book', 0.34))
+        self.assertEqual(parse_progress('100%'), ('', 1.0))
+        self.assertIsNone(parse_progress('Converting input to HTML...'))
+        self.assertIsNone(parse_progress('250% nonsense'))
+
+    def test_on_progress(self):
+        seen = []
+        convert(helpers.SAMPLE_FILE, self.output_file, on_progress=seen.append, stall_timeout=30)
+        self.assertTrue(os.path.isfile(self.output_file))
+        self.assertGreater(len(seen), 1)
+        fractions = [progress.fraction for progress in seen]
+        self.assertEqual(fractions, sorted(fractions))
+        self.assertEqual(fractions[-1], 1.0)
+        stage, fraction, elapsed = seen[-1]
+        self.assertGreaterEqual(elapsed, seen[0].elapsed)
+
+    def test_stall(self):
+        self.hang()
+        start = time.monotonic()
+        with self.assertRaises(ConversionStalled) as context:
+            convert(helpers.SAMPLE_FILE, self.output_file, stall_timeout=0.2)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIsInstance(context.exception, CalibreTimeout)
+        self.assertFalse(os.path.exists(self.output_file))
+
+    def test_async_progress(self):
+        seen = run(collect(async_convert_progress(helpers.SAMPLE_FILE, self.output_file, stall_timeout=30)))
+        self.assertTrue(os.path.isfile(self.output_file))
+        self.assertEqual(seen[-1].fraction, 1.0)
+
+    def test_async_stall(self):
+        self.hang()
+        start = time.monotonic()
+        with self.assertRaises(ConversionStalled):
+            run(collect(async_convert_progress(helpers.SAMPLE_FILE, self.output_file, stall_timeout=0.2)))
+        self.assertLess(time.monotonic() - start, 10)
@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from unittest import TestCase
+
+from capybre import CalibreTimeout, RemoteConverter, WorkerServer, WorkerUnavailable
+from capybre.toolchain import set_toolchain, Toolchain
+
+from . import helpers
+
+
+def start_worker(*args, latency='1'):
+    """Runs ``capybre worker`` over the stub tools in a new process,
+    returning it and its URL"""
+    env = dict(os.environ, CAPYBRE_CALIBRE_DIR=helpers.STUBS, CAPYBRE_STUB_LATENCY=latency)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'capybre', 'worker', '--port', '0'] + list(args),
+        stdout=subprocess.PIPE,
+        env=env,
+        cwd=os.path.dirname(helpers.THIS_DIR)
+    )
+    line = process.stdout.readline().decode('utf-8')
+    return process, line.split()[-1]
+
+
+def get(url, token=None):
+    request = urllib.request.Request(url)
+    if token:
+        request.add_header('Authorization', 'Bearer ' + token)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+class RemoteConverterTest(TestCase):
+
+    def setUp(self):
+        self.processes = []
+        self.urls = []
+        for _ in range(3):
+            process, url = start_worker('--slots', '1')
+            self.processes.append(process)
+            self.urls.append(url)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+        shutil.rmtree(self.directory)
+
+    def inputs(self, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.directory, 'book{}.epub'.format(i))
+            shutil.copyfile(helpers.SAMPLE_FILE, path)
+            paths.append(path)
+        return paths
+
+    def test_capacity(self):
+        capacity = get(self.urls[0] + '/capacity')
+        self.assertEqual(capacity['slots'], 1)
+        self.assertEqual(capacity['free'], 1)
+
+    def test_convert(self):
+        converter = RemoteConverter(self.urls)
+        output_file = converter.convert(self.inputs(1)[0], as_ext='mobi')
+        self.assertTrue(output_file.endswith('book0.mobi'))
+        self.assertGreater(os.path.getsize(output_file), 0)
+
+    def test_spreads_load(self):
+        converter = RemoteConverter(self.urls)
+        results = list(converter.convert_many(self.inputs(6), as_ext='mobi'))
+        self.assertTrue(all(result.ok for result in results))
+        completed = [worker['completed'] for worker in converter.status()]
+        self.assertEqual(sum(completed), 6)
+        self.assertTrue(all(completed), completed)
+
+    def test_retries_lost_worker(self):
+        converter = RemoteConverter(self.urls, retries=3)
+        results = []
+        consumer = threading.Thread(
+            target=lambda: results.extend(converter.convert_many(self.inputs(4), as_ext='mobi'))
+        )
+        consumer.start()
+        deadline = time.monotonic() + 30
+        while get(self.urls[0] + '/capacity')['busy'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.processes[0].kill()
+        consumer.join()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result.ok for result in results), [r.error for r in results])
+        status = converter.status()
+        self.assertFalse(status[0]['alive'])
+        self.assertEqual(status[0]['failed'], 1)
+
+    def test_no_workers(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        with self.assertRaises(WorkerUnavailable):
+            RemoteConverter(self.urls).convert(self.inputs(1)[0], as_ext='mobi')
+
+
+class WorkerServerTest(TestCase):
+
+    def setUp(self):
+        # the stubs have no calibre-debug, which a worker doesn't need
+        set_toolchain(Toolchain(helpers.STUBS))
+        self.server = WorkerServer(port=0, slots=2, token='s3cret').start()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        set_toolchain(None)
+        shutil.rmtree(self.directory)
+
+    def test_health(self):
+        health = get(self.server.url + '/health', 's3cret')
+        self.assertTrue(health['ok'])
+        self.assertEqual(health['slots'], 2)
+        self.assertEqual(health['toolchain']['version'], '5.0.1')
+        self.assertIsNone(health['toolchain']['tools']['calibre-debug'])
+
+    def test_token(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            get(self.server.url + '/capacity')
+        self.assertEqual(context.exception.code, 401)
+        context.exception.close()
+        with self.assertRaises(WorkerUnavailable) as context:
+            RemoteConverter([self.server.url]).convert(helpers.SAMPLE_FILE, as_ext='mobi')
+        self.assertIn('401', str(context.exception))
+
+    def test_convert_bytes(self):
+        converter = RemoteConverter([self.server.url], token='s3cret')
+        with open(helpers.SAMPLE_FILE, 'rb') as f:
+            converted = converter.convert_bytes(f.read(), 'epub', as_ext='txt')
+        self.assertGreater(len(converted), 0)
+
+
+class RemoteErrorTest(TestCase):
+
+    def test_timeout(self):
+        process, url = start_worker('--timeout', '0.5', latency='30')
+        directory = tempfile.mkdtemp()
+        try:
+            output_file = os.path.join(directory, 'out.mobi')
+            with self.assertRaises(CalibreTimeout):
+                RemoteConverter([url]).convert(helpers.SAMPLE_FILE, output_file)
+            self.assertFalse(os.path.exists(output_file))
+            self.assertEqual(get(url + '/capacity')['failed'], 1)
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            shutil.rmtree(directory)
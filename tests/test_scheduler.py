@@ -0,0 +1,114 @@
+import threading
+import time
+from unittest import TestCase
+
+from capybre import Metadata, QueueFull, Scheduler
+
+from . import helpers
+
+
+class SchedulerTest(TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(concurrency={'convert': 1, 'extract': 2}, max_queued=10)
+        self.release = threading.Event()
+        self.order = []
+
+    def tearDown(self):
+        self.release.set()
+        self.scheduler.shutdown()
+
+    def block(self, job_class='convert', **kwargs):
+        """Occupies a worker of job_class until self.release is set"""
+        started = threading.Event()
+
+        def run():
+            started.set()
+            self.release.wait()
+
+        future = self.scheduler.submit(job_class, run, **kwargs)
+        started.wait()
+        return future
+
+    def record(self, name, job_class='convert', **kwargs):
+        return self.scheduler.submit(job_class, self.order.append, name, **kwargs)
+
+    def test_priority(self):
+        self.block()
+        futures = [
+            self.record('low', priority=-1),
+            self.record('normal'),
+            self.record('high', priority=5),
+            self.record('normal again'),
+        ]
+        self.release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.order, ['high', 'normal', 'normal again', 'low'])
+
+    def test_tenant_fairness(self):
+        self.block(tenant='bulk')
+        futures = [self.record('bulk{}'.format(i), tenant='bulk') for i in range(3)]
+        futures += [self.record('reader{}'.format(i), tenant='reader') for i in range(2)]
+        self.release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.order, ['reader0', 'bulk0', 'reader1', 'bulk1', 'bulk2'])
+
+    def test_classes_run_independently(self):
+        self.block('convert')
+        metadata = self.scheduler.extract_metadata(helpers.SAMPLE_FILE).result(timeout=5)
+        self.assertIsInstance(metadata, Metadata)
+        self.assertEqual(metadata.title, 'Pride and Prejudice')
+
+    def test_backpressure(self):
+        scheduler = Scheduler(concurrency={'convert': 1}, max_queued=1, block=False)
+        try:
+            started = threading.Event()
+            scheduler.submit('convert', lambda: (started.set(), self.release.wait()))
+            started.wait()
+            scheduler.submit('convert', self.order.append, 'queued')
+            with self.assertRaises(QueueFull):
+                scheduler.submit('convert', self.order.append, 'rejected')
+
+            begun = time.monotonic()
+            with self.assertRaises(QueueFull):
+                scheduler.submit('convert', self.order.append, 'late', block=True, timeout=0.2)
+            self.assertGreaterEqual(time.monotonic() - begun, 0.2)
+
+            threading.Timer(0.1, self.release.set).start()
+            scheduler.submit('convert', self.order.append, 'waited', block=True).result(timeout=5)
+            self.assertEqual(self.order, ['queued', 'waited'])
+            self.assertEqual(scheduler.metrics()['convert']['rejected'], 2)
+        finally:
+            scheduler.shutdown()
+
+    def test_metrics(self):
+        self.block(tenant='bulk')
+        self.record('a', tenant='bulk')
+        self.record('b', tenant='reader')
+        failing = self.scheduler.submit('convert', lambda: 1 / 0)
+        metrics = self.scheduler.metrics()['convert']
+        self.assertEqual(metrics['queued'], 3)
+        self.assertEqual(metrics['running'], 1)
+        self.assertEqual(metrics['tenants']['bulk'], {'queued': 1, 'running': 1})
+        self.assertEqual(metrics['tenants']['reader'], {'queued': 1, 'running': 0})
+
+        self.release.set()
+        with self.assertRaises(ZeroDivisionError):
+            failing.result(timeout=5)
+        self.scheduler.shutdown()
+        metrics = self.scheduler.metrics()['convert']
+        self.assertEqual((metrics['completed'], metrics['failed']), (3, 1))
+        self.assertEqual(metrics['wait_seconds']['count'], 4)
+        self.assertGreater(metrics['wait_seconds']['max'], 0)
+
+    def test_shutdown_cancels_pending(self):
+        self.block()
+        pending = self.record('never')
+        threading.Timer(0.1, self.release.set).start()
+        self.scheduler.shutdown(cancel_pending=True)
+        self.assertTrue(pending.cancelled())
+        self.assertEqual(self.order, [])
+        with self.assertRaises(Exception):
+            self.record('closed')
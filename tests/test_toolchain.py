@@ -0,0 +1,83 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from capybre import EbookFormat, extract_metadata
+from capybre.toolchain import (
+    CalibreNotFound,
+    Toolchain,
+    get_toolchain,
+    set_toolchain,
+)
+
+from . import helpers
+
+
+class ToolchainTest(TestCase):
+
+    def tearDown(self):
+        set_toolchain(None)
+
+    def test_resolves_once(self):
+        toolchain = Toolchain()
+        path = toolchain.path('ebook-meta')
+        self.assertTrue(os.path.isabs(path))
+        self.assertEqual(path, shutil.which('ebook-meta'))
+        self.assertEqual(toolchain.command(['ebook-meta', 'book.epub']), [path, 'book.epub'])
+        self.assertEqual(toolchain.command(['ls', '-l']), ['ls', '-l'])
+
+        original = os.environ['PATH']
+        os.environ['PATH'] = ''
+        try:
+            self.assertEqual(toolchain.path('ebook-meta'), path)
+        finally:
+            os.environ['PATH'] = original
+
+    def test_missing_calibre(self):
+        with tempfile.TemporaryDirectory() as directory:
+            set_toolchain(Toolchain(directory))
+            with self.assertRaises(CalibreNotFound) as raised:
+                extract_metadata(helpers.SAMPLE_FILE, native=False)
+            self.assertIn(directory, str(raised.exception))
+            self.assertIsInstance(raised.exception, FileNotFoundError)
+
+            status = get_toolchain().health_check()
+            self.assertFalse(status['ok'])
+            self.assertIsNone(status['version'])
+            self.assertIn('ebook-convert not found', status['errors'])
+
+    def test_capabilities(self):
+        toolchain = Toolchain()
+        status = toolchain.health_check()
+        self.assertTrue(status['ok'], status['errors'])
+        self.assertIsInstance(toolchain.version, tuple)
+        self.assertIn('epub', toolchain.input_formats)
+        self.assertIn('mobi', toolchain.output_formats)
+        self.assertTrue(toolchain.supports(EbookFormat.EPUB, 'mobi'))
+        self.assertFalse(toolchain.supports('epub', 'exe'))
+
+
+class LazyImportTest(TestCase):
+
+    def test_import_is_lazy(self):
+        loaded = subprocess.run(
+            [sys.executable, '-c', 'import capybre, sys; print(sorted(sys.modules))'],
+            stdout=subprocess.PIPE,
+            check=True
+        ).stdout.decode('utf-8')
+        self.assertNotIn('capybre.convert', loaded)
+        self.assertNotIn('asyncio', loaded)
+
+    def test_exports(self):
+        import capybre.convert
+        # the submodule of the same name doesn't hide the function
+        self.assertTrue(callable(capybre.convert))
+        self.assertIs(capybre.convert, capybre.convert_many.__globals__['convert'])
+        for name in capybre.__all__:
+            self.assertTrue(hasattr(capybre, name), name)
+        self.assertIn('convert_to_many', dir(capybre))
+        with self.assertRaises(AttributeError):
+            capybre.not_an_export
@@ -0,0 +1,75 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from capybre import convert, extract_metadata, MetadataNotFound, WorkerPool
+from capybre.fetch_metadata import fetch_metadata_args, lookup
+from capybre.helpers import get_backend
+
+from . import helpers
+
+# runs the worker script with the fake calibre package beside it importable
+FAKE_CALIBRE_DEBUG = '''import os, runpy, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+runpy.run_path(sys.argv[2], run_name='__main__')
+'''
+# a source lookup that finds nothing, reported the way Calibre's prints() does
+NO_RESULTS_CLI = '''import sys
+def main(args):
+    sys.stderr.buffer.write(b'No results found\\n')
+    return 1
+'''
+
+
+class WorkerPoolTest(TestCase):
+    def test_routes_public_functions(self):
+        output_file = helpers.local_path('pooled.mobi')
+        with WorkerPool(size=1) as pool:
+            self.assertIs(get_backend(), pool)
+            metadata = extract_metadata(helpers.SAMPLE_FILE, native=False)
+            convert(helpers.SAMPLE_FILE, output_file=output_file)
+        self.assertIsNone(get_backend())
+        self.assertEqual(metadata.title, 'Pride and Prejudice')
+        self.assertTrue(os.path.isfile(output_file))
+        os.remove(output_file)
+
+    def test_batched_metadata(self):
+        files = [helpers.SAMPLE_FILE] * 5 + [helpers.local_path('missing.epub')]
+        with WorkerPool(size=2) as pool:
+            results = pool.extract_metadata_many(files, batch_size=2)
+        self.assertEqual(
+            [m.author_sort for m in results[:5]],
+            ['Austen, Jane'] * 5
+        )
+        self.assertIsInstance(results[5], Exception)
+        # each listing of a path gets a result of its own
+        self.assertEqual(len({id(m) for m in results[:5]}), 5)
+
+    def test_recycles_and_restarts_workers(self):
+        with WorkerPool(size=1, max_jobs=1) as pool:
+            extract_metadata(helpers.SAMPLE_FILE, native=False)
+            first = next(iter(pool._workers))
+            extract_metadata(helpers.SAMPLE_FILE, native=False)
+            second = next(iter(pool._workers))
+            self.assertIsNot(first, second)
+
+            second.process.kill()
+            second.process.wait()
+            self.assertEqual(
+                extract_metadata(helpers.SAMPLE_FILE, native=False).title,
+                'Pride and Prejudice'
+            )
+
+    def test_fetch_not_found(self):
+        with tempfile.TemporaryDirectory() as directory:
+            package = directory
+            for name in ('calibre', 'ebooks', 'metadata', 'sources'):
+                package = os.path.join(package, name)
+                os.mkdir(package)
+                open(os.path.join(package, '__init__.py'), 'w').close()
+            with open(os.path.join(package, 'cli.py'), 'w') as f:
+                f.write(NO_RESULTS_CLI)
+            calibre_debug = helpers.write_tool(directory, 'calibre-debug', FAKE_CALIBRE_DEBUG)
+            with WorkerPool(size=1, calibre_debug=calibre_debug):
+                with self.assertRaises(MetadataNotFound):
+                    lookup(fetch_metadata_args(isbn='0000'))
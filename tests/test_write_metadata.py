@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import date
+from unittest import TestCase
+
+from capybre import (
+    extract_metadata,
+    write_metadata,
+    write_metadata_many,
+    Metadata,
+)
+from capybre.instrumentation import add_listener, remove_listener
+
+from . import helpers
+
+
+class WriteMetadataTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.book = os.path.join(self.directory, 'PrideAndPrejudice.epub')
+        shutil.copyfile(helpers.SAMPLE_FILE, self.book)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_epub(self):
+        invocations = []
+        add_listener(invocations.append)
+        try:
+            write_metadata(self.book, Metadata(
+                title='Pride & Prejudice',
+                tags=['Classics'],
+                publication_date=date(1813, 1, 28),
+            ))
+        finally:
+            remove_listener(invocations.append)
+        self.assertEqual(invocations, [])
+
+        metadata = extract_metadata(self.book)
+        self.assertEqual(metadata.title, 'Pride & Prejudice')
+        self.assertEqual(metadata.tags, ['Classics'])
+        self.assertEqual(metadata.publication_date, date(1813, 1, 28))
+        self.assertEqual(metadata.author, 'Jane Austen')
+        self.assertEqual(os.listdir(self.directory), ['PrideAndPrejudice.epub'])
+
+        with zipfile.ZipFile(helpers.SAMPLE_FILE) as before, zipfile.ZipFile(self.book) as after:
+            self.assertIsNone(after.testzip())
+            self.assertEqual(before.namelist(), after.namelist())
+            for info in before.infolist():
+                if not info.filename.endswith('.opf'):
+                    self.assertEqual(after.getinfo(info.filename).compress_size, info.compress_size)
+                    self.assertEqual(after.read(info.filename), before.read(info.filename))
+
+    def test_write_with_ebook_meta(self):
+        invocations = []
+        add_listener(invocations.append)
+        try:
+            write_metadata(self.book, Metadata(title='Pride & Prejudice', rating=5), native=False)
+        finally:
+            remove_listener(invocations.append)
+        self.assertEqual(len(invocations), 1)
+        args = invocations[0].args
+        self.assertEqual(args[0], 'ebook-meta')
+        self.assertNotEqual(args[1], self.book)
+        self.assertEqual(args[2:], ['--title', 'Pride & Prejudice', '--rating', '5'])
+        self.assertEqual(os.listdir(self.directory), ['PrideAndPrejudice.epub'])
+
+    def test_write_many(self):
+        missing = os.path.join(self.directory, 'missing.epub')
+        results = list(write_metadata_many([
+            (self.book, Metadata(publisher='Penguin')),
+            (missing, Metadata(publisher='Penguin')),
+        ], max_workers=2))
+        failed = [r for r in results if not r.ok]
+        self.assertEqual(len(results), 2)
+        self.assertEqual([r.input_file for r in failed], [missing])
+        self.assertEqual(extract_metadata(self.book).publisher, 'Penguin')
+        self.assertEqual(os.listdir(self.directory), ['PrideAndPrejudice.epub'])